@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import shutil
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+from selinuxtool.util.common import file_digest
+
+_logger = logging.getLogger('SELinuxTool')
+
+POLICY_CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME', '~/.cache')).expanduser() / 'selinuxtool'
+DEFAULT_CACHE_SIZE = 4 * 2**30
+
+# Entries are only valid once their metadata has been written
+META_FILE = 'meta.json'
+
+
+class PolicyCache:
+    # Content-addressed store of loaded policies: each entry is a directory named after the hash
+    # of the policy inputs, evicted least recently used first once the cache exceeds max_bytes
+    def __init__(self, root: Path = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_CACHE_SIZE) -> None:
+        self._root = root
+        self._max_bytes = max_bytes
+
+    @property
+    def root(self) -> Path:
+        return self._root
+
+    @staticmethod
+    def key(inputs: list[Path]) -> str:
+        version = POLICY_CACHE_VERSION.to_bytes(4, 'little')
+        return (version + file_digest(inputs)).hex()
+
+    def lookup(self, key: str) -> tuple[Path, dict] | None:
+        entry = self._root / key
+        # The entry may be evicted by a concurrent load at any point, which is just a miss
+        try:
+            with open(entry / META_FILE) as meta_file:
+                meta = json.load(meta_file)
+            if meta.get('version') != POLICY_CACHE_VERSION:
+                return None
+            os.utime(entry / META_FILE)  # Recently used
+        except (OSError, ValueError):
+            return None
+        return entry, meta
+
+    def store(self, key: str, write: Callable[[Path], dict]) -> None:
+        # Entries are written aside and renamed in place, so readers never see partial ones
+        self._root.mkdir(parents=True, exist_ok=True)
+        entry = self._root / key
+        tmp_entry = self._root / f'.{key}.{os.getpid()}'
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        tmp_entry.mkdir()
+        try:
+            meta = write(tmp_entry)
+            meta['version'] = POLICY_CACHE_VERSION
+            meta['created'] = time.time()
+            with open(tmp_entry / META_FILE, 'w') as meta_file:
+                json.dump(meta, meta_file)
+            shutil.rmtree(entry, ignore_errors=True)
+            tmp_entry.rename(entry)
+        except OSError as e:
+            _logger.warning(f'Could not cache policy ({e}).')
+        finally:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self.evict(keep=key)
+
+    def evict(self, keep: str | None = None) -> None:
+        entries = []
+        total_size = 0
+        for entry in self._root.iterdir():
+            if not entry.is_dir() or entry.name.startswith('.'):
+                continue
+            # Concurrent loads may be storing or evicting entries at the same time
+            try:
+                size = sum(path.stat().st_size for path in entry.rglob('*') if path.is_file())
+                meta_path = entry / META_FILE
+                last_used = meta_path.stat().st_mtime if meta_path.exists() else 0.0
+            except OSError:
+                continue
+            entries.append((last_used, size, entry))
+            total_size += size
+
+        for _, size, entry in sorted(entries):
+            if total_size <= self._max_bytes:
+                break
+            if entry.name == keep:
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            total_size -= size
+            _logger.info(f'Evicted cached policy {entry.name[:16]} ({size / 2**20:.2f} MiB).')
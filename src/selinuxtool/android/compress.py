@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import logging
+import time
+from array import array
+from collections.abc import Iterator
+
+import networkx as nx
+
+from selinuxtool.android.csr import CSRAdjacency
+from selinuxtool.android.label import EdgeType
+
+_logger = logging.getLogger('SELinuxTool')
+
+
+def _bits(mask: int) -> list[int]:
+    return [pos for pos, bit in enumerate(bin(mask)[:1:-1]) if bit == '1']
+
+
+class SubjectCompression:
+    # Object-only view of a policy graph: object a flows to object b if the policy has an edge
+    # between them, or a path whose inner nodes are all non-objects (subjects), which the
+    # simplified graph represents with an ADDL edge
+    def __init__(self, graph: nx.DiGraph) -> None:
+        self._graph = graph
+        self._labels: list[str] = list(graph)
+        self._ids = {label: node_id for node_id, label in enumerate(self._labels)}
+        self._is_object = bytearray(
+            bool(graph.nodes[label].get('is_object', False)) for label in self._labels
+        )
+
+        sources = array('i')
+        targets = array('i')
+        for source, target in graph.edges():
+            sources.append(self._ids[source])
+            targets.append(self._ids[target])
+        self._successors = CSRAdjacency.from_edges(len(self._labels), sources, targets)
+        self._predecessors: CSRAdjacency | None = None
+        self._trees: dict[int, tuple[array, array]] = {}
+
+    @property
+    def objects(self) -> list[str]:
+        return [label for node_id, label in enumerate(self._labels) if self._is_object[node_id]]
+
+    def object_edges(self) -> Iterator[tuple[str, str]]:
+        # Object pairs linked by a path through one or more subjects
+        is_object = self._is_object
+        successors = self._successors
+        objects = [node_id for node_id in range(len(self._labels)) if is_object[node_id]]
+        object_pos = {node_id: pos for pos, node_id in enumerate(objects)}
+
+        # Subjects in the same SCC reach the same objects, rows are bitsets over object positions
+        sources = array('i')
+        targets = array('i')
+        for source, target in successors.edges():
+            if not is_object[source] and not is_object[target]:
+                sources.append(source)
+                targets.append(target)
+        component, count = CSRAdjacency.from_edges(len(self._labels), sources, targets).components()
+
+        rows = [0] * count
+        component_targets: list[set[int]] = [set() for _ in range(count)]
+        for source in range(len(self._labels)):
+            if is_object[source]:
+                continue
+            for target in successors.neighbours(source):
+                if is_object[target]:
+                    rows[component[source]] |= 1 << object_pos[target]
+                elif component[target] != component[source]:
+                    component_targets[component[source]].add(component[target])
+
+        # Components are numbered sinks first, so the rows of the successors are complete
+        for source_component in range(count):
+            for target_component in component_targets[source_component]:
+                rows[source_component] |= rows[target_component]
+
+        for source in objects:
+            subjects = [node for node in successors.neighbours(source) if not is_object[node]]
+            mask = 0
+            for subject_component in {component[subject] for subject in subjects}:
+                mask |= rows[subject_component]
+            for pos in _bits(mask):
+                yield self._labels[source], self._labels[objects[pos]]
+
+    def simple_graph(self) -> nx.DiGraph:
+        init_time = time.time()
+        graph = nx.DiGraph()
+        graph.add_nodes_from((label, self._graph.nodes[label]) for label in self.objects)
+        graph.add_edges_from(
+            (source, target, data)
+            for source, target, data in self._graph.edges(data=True)
+            if source in graph and target in graph
+        )
+
+        bypass_count = 0
+        for source, target in self.object_edges():
+            if not graph.has_edge(source, target):
+                graph.add_edge(source, target, type=EdgeType.ADDL)
+                bypass_count += 1
+        _logger.debug(f'Added {bypass_count} bypass edges in {time.time() - init_time}.')
+        return graph
+
+    def _tree(self, source_id: int) -> tuple[array, array]:
+        # BFS tree through subjects from one object (parent and depth per node, -1 if unreached),
+        # built once per queried source and shared by all its targets
+        if source_id not in self._trees:
+            parent = array('i', [-1]) * len(self._labels)
+            depth = array('i', [-1]) * len(self._labels)
+            depth[source_id] = 0
+            frontier = [source_id]
+            while frontier:
+                next_frontier = []
+                for node in frontier:
+                    for successor in self._successors.neighbours(node):
+                        if not self._is_object[successor] and depth[successor] == -1:
+                            parent[successor] = node
+                            depth[successor] = depth[node] + 1
+                            next_frontier.append(successor)
+                frontier = next_frontier
+            self._trees[source_id] = (parent, depth)
+        return self._trees[source_id]
+
+    def witness(self, source: str, target: str) -> list[str] | None:
+        # Subjects along a shortest source -> target path through subjects only, materialised on
+        # demand instead of storing the omitted nodes on every ADDL edge
+        if self._predecessors is None:
+            self._predecessors = self._successors.reverse()
+        parent, depth = self._tree(self._ids[source])
+
+        last = -1
+        for node in self._predecessors.neighbours(self._ids[target]):
+            if depth[node] > 0 and (last == -1 or depth[node] < depth[last]):
+                last = node
+        if last == -1:
+            return None
+
+        path = [last]
+        while depth[path[-1]] > 1:
+            path.append(parent[path[-1]])
+        return [self._labels[node_id] for node_id in reversed(path)]
@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import sys
+from array import array
+from collections.abc import Iterable
+
+
+class CSRAdjacency:
+    # Compressed sparse rows: the neighbours of node i are targets[offsets[i]:offsets[i + 1]]
+    __slots__ = ('_offsets', '_targets')
+
+    def __init__(self, offsets: array, targets: array) -> None:
+        self._offsets = offsets
+        self._targets = targets
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    @property
+    def num_edges(self) -> int:
+        return len(self._targets)
+
+    @property
+    def nbytes(self) -> int:
+        return (len(self._offsets) + len(self._targets)) * self._targets.itemsize
+
+    @staticmethod
+    def from_edges(num_nodes: int, sources: array, targets: array) -> CSRAdjacency:
+        # Counting sort of the edges by source, stable w.r.t. the insertion order
+        offsets = array('i', bytes(4 * (num_nodes + 1)))
+        for source in sources:
+            offsets[source + 1] += 1
+        for node in range(num_nodes):
+            offsets[node + 1] += offsets[node]
+
+        fill = array('i', offsets[:-1])
+        sorted_targets = array('i', bytes(4 * len(targets)))
+        for source, target in zip(sources, targets):
+            sorted_targets[fill[source]] = target
+            fill[source] += 1
+        return CSRAdjacency(offsets, sorted_targets)
+
+    @staticmethod
+    def from_pairs(num_nodes: int, edges: Iterable[tuple[int, int]]) -> CSRAdjacency:
+        sources = array('i')
+        targets = array('i')
+        for source, target in edges:
+            sources.append(source)
+            targets.append(target)
+        return CSRAdjacency.from_edges(num_nodes, sources, targets)
+
+    def neighbours(self, node: int) -> array:
+        return self._targets[self._offsets[node] : self._offsets[node + 1]]
+
+    def edges(self) -> Iterable[tuple[int, int]]:
+        for source in range(len(self)):
+            for target in self.neighbours(source):
+                yield source, target
+
+    def reverse(self) -> CSRAdjacency:
+        sources = array('i')
+        for source in range(len(self)):
+            sources.extend([source] * (self._offsets[source + 1] - self._offsets[source]))
+        return CSRAdjacency.from_edges(len(self), self._targets, sources)
+
+    def components(self) -> tuple[array, int]:
+        # Iterative Tarjan, components are numbered in reverse topological order (sinks first)
+        num_nodes = len(self)
+        index = array('i', [-1]) * num_nodes
+        lowlink = array('i', bytes(4 * num_nodes))
+        component = array('i', [-1]) * num_nodes
+        stack: list[int] = []
+        count = 0
+        next_index = 0
+
+        for root in range(num_nodes):
+            if index[root] != -1:
+                continue
+            index[root] = lowlink[root] = next_index
+            next_index += 1
+            stack.append(root)
+            work = [(root, self._offsets[root])]
+
+            while work:
+                node, pos = work[-1]
+                if pos < self._offsets[node + 1]:
+                    work[-1] = (node, pos + 1)
+                    target = self._targets[pos]
+                    if index[target] == -1:
+                        index[target] = lowlink[target] = next_index
+                        next_index += 1
+                        stack.append(target)
+                        work.append((target, self._offsets[target]))
+                    elif component[target] == -1:  # Still on the stack
+                        lowlink[node] = min(lowlink[node], index[target])
+                    continue
+
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    member = -1
+                    while member != node:
+                        member = stack.pop()
+                        component[member] = count
+                    count += 1
+
+        return component, count
+
+
+class TransitiveClosure:
+    # Reachability (in one or more steps) of the SCC condensation, one bitset row per component
+    __slots__ = ('_component', '_rows')
+
+    def __init__(self, adjacency: CSRAdjacency) -> None:
+        component, count = adjacency.components()
+        members = [0] * count
+        targets: list[set[int]] = [set() for _ in range(count)]
+        for source, target in adjacency.edges():
+            targets[component[source]].add(component[target])
+        for node in range(len(adjacency)):
+            members[component[node]] |= 1 << node
+
+        # Successor components always have a smaller number, so their rows are complete
+        rows = [0] * count
+        for source_component in range(count):
+            row = 0
+            for target_component in targets[source_component]:
+                row |= members[target_component]
+                if target_component != source_component:
+                    row |= rows[target_component]
+            rows[source_component] = row
+
+        self._component = component
+        self._rows = rows
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    @property
+    def nbytes(self) -> int:
+        rows = sum(sys.getsizeof(row) for row in self._rows)
+        return len(self._component) * self._component.itemsize + rows
+
+    def reachable(self, sources: Iterable[int]) -> int:
+        mask = 0
+        for source_component in {self._component[source] for source in sources}:
+            mask |= self._rows[source_component]
+        return mask
@@ -4,19 +4,56 @@ from __future__ import annotations
 import json
 import logging
 import re
-import tempfile
+import struct
+import sys
+import time
+import weakref
+from array import array
 from pathlib import Path
+from typing import BinaryIO
 
 from libmata import alphabets as mata_alph
 from libmata import parser as mata_parser
 from libmata.nfa import nfa as mata_nfa
 
+from selinuxtool.util.common import NfaTable, nfa_from_table, nfa_to_table
+
+from .prefix import PrefixTrie, literal_prefix
+
 _logger = logging.getLogger('SELinuxTool')
 _rlogger = logging.getLogger('SELinuxTool:r')
 
 _ascii = {chr(i): i for i in range(32, 127)}  # Except non-printable characters
 _ascii_alphabet = mata_alph.OnTheFlyAlphabet.from_symbol_map(_ascii)
 
+FC_DB_VERSION = 2
+_FC_DB_MAGIC = b'FCDB'
+_FC_DB_HEADER = struct.Struct('<4sIc')
+_FC_DB_ENTRY = struct.Struct('<III')
+_BYTEORDER = b'<' if sys.byteorder == 'little' else b'>'
+
+# Process-wide interning of the NFAs, shared by all the policies loaded by the process (e.g.
+# consecutive releases of a device): shadowed entries are keyed by their regex and the set of
+# overlapping later regexes, aggregated types by the keys of their entries
+_EntryKey = tuple[str, frozenset[str]]
+_shadowed_nfas: dict[_EntryKey, mata_nfa.Nfa] = {}
+_type_nfas: dict[tuple[_EntryKey, ...], mata_nfa.Nfa] = {}
+# Keys used by the last load, kept when the tables are trimmed along with those of the contexts
+# still alive (NFAs cannot be weakly referenced, the contexts holding them can)
+_last_entries: set[_EntryKey] = set()
+_last_types: set[tuple[_EntryKey, ...]] = set()
+_interned_contexts: weakref.WeakSet[FileContext] = weakref.WeakSet()
+# NFAs received from other processes or read from dbs are interned by their transition table
+_table_nfas: dict[tuple[int, tuple[int, ...], tuple[int, ...], bytes], mata_nfa.Nfa] = {}
+
+
+def _table_nfa(table: NfaTable) -> mata_nfa.Nfa:
+    states, initial, final, transitions = table
+    table_key = (states, tuple(initial), tuple(final), transitions.tobytes())
+    if table_key not in _table_nfas:
+        _table_nfas[table_key] = nfa_from_table(table)
+    return _table_nfas[table_key]
+
 
 # File type (file object class)
 # https://github.com/SELinuxProject/selinux-notebook/blob/main/src/seandroid.md#file_contexts
@@ -66,6 +103,7 @@ class FileContext:
         self._ftype = file_type  # Future-proof
         self._ctx = ctx
         self._nfa = nfa
+        self._entry_keys: list[_EntryKey] = []  # Interning keys of its entries, if any
 
     @property
     def label(self) -> SELinuxContext:
@@ -77,6 +115,11 @@ class FileContext:
             raise ValueError('Attempted access to regex after initial setup.')
         return self._regex[0]
 
+    @property
+    def prefixes(self) -> set[str]:
+        # Literal prefixes shared by every path of the context (one per aggregated regex)
+        return {literal_prefix(regex) for regex in self._regex}
+
     @property
     def nfa(self) -> mata_nfa:
         return self._nfa
@@ -85,58 +128,101 @@ class FileContext:
     def nfa(self, nfa: mata_nfa) -> None:
         self._nfa = nfa
 
+    # NFAs are not picklable, they travel between processes as transition tables
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state['_nfa'] = None if self._nfa is None else nfa_to_table(self._nfa)
+        state['_entry_keys'] = []  # Only meaningful to the tables of the sending process
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        if self._nfa is not None:
+            self._nfa = _table_nfa(self._nfa)
+            _interned_contexts.add(self)
+
     def add_regex(self, other: FileContext) -> None:
         if len(other._regex) != 1:
             raise ValueError
         self._regex.append(other._regex[0])
 
-    # TODO: consider using json
-    def to_db_string(self) -> str:
-        ctx_string = f'{json.dumps(self._regex)}\t{self._ftype or ""}\t{self._ctx}'
-        mata_string = self.nfa.to_mata_str()
-
-        return f'--BEGIN--\n{ctx_string}\n{mata_string}--END--\n'
-
     @staticmethod
     def save(contexts: dict[str, FileContext], policy_path: str | Path) -> None:
         db_path = Path(policy_path) / 'db'
         db_path.mkdir(exist_ok=True)
 
-        with open(db_path / 'file_contexts.db', 'w') as db:
-            for _, ctx in contexts.items():
-                db.write(ctx.to_db_string())
+        # Each entry: lengths, JSON metadata (regexes, type, context, initial/final states) and
+        # the flat int32 transition table of its NFA
+        with open(db_path / 'file_contexts.db', 'wb') as db:
+            db.write(_FC_DB_HEADER.pack(_FC_DB_MAGIC, FC_DB_VERSION, _BYTEORDER))
+            for ctx in contexts.values():
+                num_states, initial_states, final_states, transitions = nfa_to_table(ctx.nfa)
+                metadata = json.dumps(
+                    {
+                        'regex': ctx._regex,
+                        'ftype': ctx._ftype or '',
+                        'ctx': str(ctx._ctx),
+                        'initial': initial_states,
+                        'final': final_states,
+                    }
+                ).encode()
+                db.write(_FC_DB_ENTRY.pack(len(metadata), num_states, len(transitions)))
+                db.write(metadata)
+                db.write(transitions.tobytes())
 
         _logger.info(f'Saved {len(contexts)} file contexts to db ({db_path}).')
 
     @staticmethod
-    def load(policy_path: Path) -> dict[str, FileContext]:
-        _rlogger.info('Loading file contexts from db.')
-        contexts: dict[str, FileContext] = {}
+    def load(policy_path: Path) -> dict[str, FileContext] | None:
+        # None if the db has another format or is corrupt, so that the contexts are rebuilt
+        init_time = time.time()
         db_path = Path(policy_path) / 'db' / 'file_contexts.db'
-        with open(db_path, 'r') as db:
-            raw_db = db.read()
-            ctx_expr = re.compile(
-                r'^--BEGIN--\n([^\t]*)\t([^\s]*)\t([^\s]*)\n(.*?)\n--END--$',
-                re.DOTALL | re.MULTILINE,
-            )
-            matches = ctx_expr.findall(raw_db)
-
-            for progress, (regex, file_type, ctx, mata_str) in enumerate(matches):
-                tmp_mata_file = tempfile.NamedTemporaryFile()
-                with open(tmp_mata_file.name, 'w') as f:
-                    f.write(mata_str)
-                nfa = mata_parser.from_mata(tmp_mata_file.name, mata_alph.IntAlphabet())
-
-                se_ctx = SELinuxContext.from_string(ctx)
-
-                contexts[se_ctx.type] = FileContext(json.loads(regex), file_type, se_ctx, nfa)
-                _rlogger.info(f'Loading file contexts from db {progress + 1} / {len(matches)}.')
+        with open(db_path, 'rb') as db:
+            header = _FC_DB_HEADER.pack(_FC_DB_MAGIC, FC_DB_VERSION, _BYTEORDER)
+            if db.read(_FC_DB_HEADER.size) != header:
+                _logger.warning(f'Ignoring file contexts db with unsupported format ({db_path}).')
+                return None
+
+            try:
+                contexts = FileContext._read_entries(db)
+            except (struct.error, IndexError, KeyError, ValueError, TypeError, OverflowError) as e:
+                # Truncated or corrupt entries (short reads, bad metadata, states or encodings)
+                _logger.warning(f'Ignoring corrupt file contexts db ({db_path}: {e}).')
+                return None
+            db_size = db.tell()
+        _interned_contexts.update(contexts.values())
+
+        load_time = max(time.time() - init_time, 1e-6)
         _logger.info(
             f'Loaded {len(contexts)} file contexts from db '
-            f'({policy_path.name}/db/file_contexts.db).'
+            f'({policy_path.name}/db/file_contexts.db) in {load_time:.4f} '
+            f'({len(contexts) / load_time:.0f} contexts/s, '
+            f'{db_size / 2**20 / load_time:.2f} MiB/s).'
         )
         return contexts
 
+    @staticmethod
+    def _read_entries(db: BinaryIO) -> dict[str, FileContext]:
+        contexts: dict[str, FileContext] = {}
+
+        def read(size: int) -> bytes:
+            data = db.read(size)
+            if len(data) != size:
+                raise ValueError(f'truncated entry {len(contexts) + 1}')
+            return data
+
+        while entry := db.read(_FC_DB_ENTRY.size):
+            metadata_size, num_states, num_transitions = _FC_DB_ENTRY.unpack(entry)
+            metadata = json.loads(read(metadata_size))
+            transitions = array('i')
+            transitions.frombytes(read(transitions.itemsize * num_transitions))
+            nfa = _table_nfa((num_states, metadata['initial'], metadata['final'], transitions))
+
+            se_ctx = SELinuxContext.from_string(metadata['ctx'])
+            contexts[se_ctx.type] = FileContext(metadata['regex'], metadata['ftype'], se_ctx, nfa)
+            _rlogger.info(f'Loading file contexts from db {len(contexts)}.')
+        return contexts
+
     @staticmethod
     def from_files(ctx_paths: list[Path]) -> dict[str, FileContext]:
         contexts: list[FileContext] = []
@@ -168,30 +254,117 @@ class FileContext:
 
                     contexts.append(FileContext(regex, ftype, SELinuxContext.from_string(ctx_str)))
 
-        # Contexts are processed from the last to the first
-        contexts.reverse()
-
-        # Construct NFA for each context regex
-        old_nfa = mata_parser.from_regex('')
-        for progress, ctx in enumerate(contexts):
-            nfa = mata_parser.from_regex(ctx.regex)
-            ctx.nfa = mata_nfa.intersection(nfa, mata_nfa.complement(old_nfa, _ascii_alphabet))
-            old_nfa = mata_nfa.union(old_nfa, nfa)
-            _rlogger.info(f'Reading file context {progress + 1} / {len(contexts)}.')
-        _logger.info('')
+        entry_keys, reused_entries = FileContext._resolve_precedence(contexts)
 
         # Now with the NFA constructed we can aggregate them with no ordering issues
         contexts_dict: dict[str, FileContext] = {}
-        repeated_ctx_count = 0
-        for progress, ctx in enumerate(contexts):
+        type_keys: dict[str, list[_EntryKey]] = {}
+        for progress, (ctx, entry_key) in enumerate(zip(contexts, entry_keys)):
             ctx_type = ctx.label.type
             if ctx_type not in contexts_dict:
                 contexts_dict[ctx_type] = ctx
+                type_keys[ctx_type] = [entry_key]
             else:
-                repeated_ctx = contexts_dict[ctx_type]
-                repeated_ctx.add_regex(ctx)
-                repeated_ctx.nfa = mata_nfa.union(repeated_ctx.nfa, ctx.nfa)
-                repeated_ctx_count += 1
+                contexts_dict[ctx_type].add_regex(ctx)
+                type_keys[ctx_type].append(entry_key)
             _rlogger.info(f'Aggregating file context {progress + 1} / {len(contexts)}')
+
+        reused_types = 0
+        for ctx_type, ctx in contexts_dict.items():
+            type_key = tuple(type_keys[ctx_type])
+            if len(type_key) == 1:
+                continue  # Already the shared entry NFA
+            if type_key in _type_nfas:
+                reused_types += 1
+            else:
+                # The first union copies, so that the shared entry NFAs are never modified
+                nfa = mata_nfa.union(_shadowed_nfas[type_key[0]], _shadowed_nfas[type_key[1]])
+                for entry_key in type_key[2:]:
+                    nfa.union(_shadowed_nfas[entry_key])
+                _type_nfas[type_key] = nfa
+            ctx.nfa = _type_nfas[type_key]
+
+        for ctx_type, ctx in contexts_dict.items():
+            ctx._entry_keys = type_keys[ctx_type]
+            _interned_contexts.add(ctx)
+        _last_entries.clear()
+        _last_entries.update(entry_keys)
+        _last_types.clear()
+        _last_types.update(tuple(keys) for keys in type_keys.values() if len(keys) > 1)
+
+        aggregated_types = sum(len(keys) > 1 for keys in type_keys.values())
         _logger.info(f'Read {len(contexts)} entries into {len(contexts_dict)} file contexts.')
+        _logger.info(
+            f'Reused {reused_entries} / {len(contexts)} entry NFAs and '
+            f'{reused_types} / {aggregated_types} aggregated type NFAs from previous loads.'
+        )
         return contexts_dict
+
+    @staticmethod
+    def trim_interned() -> None:
+        # Called wherever policies are released: only the NFAs of the last load and of the
+        # contexts still alive stay interned, so the tables are bounded by the loaded policies
+        entries = set(_last_entries)
+        types = set(_last_types)
+        live_nfas = set()
+        for ctx in _interned_contexts:
+            entries.update(ctx._entry_keys)
+            if len(ctx._entry_keys) > 1:
+                types.add(tuple(ctx._entry_keys))
+            live_nfas.add(id(ctx.nfa))
+
+        for key in _shadowed_nfas.keys() - entries:
+            del _shadowed_nfas[key]
+        for type_key in _type_nfas.keys() - types:
+            del _type_nfas[type_key]
+        for table_key in [key for key, nfa in _table_nfas.items() if id(nfa) not in live_nfas]:
+            del _table_nfas[table_key]
+
+    @staticmethod
+    def _resolve_precedence(contexts: list[FileContext]) -> tuple[list[_EntryKey], int]:
+        # Contexts are processed from the last to the first
+        contexts.reverse()
+
+        # Each entry is shadowed by the later ones (already processed), but only those whose
+        # literal prefix overlaps can share a path: the others are left out of the complement.
+        # The result only depends on the entry and those regexes, so it is shared process-wide
+        processed: PrefixTrie[str] = PrefixTrie()
+        regex_nfas: dict[str, mata_nfa.Nfa] = {}
+        entry_keys: list[_EntryKey] = []
+        shadowing_count = 0
+        reused_entries = 0
+
+        def regex_nfa(regex: str) -> mata_nfa.Nfa:
+            if regex not in regex_nfas:
+                regex_nfas[regex] = mata_parser.from_regex(regex)
+            return regex_nfas[regex]
+
+        for progress, ctx in enumerate(contexts):
+            regex = ctx.regex
+            prefix = literal_prefix(regex)
+            entry_key = (regex, frozenset(processed.overlapping(prefix)))
+            shadowing_count += len(entry_key[1])
+
+            if entry_key in _shadowed_nfas:
+                reused_entries += 1
+            else:
+                # In-place union avoids copying the accumulated automaton at every step
+                old_nfa = mata_parser.from_regex('')
+                for shadowing_regex in entry_key[1]:
+                    old_nfa.union(regex_nfa(shadowing_regex))
+
+                # Trimming drops the useless states left by the complement product
+                _shadowed_nfas[entry_key] = mata_nfa.intersection(
+                    regex_nfa(regex), mata_nfa.complement(old_nfa, _ascii_alphabet)
+                ).trim()
+
+            ctx.nfa = _shadowed_nfas[entry_key]
+            entry_keys.append(entry_key)
+            processed.insert(prefix, regex)
+            _rlogger.info(f'Reading file context {progress + 1} / {len(contexts)}.')
+        _logger.info('')
+        _logger.debug(
+            f'Shadowed {len(contexts)} entries against {shadowing_count} overlapping entries '
+            f'(instead of {len(contexts) * (len(contexts) - 1) // 2}).'
+        )
+        return entry_keys, reused_entries
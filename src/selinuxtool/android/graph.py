@@ -1,11 +1,20 @@
+from __future__ import annotations
+
 import logging
+import sys
 import time
+from array import array
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
 
 import networkx as nx
 from libmata import alphabets as mata_alph
 from libmata.nfa import nfa as mata_nfa
 
+from selinuxtool.android.csr import CSRAdjacency, TransitiveClosure
 from selinuxtool.android.policy import Policy, SecurityLvl
+from selinuxtool.android.prefix import PrefixTrie
+from selinuxtool.util.common import NfaTable, nfa_from_table, nfa_to_table
 
 _logger = logging.getLogger('SELinuxTool')
 _rlogger = logging.getLogger('SELinuxTool:r')
@@ -14,94 +23,400 @@ _rlogger = logging.getLogger('SELinuxTool:r')
 _ascii = {chr(i): i for i in range(32, 127)}
 _ascii_alphabet = mata_alph.OnTheFlyAlphabet.from_symbol_map(_ascii)
 
+DIRECTIONS = ('left', 'right')
+
+# How ito/ifrom are answered: a fresh search per query, unions of precomputed closure rows,
+# or the closure only on graphs large enough to amortise it (see util/bench.py)
+REACHABILITY_MODES = ('auto', 'search', 'closure')
+_CLOSURE_MIN_EDGES = 10_000
+
+# Node sets are int bitmasks over node ids, converted to and from one byte per node
+_FLAG_BITS = bytes.maketrans(b'\x00\x01', b'01')
+
+
+def _flags_to_mask(flags: bytearray) -> int:
+    return int(flags[::-1].translate(_FLAG_BITS) or b'0', 2)
+
+
+def _prefix_index(prefixes: list[set[str]]) -> PrefixTrie[int]:
+    # Paths of two contexts can only overlap if one literal prefix extends the other
+    return PrefixTrie(
+        (prefix, pos) for pos, label_prefixes in enumerate(prefixes) for prefix in label_prefixes
+    )
+
+
+# Emptiness of label intersections, keyed by the (sorted) ids of the two NFAs: kept across the
+# products of consecutive releases, whose interned NFAs are mostly the same objects
+_PairKey = tuple[int, int]
+
+
+def _pair_key(left_key: int, right_key: int) -> _PairKey:
+    return (left_key, right_key) if left_key <= right_key else (right_key, left_key)
+
+
+def _product_pairs(
+    left: list[tuple[int, set[str], mata_nfa.Nfa, int]],
+    right_nfas: list[mata_nfa.Nfa],
+    right_keys: list[int],
+    right_index: PrefixTrie[int],
+    known: dict[_PairKey, bool],
+    progress: bool = False,
+) -> tuple[list[tuple[int, int]], dict[_PairKey, bool], int]:
+    # Left items are (position, prefixes, NFA, NFA key); returns the overlapping pairs, the
+    # emptiness of the intersections checked (not in known) and the number of shared NFAs
+    pairs: list[tuple[int, int]] = []
+    checked: dict[_PairKey, bool] = {}
+    shared_pairs = 0
+    for count, (left_pos, left_prefixes, left_nfa, left_key) in enumerate(left):
+        if progress:
+            _rlogger.info(f'Constructing InfoFlowGraph... {count + 1} / {len(left)}')
+        if left_nfa.is_lang_empty():
+            continue
+
+        candidates: set[int] = set()
+        for prefix in left_prefixes:
+            candidates.update(right_index.overlapping(prefix))
+
+        for right_pos in sorted(candidates):
+            # Interned NFAs (see file_contexts) shared by both policies trivially overlap
+            if left_nfa is right_nfas[right_pos]:
+                shared_pairs += 1
+                pairs.append((left_pos, right_pos))
+                continue
+
+            key = _pair_key(left_key, right_keys[right_pos])
+            if key in known:
+                is_empty = known[key]
+            elif key in checked:
+                is_empty = checked[key]
+            else:
+                lr_fc_inter = mata_nfa.intersection(left_nfa, right_nfas[right_pos])
+                is_empty = checked[key] = lr_fc_inter.is_lang_empty()
+            if not is_empty:
+                pairs.append((left_pos, right_pos))
+    return pairs, checked, shared_pairs
+
+
+# Right side of the product and its NFAs by parent object id, rebuilt once by each worker, so
+# that NFAs shared by both policies are sent once and stay the same object
+_worker_right: tuple[list[mata_nfa.Nfa], list[int], PrefixTrie[int]]
+_worker_nfas: dict[int, mata_nfa.Nfa]
+_worker_known: dict[_PairKey, bool]
+
+
+def _init_product_worker(
+    right_prefixes: list[set[str]],
+    right_ids: list[int],
+    right_tables: dict[int, NfaTable],
+    known: dict[_PairKey, bool],
+) -> None:
+    global _worker_right, _worker_nfas, _worker_known
+    _worker_nfas = {nfa_id: nfa_from_table(table) for nfa_id, table in right_tables.items()}
+    _worker_right = (
+        [_worker_nfas[nfa_id] for nfa_id in right_ids],
+        right_ids,
+        _prefix_index(right_prefixes),
+    )
+    _worker_known = known
+
+
+def _product_shard(
+    left: list[tuple[int, set[str], int, NfaTable | None]],
+) -> tuple[list[tuple[int, int]], dict[_PairKey, bool], int, float]:
+    # NFA keys are the ids in the parent process, so that the results can be shared there
+    init_time = time.time()
+    left_nfas = [
+        (pos, prefixes, _worker_nfas[nfa_id] if table is None else nfa_from_table(table), nfa_id)
+        for pos, prefixes, nfa_id, table in left
+    ]
+    pairs, checked, shared_pairs = _product_pairs(left_nfas, *_worker_right, _worker_known)
+    return pairs, checked, shared_pairs, time.time() - init_time
+
+
+def _product_parallel(
+    left: list[tuple[int, set[str], mata_nfa.Nfa, int]],
+    right_prefixes: list[set[str]],
+    right_nfas: list[mata_nfa.Nfa],
+    known: dict[_PairKey, bool],
+    jobs: int,
+) -> tuple[list[tuple[int, int]], dict[_PairKey, bool], int]:
+    # Round-robin shards balance the load, sorting the pairs restores the serial order
+    shards = [left[shard::jobs] for shard in range(jobs)]
+    right_tables = {id(nfa): nfa_to_table(nfa) for nfa in right_nfas}
+    pairs: list[tuple[int, int]] = []
+    checked: dict[_PairKey, bool] = {}
+    shared_pairs = 0
+    with ProcessPoolExecutor(
+        jobs,
+        initializer=_init_product_worker,
+        initargs=(right_prefixes, [id(nfa) for nfa in right_nfas], right_tables, known),
+    ) as pool:
+        futures = [
+            pool.submit(
+                _product_shard,
+                [
+                    (pos, prefixes, id(nfa), None if id(nfa) in right_tables else nfa_to_table(nfa))
+                    for pos, prefixes, nfa, _ in shard
+                ],
+            )
+            for shard in shards
+        ]
+        for shard, future in enumerate(futures):
+            shard_pairs, shard_checked, shard_shared, shard_time = future.result()
+            _logger.info(
+                f'Built InfoFlowGraph shard {shard + 1} / {jobs} ({len(shards[shard])} labels, '
+                f'{len(shard_checked)} pairs) in {shard_time:.4f}.'
+            )
+            pairs += shard_pairs
+            checked.update(shard_checked)
+            shared_pairs += shard_shared
+    pairs.sort()
+    return pairs, checked, shared_pairs
+
+
+class _PolicySide:
+    # What the product needs of one policy, independent of the other: shared by the products of
+    # consecutive releases, where a policy is first the right then the left side
+    def __init__(self, policy: Policy) -> None:
+        simple_graph = policy.simple_graph
+        file_contexts = policy.file_contexts
+        self.labels: list[str] = list(simple_graph.nodes)
+        positions = {label: pos for pos, label in enumerate(self.labels)}
+        self.prefixes = [file_contexts[label].prefixes for label in self.labels]
+        self.nfas = [file_contexts[label].nfa for label in self.labels]
+        self.sources = array('i', (positions[source] for source, _ in simple_graph.edges))
+        self.targets = array('i', (positions[target] for _, target in simple_graph.edges))
+        self._index: PrefixTrie[int] | None = None
+
+    @property
+    def index(self) -> PrefixTrie[int]:
+        if self._index is None:
+            self._index = _prefix_index(self.prefixes)
+        return self._index
+
+    def lift(self, groups: list[array]) -> tuple[array, array]:
+        # Each edge is lifted to all the product nodes sharing its endpoints (groups of node ids
+        # by label position)
+        sources = array('i')
+        targets = array('i')
+        for label_1, label_2 in zip(self.sources, self.targets):
+            group_1 = groups[label_1]
+            group_2 = groups[label_2]
+            if group_1 and group_2:
+                for source in group_1:
+                    sources.extend([source] * len(group_2))
+                    targets.extend(group_2)
+        return sources, targets
+
 
 class InfoFlowGraph:
-    def __init__(self, left: Policy, right: Policy) -> None:
+    def __init__(self, left: Policy, right: Policy, reachability: str = 'auto') -> None:
+        if reachability not in REACHABILITY_MODES:
+            raise ValueError(f'Invalid reachability mode {reachability}.')
         self._left = left
         self._right = right
-        self._graph = nx.MultiDiGraph()  # TODO: this should prolly build the graph
+        self._reachability = reachability
+
+        # Product nodes are interned to integer ids, edges are stored per direction in CSR form
+        self._nodes: list[tuple[str, str]] = []
+        self._node_ids: dict[tuple[str, str], int] = {}
+        self._successors: dict[str, CSRAdjacency] = {}
+        self._predecessors: dict[str, CSRAdjacency] = {}
+        self._label_masks: tuple[dict[str, int], dict[str, int]] | None = None
+        self._level_masks: dict[tuple[int, SecurityLvl | str], int] = {}
+        self._closures: dict[tuple[str, str], TransitiveClosure] = {}
+        self._left_side: _PolicySide | None = None
+        self._right_side: _PolicySide | None = None
+        self._emptiness: dict[_PairKey, bool] = {}
+        self._emptiness_nfas: dict[int, mata_nfa.Nfa] = {}
+        self._delta_region: tuple[int, int] | None = None
 
     @property
     def graph(self) -> nx.MultiDiGraph:
-        return self._graph
+        # Materialised on demand, the analyses only use the CSR adjacencies
+        graph = nx.MultiDiGraph()
+        graph.add_nodes_from(self._nodes)
+        for direction in DIRECTIONS:
+            graph.add_edges_from(
+                (self._nodes[source], self._nodes[target], {'direction': direction})
+                for source, target in self._successors[direction].edges()
+            )
+        return graph
+
+    @property
+    def nodes(self) -> list[tuple[str, str]]:
+        return self._nodes
 
     @property
     def labels(self) -> set[tuple[str, str]]:
-        return set(self._graph.nodes)
+        return set(self._nodes)
+
+    @property
+    def num_edges(self) -> int:
+        return sum(adjacency.num_edges for adjacency in self._successors.values())
+
+    @property
+    def nbytes(self) -> int:
+        adjacencies = [*self._successors.values(), *self._predecessors.values()]
+        return sum(adjacency.nbytes for adjacency in adjacencies)
+
+    @property
+    def cache_nbytes(self) -> int:
+        # What the queries build on demand: closures, node masks and the delta region
+        masks = [*self._level_masks.values(), *(self._delta_region or ())]
+        for side_masks in self._label_masks or ():
+            masks += side_masks.values()
+        closures = sum(closure.nbytes for closure in self._closures.values())
+        return closures + sum(sys.getsizeof(mask) for mask in masks)
 
     @property
     def graph_debug_str(self) -> str:
-        return f'[N {len(self._graph.nodes())}] [E {len(self._graph.edges())}]'
+        return f'[N {len(self._nodes)}] [E {self.num_edges}]'
 
-    def build_graph(self) -> None:
+    @property
+    def all_mask(self) -> int:
+        return (1 << len(self._nodes)) - 1
+
+    def node_id(self, node: tuple[str, str]) -> int:
+        return self._node_ids[node]
+
+    def mask_of(self, nodes: Iterable[tuple[str, str]]) -> int:
+        flags = bytearray(len(self._nodes))
+        for node in nodes:
+            flags[self._node_ids[node]] = 1
+        return _flags_to_mask(flags)
+
+    def ids_of(self, mask: int) -> list[int]:
+        return [node_id for node_id, bit in enumerate(bin(mask)[:1:-1]) if bit == '1']
+
+    def nodes_of(self, mask: int) -> set[tuple[str, str]]:
+        return {self._nodes[node_id] for node_id in self.ids_of(mask)}
+
+    def successors(self, node: int, direction: str) -> array:
+        return self._successors[direction].neighbours(node)
+
+    def predecessors(self, node: int, direction: str) -> array:
+        return self._predecessors[direction].neighbours(node)
+
+    def load_networkx(self, graph: nx.MultiDiGraph) -> None:
+        nodes = list(graph.nodes)
+        node_ids = {node: node_id for node_id, node in enumerate(nodes)}
+        edges = {direction: (array('i'), array('i')) for direction in DIRECTIONS}
+        for source, target, direction in graph.edges(data='direction'):
+            edges[direction][0].append(node_ids[source])
+            edges[direction][1].append(node_ids[target])
+        self._store(nodes, edges)
+
+    def _store(self, nodes: list[tuple[str, str]], edges: dict[str, tuple[array, array]]) -> None:
+        self._nodes = nodes
+        self._node_ids = {node: node_id for node_id, node in enumerate(nodes)}
+        self._label_masks = None
+        self._level_masks = {}
+        self._closures = {}
+        self._delta_region = None
+        for direction, (sources, targets) in edges.items():
+            self._successors[direction] = CSRAdjacency.from_edges(len(nodes), sources, targets)
+            self._predecessors[direction] = CSRAdjacency.from_edges(len(nodes), targets, sources)
+
+    def build_graph(self, jobs: int = 1) -> None:
         init_time = time.time()
+        if self._left_side is None:
+            self._left_side = _PolicySide(self._left)
+        if self._right_side is None:
+            self._right_side = _PolicySide(self._right)
+        left_side = self._left_side
+        right_side = self._right_side
+
+        left = [
+            (pos, prefixes, nfa, id(nfa))
+            for pos, (prefixes, nfa) in enumerate(zip(left_side.prefixes, left_side.nfas))
+        ]
+        jobs = min(jobs, len(left))
+        if jobs > 1:
+            pairs, checked, shared_pairs = _product_parallel(
+                left, right_side.prefixes, right_side.nfas, self._emptiness, jobs
+            )
+        else:
+            pairs, checked, shared_pairs = _product_pairs(
+                left,
+                right_side.nfas,
+                [id(nfa) for nfa in right_side.nfas],
+                right_side.index,
+                self._emptiness,
+                progress=True,
+            )
+        known_pairs = len(self._emptiness)
+        self._remember(checked, [*left_side.nfas, *right_side.nfas])
+
+        left_labels = left_side.labels
+        right_labels = right_side.labels
+        nodes = [(left_labels[left_pos], right_labels[right_pos]) for left_pos, right_pos in pairs]
+        _logger.debug(
+            f'Checked {len(checked)} / {len(left_labels) * len(right_labels)} label pairs '
+            f'({shared_pairs} more with shared NFAs, {known_pairs} known from the previous '
+            f'product).'
+        )
 
-        left_g = self._left.simple_graph
-        right_g = self._right.simple_graph
-
-        for progress, data in enumerate(left_g.nodes.items()):
-            _rlogger.info(f'Constructing InfoFlowGraph... {progress + 1} / {len(left_g.nodes)}')
-            left_label, _ = data
-            left_label_fc = self._left.file_contexts[left_label].nfa
-            for right_label, _ in right_g.nodes.items():
-                right_label_fc = self._right.file_contexts[right_label].nfa
-                lr_fc_inter = mata_nfa.intersection(left_label_fc, right_label_fc)
-
-                if not lr_fc_inter.is_lang_empty():
-                    self._graph.add_node((left_label, right_label))
-                #     if left_label != right_label:
-                #         _logger.debug(f'L ({left_label}) - R ({right_label}) [NOT EQUAL]')
-                # elif left_label == right_label:
-                #     _logger.debug(f'L ({left_label}) - R ({right_label}) [EMPTY INTER]')
-
-        for left_label_1, right_label_1 in self._graph.nodes:
-            for left_label_2, right_label_2 in self._graph.nodes:
-                if left_g.has_edge(left_label_1, left_label_2):
-                    self._graph.add_edge(
-                        (left_label_1, right_label_1),
-                        (left_label_2, right_label_2),
-                        direction='left',
-                    )
-                if right_g.has_edge(right_label_1, right_label_2):
-                    self._graph.add_edge(
-                        (left_label_1, right_label_1),
-                        (left_label_2, right_label_2),
-                        direction='right',
-                    )
+        left_groups = [array('i') for _ in left_labels]
+        right_groups = [array('i') for _ in right_labels]
+        for node_id, (left_pos, right_pos) in enumerate(pairs):
+            left_groups[left_pos].append(node_id)
+            right_groups[right_pos].append(node_id)
+        edges = {'left': left_side.lift(left_groups), 'right': right_side.lift(right_groups)}
+
+        self._store(nodes, edges)
         self._built_time = time.time() - init_time
         _logger.info(f'Built InfoFlowGraph {self.graph_debug_str} in {self._built_time}.')
 
-    def has_path(self, source: str, target: str, kind: int = 0) -> bool:
+    def _remember(self, checked: dict[_PairKey, bool], nfas: list[mata_nfa.Nfa]) -> None:
+        # The NFAs are referenced along with the results, so that their ids are never reused
+        self._emptiness.update(checked)
+        for nfa in nfas:
+            self._emptiness_nfas[id(nfa)] = nfa
+
+    def successor(self, policy: Policy, jobs: int = 1) -> InfoFlowGraph:
+        # Product of the right policy and the next one: the right side is reused as the left one,
+        # and so are the intersections already checked between NFAs of the right policy and
+        # NFAs the next one still shares, only those with its new NFAs are computed
+        if self._right_side is None:
+            raise ValueError('The InfoFlowGraph was not built.')
+        graph = InfoFlowGraph(self._right, policy, self._reachability)
+        graph._left_side = self._right_side
+
+        right_keys = {id(nfa) for nfa in self._right_side.nfas}
+        next_keys = {id(ctx.nfa) for ctx in policy.file_contexts.values()}
+        graph._emptiness = {
+            key: is_empty
+            for key, is_empty in self._emptiness.items()
+            if (key[0] in right_keys and key[1] in next_keys)
+            or (key[1] in right_keys and key[0] in next_keys)
+        }
+        graph._emptiness_nfas = {
+            nfa_id: self._emptiness_nfas[nfa_id] for key in graph._emptiness for nfa_id in key
+        }
+        graph.build_graph(jobs)
+        return graph
+
+    def release(self) -> None:
+        # Keeps only what successor() needs, so that the left policy and the product can be freed
+        # before the next policy is loaded
+        del self._left
+        self._left_side = None
+        self._store([], {direction: (array('i'), array('i')) for direction in DIRECTIONS})
+
+    def has_path(self, source: tuple[str, str], target: tuple[str, str], kind: int = 0) -> bool:
         # kind 0 = left, kind 1 = right
-        def left_weighted(source: tuple, target: tuple, edge_attrs: dict) -> int:
-            if any(edge['direction'] == 'left' for _, edge in edge_attrs.items()):
-                return 0
-            return 1
-
-        try:
-            nx.shortest_path(self._graph, source, target, weight=left_weighted)
-        except nx.NetworkXNoPath:
-            return False
-
-        return nx.shortest_path_length(self._graph, source, target, weight=left_weighted) == 0
-
-    def security_lvs_diff(self) -> None:
-        untrusted_right_in_left = [
-            (x, y)
-            for (x, y) in self._graph.nodes()
-            if SecurityLvl.UNTRUSTED in self._right._graph.nodes[y]['security_level']
-        ]
-
-        critical_right_in_left = [
-            (x, y)
-            for (x, y) in self._graph.nodes()
-            if SecurityLvl.CRITICAL in self._right._graph.nodes[y]['security_level']
-        ]
-
-        initial_right_in_left = set()
-        for source in untrusted_right_in_left:
-            if any(self.has_path(source, target) for target in critical_right_in_left):
-                initial_right_in_left.add(source)
+        if source == target:
+            return True
+        reached = self.eventually_reachable_mask(1 << self.node_id(source), DIRECTIONS[kind], 'out')
+        return bool(reached >> self.node_id(target) & 1)
+
+    def security_lvs_diff(self) -> mata_nfa.Nfa:
+        # Untrusted (right) nodes with a left path to a critical (right) one: a single backward
+        # search from all the critical nodes at once, paths being reflexive as in has_path
+        critical = self.label_mask(2, SecurityLvl.CRITICAL)
+        reaching = critical | self.eventually_reachable_mask(critical, 'left', type='in')
+        initial_right_in_left = self.nodes_of(self.label_mask(2, SecurityLvl.UNTRUSTED) & reaching)
 
         init_fc_left = mata_nfa.Nfa()  # empty lang
         fc_untrust_right = mata_nfa.Nfa()
@@ -122,30 +437,148 @@ class InfoFlowGraph:
         )
         return minimal_nfa
 
-    def eventually_reachable(
-        self, nodes: set[tuple[str, str]], direction: str = 'left', type: str = 'in'
-    ) -> set[tuple[str, str]]:
-        # Set function to use based on the given type.
+    def label_mask(self, index: int, label: SecurityLvl | str) -> int:
+        # Product nodes whose label in policy #index is (or has the security level) label
+        if (index, label) not in self._level_masks:
+            if self._label_masks is None:
+                self._label_masks = ({}, {})
+                for node_id, node in enumerate(self._nodes):
+                    for side, masks in enumerate(self._label_masks):
+                        masks[node[side]] = masks.get(node[side], 0) | (1 << node_id)
+
+            masks = self._label_masks[index - 1]
+            if isinstance(label, SecurityLvl):
+                policy = self._left if index == 1 else self._right
+                labels: Iterable[str] = policy.security_labels(label) & masks.keys()
+            else:
+                labels = [label] if label in masks else []
+
+            mask = 0
+            for type_label in labels:
+                mask |= masks[type_label]
+            self._level_masks[index, label] = mask
+        return self._level_masks[index, label]
+
+    @property
+    def uses_closure(self) -> bool:
+        if self._reachability == 'auto':
+            return self.num_edges >= _CLOSURE_MIN_EDGES
+        return self._reachability == 'closure'
+
+    def closure(self, direction: str, type: str) -> TransitiveClosure:
+        # ito (in) unions the rows of the reversed direction, ifrom (out) of the forward one
+        if (direction, type) not in self._closures:
+            init_time = time.time()
+            adjacency = (self._predecessors if type == 'in' else self._successors)[direction]
+            closure = TransitiveClosure(adjacency)
+            self._closures[direction, type] = closure
+            _logger.debug(
+                f'Built {direction}/{type} closure ({len(closure)} components) '
+                f'in {time.time() - init_time}.'
+            )
+        return self._closures[direction, type]
+
+    def eventually_reachable_mask(
+        self, mask: int, direction: str = 'left', type: str = 'in'
+    ) -> int:
+        # Set adjacency to use based on the given type.
         if type == 'in':
-            in_out_edges = self._graph.in_edges
+            adjacency = self._predecessors[direction]
         elif type == 'out':
-            in_out_edges = self._graph.out_edges
+            adjacency = self._successors[direction]
         else:
             raise ValueError('Invalid type (only in/out).')
 
-        reachable_nodes = set()
-        nodes_to_process = list(nodes)
+        sources = self.ids_of(mask)
+        if self.uses_closure:
+            return self.closure(direction, type).reachable(sources)
 
-        while nodes_to_process:
-            for source, target, edge in in_out_edges(nodes_to_process.pop(), data=True):
-                candidate = source if type == 'in' else target
+        is_source = bytearray(len(self._nodes))
+        for source in sources:
+            is_source[source] = 1
+        reachable = bytearray(len(self._nodes))
+        nodes_to_process = sources
 
-                if edge['direction'] == direction and candidate not in reachable_nodes:
-                    reachable_nodes.add(candidate)
-                    if candidate not in nodes:
+        while nodes_to_process:
+            for candidate in adjacency.neighbours(nodes_to_process.pop()):
+                if not reachable[candidate]:
+                    reachable[candidate] = 1
+                    if not is_source[candidate]:
                         nodes_to_process.append(candidate)
 
-        return reachable_nodes
+        return _flags_to_mask(reachable)
+
+    def delta_mask(self) -> int:
+        # Nodes whose left and right successors differ
+        return self._delta()[0]
+
+    def delta_region_mask(self) -> int:
+        # Nodes connected to the delta by edges of either direction, either way: elsewhere left
+        # and right edges coincide, so a formula and its index-swapped version agree there
+        return self._delta()[1]
+
+    def _delta(self) -> tuple[int, int]:
+        if self._delta_region is None:
+            init_time = time.time()
+            left = self._successors['left']
+            right = self._successors['right']
+            region = bytearray(len(self._nodes))
+            delta = []
+            for node_id in range(len(self._nodes)):
+                if sorted(left.neighbours(node_id)) != sorted(right.neighbours(node_id)):
+                    region[node_id] = 1
+                    delta.append(node_id)
+            delta_mask = _flags_to_mask(region)
+
+            adjacencies = [*self._successors.values(), *self._predecessors.values()]
+            nodes_to_process = list(delta)
+            while nodes_to_process:
+                node_id = nodes_to_process.pop()
+                for adjacency in adjacencies:
+                    for candidate in adjacency.neighbours(node_id):
+                        if not region[candidate]:
+                            region[candidate] = 1
+                            nodes_to_process.append(candidate)
+
+            self._delta_region = (delta_mask, _flags_to_mask(region))
+            _logger.debug(
+                f'Found {len(delta)} nodes with different left/right edges, affecting '
+                f'{region.count(1)} / {len(self._nodes)} nodes in {time.time() - init_time}.'
+            )
+        return self._delta_region
+
+    def witness_path(
+        self, node: tuple[str, str], targets: int, direction: str = 'left', type: str = 'in'
+    ) -> list[tuple[str, str]] | None:
+        # A shortest path explaining why node is in eventually_reachable_mask(targets, ...):
+        # from node to a target for type in, from a target to node for type out
+        adjacency = (self._successors if type == 'in' else self._predecessors)[direction]
+        node_id = self.node_id(node)
+        parent = array('i', [-1]) * len(self._nodes)
+        frontier = [node_id]
+        while frontier:
+            next_frontier = []
+            for current in frontier:
+                for candidate in adjacency.neighbours(current):
+                    if parent[candidate] != -1:
+                        continue
+                    parent[candidate] = current
+                    if targets >> candidate & 1:
+                        path = [candidate]
+                        while path[-1] != node_id or len(path) == 1:
+                            path.append(parent[path[-1]])
+                        if type == 'in':
+                            path.reverse()
+                        return [self._nodes[path_id] for path_id in path]
+                    next_frontier.append(candidate)
+            frontier = next_frontier
+        return None
+
+    def eventually_reachable(
+        self, nodes: set[tuple[str, str]], direction: str = 'left', type: str = 'in'
+    ) -> set[tuple[str, str]]:
+        mask = self.eventually_reachable_mask(self.mask_of(nodes), direction, type)
+        return self.nodes_of(mask)
 
     def eventually_reach(
         self, nodes: set[tuple[str, str]], direction: str = 'left'
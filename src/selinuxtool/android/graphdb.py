@@ -0,0 +1,227 @@
+from __future__ import annotations
+
+import logging
+import mmap
+import struct
+import sys
+import time
+from array import array
+from pathlib import Path
+
+import networkx as nx
+
+from selinuxtool.android.label import EdgeType
+
+_logger = logging.getLogger('SELinuxTool')
+
+# Layout: header, then length-prefixed sections padded to 8 bytes
+#   labels (NUL separated), perms (NUL separated), node flags (one byte per node),
+#   type transitions (int32 node, source, file context triples),
+#   and for the policy and simple graphs: node ids, edge sources, targets, types,
+#   perm offsets (one per edge + 1) and perm ids, all int32
+GRAPH_DB_VERSION = 1
+_MAGIC = b'SEGRAPH\0'
+_HEADER = struct.Struct('<8sIc32s')
+_LENGTH = struct.Struct('<Q')
+_BYTEORDER = b'<' if sys.byteorder == 'little' else b'>'
+_IS_OBJECT = 1
+_IS_SUBJECT = 2
+
+
+def _padding(length: int) -> bytes:
+    return bytes(-length % 8)
+
+
+class _SectionReader:
+    # Sections are exposed as zero-copy views of the mapped file, released all at once
+    def __init__(self, view: memoryview) -> None:
+        self._view = view
+        self._offset = _HEADER.size
+        self._views: list[memoryview] = []
+
+    def bytes(self) -> memoryview:
+        (length,) = _LENGTH.unpack_from(self._view, self._offset)
+        start = self._offset + _LENGTH.size
+        if start + length > len(self._view):
+            raise ValueError('section past the end of the db')
+        self._offset = start + length + (-length % 8)
+        section = self._view[start : start + length]
+        self._views.append(section)
+        return section
+
+    def strings(self) -> list[str]:
+        section = self.bytes()
+        return bytes(section).decode().split('\0') if len(section) else []
+
+    def ints(self) -> memoryview:
+        section = self.bytes().cast('i')
+        self._views.append(section)
+        return section
+
+    def release(self) -> None:
+        for section in reversed(self._views):
+            section.release()
+
+
+def _graph_sections(
+    graph: nx.DiGraph, ids: dict[str, int], perm_ids: dict[str, int]
+) -> list[bytes]:
+    nodes = array('i', (ids[node] for node in graph))
+    sources = array('i')
+    targets = array('i')
+    types = array('i')
+    perm_offsets = array('i', [0])
+    edge_perms = array('i')
+    for source, target, data in graph.edges(data=True):
+        sources.append(ids[source])
+        targets.append(ids[target])
+        types.append(data['type'].value)
+        edge_perms.extend(sorted(perm_ids[perm] for perm in data.get('perms', ())))
+        perm_offsets.append(len(edge_perms))
+    return [section.tobytes() for section in (nodes, sources, targets, types)] + [
+        perm_offsets.tobytes(),
+        edge_perms.tobytes(),
+    ]
+
+
+def dump_graphs(checksum: bytes, graph: nx.DiGraph, simple_graph: nx.DiGraph) -> bytes:
+    labels = list(graph)
+    ids = {label: node_id for node_id, label in enumerate(labels)}
+    transitions = array('i')
+    for node, node_transitions in graph.nodes(data='transitions'):
+        for source, fc_label in node_transitions or ():
+            for label in (source, fc_label):
+                if label not in ids:
+                    ids[label] = len(labels)
+                    labels.append(label)
+            transitions.extend((ids[node], ids[source], ids[fc_label]))
+
+    perms = sorted(
+        {perm for _, _, edge_perms in graph.edges(data='perms') for perm in edge_perms or ()}
+    )
+    perm_ids = {perm: perm_id for perm_id, perm in enumerate(perms)}
+    flags = bytes(
+        _IS_OBJECT * bool(data.get('is_object')) | _IS_SUBJECT * bool(data.get('is_subject'))
+        for _, data in graph.nodes(data=True)
+    )
+
+    sections = [
+        '\0'.join(labels).encode(),
+        '\0'.join(perms).encode(),
+        flags,
+        transitions.tobytes(),
+        *_graph_sections(graph, ids, perm_ids),
+        *_graph_sections(simple_graph, ids, perm_ids),
+    ]
+
+    chunks = [_HEADER.pack(_MAGIC, GRAPH_DB_VERSION, _BYTEORDER, checksum)]
+    for section in sections:
+        chunks += [_LENGTH.pack(len(section)), section, _padding(len(section))]
+    return b''.join(chunks)
+
+
+def save_graphs(
+    db_path: Path, checksum: bytes, graph: nx.DiGraph, simple_graph: nx.DiGraph
+) -> None:
+    init_time = time.time()
+    with open(db_path, 'wb') as db:
+        db.write(dump_graphs(checksum, graph, simple_graph))
+    _logger.info(
+        f'Saved graphs to db ({db_path.parent.name}/{db_path.name}, '
+        f'{db_path.stat().st_size / 2**20:.2f} MiB) in {time.time() - init_time:.4f}.'
+    )
+
+
+def _read_graph(
+    reader: _SectionReader, labels: list[str], perms: list[str], node_data: list[dict]
+) -> nx.DiGraph:
+    nodes, sources, targets, types = reader.ints(), reader.ints(), reader.ints(), reader.ints()
+    perm_offsets, edge_perms = reader.ints(), reader.ints()
+
+    graph = nx.DiGraph()
+    graph.add_nodes_from((labels[node], node_data[node]) for node in nodes)
+
+    # networkx needs Python objects anyway, so the views are converted in bulk
+    edge_types = {value: EdgeType(value) for value in set(types)}
+    offsets = perm_offsets.tolist()
+    perm_list = [perms[perm] for perm in edge_perms.tolist()]
+    addl = EdgeType.ADDL.value
+    edges: list[tuple[str, str, dict[str, EdgeType | set[str]]]] = []
+    for source, target, edge_type, start, end in zip(
+        sources.tolist(), targets.tolist(), types.tolist(), offsets, offsets[1:]
+    ):
+        data: dict[str, EdgeType | set[str]] = {'type': edge_types[edge_type]}
+        if edge_type != addl:
+            data['perms'] = set(perm_list[start:end])
+        edges.append((labels[source], labels[target], data))
+    graph.add_edges_from(edges)
+    return graph
+
+
+def parse_graphs(
+    buffer: bytes | mmap.mmap, checksum: bytes, source: str
+) -> tuple[nx.DiGraph, nx.DiGraph] | None:
+    # None if the buffer is of another version or was built from different inputs
+    if len(buffer) < _HEADER.size:
+        _logger.warning(f'Ignoring truncated graph db ({source}).')
+        return None
+
+    view = memoryview(buffer)
+    reader = _SectionReader(view)
+    try:
+        return _parse_sections(view, reader, checksum, source)
+    except (struct.error, IndexError, ValueError, TypeError) as e:
+        # Truncated or corrupt sections (bad lengths, ids, edge types or encodings)
+        _logger.warning(f'Ignoring corrupt graph db ({source}: {e}).')
+        return None
+    finally:
+        reader.release()
+        view.release()
+
+
+def _parse_sections(
+    view: memoryview, reader: _SectionReader, checksum: bytes, source: str
+) -> tuple[nx.DiGraph, nx.DiGraph] | None:
+    magic, version, byteorder, stored_checksum = _HEADER.unpack_from(view)
+    if magic != _MAGIC or version != GRAPH_DB_VERSION or byteorder != _BYTEORDER:
+        _logger.warning(f'Ignoring graph db with unsupported format ({source}).')
+        return None
+    if stored_checksum != checksum:
+        _logger.info(f'Ignoring stale graph db ({source}).')
+        return None
+
+    labels = reader.strings()
+    perms = reader.strings()
+    flags = reader.bytes()
+    node_data: list[dict] = [
+        {'is_object': bool(flag & _IS_OBJECT), 'is_subject': bool(flag & _IS_SUBJECT)}
+        for flag in flags
+    ]
+    transitions = reader.ints()
+    for pos in range(0, len(transitions), 3):
+        node, source_label, fc_label = transitions[pos : pos + 3]
+        node_data[node].setdefault('transitions', []).append(
+            (labels[source_label], labels[fc_label])
+        )
+
+    graph = _read_graph(reader, labels, perms, node_data)
+    # Node attributes are copied, as the simplified graph used to be a copy
+    simple_graph = _read_graph(reader, labels, perms, [dict(data) for data in node_data])
+    return graph, simple_graph
+
+
+def load_graphs(db_path: Path, checksum: bytes) -> tuple[nx.DiGraph, nx.DiGraph] | None:
+    # None if the db is missing, of another version or built from different inputs
+    if not db_path.exists() or db_path.stat().st_size == 0:
+        return None
+
+    init_time = time.time()
+    with open(db_path, 'rb') as db, mmap.mmap(db.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        graphs = parse_graphs(mapped, checksum, str(db_path))
+
+    if graphs is not None:
+        _logger.info(
+            f'Loaded graphs from db ({db_path.parent.name}/{db_path.name}) '
+            f'in {time.time() - init_time:.4f}.'
+        )
+    return graphs
@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import functools
+import json
+import re
+from collections.abc import Iterable
+from enum import Flag, auto
+from pathlib import Path
+
+DEFAULT_RULES_FILE = Path(__file__).parent.parent / 'security_rules.json'
+
+
+class SecurityLvl(Flag):
+    NONE = 0
+    UNTRUSTED = auto()
+    TRUSTED = auto()
+    CRITICAL = auto()
+
+
+SECURITY_LVS = (SecurityLvl.UNTRUSTED, SecurityLvl.TRUSTED, SecurityLvl.CRITICAL)
+
+
+class _Matcher:
+    # Keywords (substrings) and regexes combined into a single regex, plus exact type names
+    def __init__(self, spec: dict) -> None:
+        patterns = [re.escape(keyword) for keyword in spec.get('keywords', [])]
+        patterns += [f'(?:{regex})' for regex in spec.get('regexes', [])]
+        self._regex = re.compile('|'.join(patterns)) if patterns else None
+        self._types = frozenset(spec.get('types', []))
+
+    def __call__(self, type_name: str) -> bool:
+        if type_name in self._types:
+            return True
+        return self._regex is not None and self._regex.search(type_name) is not None
+
+
+class SecurityRules:
+    # Labelling rules, per level: keywords, regexes, explicit types and type attributes, minus
+    # the exclusions (keywords, regexes and types). Levels only depending on the type name are
+    # cached per name, so the same rules can label all the policies of a run
+    def __init__(self, rules: dict[str, dict]) -> None:
+        self._levels: list[tuple[SecurityLvl, _Matcher, _Matcher, frozenset[str]]] = []
+        for name, spec in rules.items():
+            try:
+                level = SecurityLvl[name]
+            except KeyError:
+                raise ValueError(f'Unknown security level {name}.') from None
+            if level not in SECURITY_LVS:
+                raise ValueError(f'Unknown security level {name}.')
+            attributes = frozenset(spec.get('attributes', []))
+            self._levels.append(
+                (level, _Matcher(spec), _Matcher(spec.get('exclude', {})), attributes)
+            )
+        self._cache: dict[str, tuple[SecurityLvl, SecurityLvl]] = {}
+
+    @staticmethod
+    def from_file(rules_file: str | Path) -> SecurityRules:
+        with open(rules_file) as file:
+            return SecurityRules(json.load(file))
+
+    @property
+    def attributes(self) -> frozenset[str]:
+        # Type attributes whose members have to be looked up in each policy
+        return frozenset().union(*(attributes for *_, attributes in self._levels))
+
+    def _name_levels(self, type_name: str) -> tuple[SecurityLvl, SecurityLvl]:
+        # Levels given and excluded by the type name alone
+        if type_name not in self._cache:
+            level = SecurityLvl.NONE
+            excluded = SecurityLvl.NONE
+            for single_level, include, exclude, _ in self._levels:
+                if include(type_name):
+                    level |= single_level
+                if exclude(type_name):
+                    excluded |= single_level
+            self._cache[type_name] = (level, excluded)
+        return self._cache[type_name]
+
+    def classify(
+        self, type_names: Iterable[str], members: dict[str, frozenset[str]] | None = None
+    ) -> dict[SecurityLvl, frozenset[str]]:
+        # Types of each level, members maps the attributes of the rules to their types
+        labels: dict[SecurityLvl, set[str]] = {level: set() for level in SECURITY_LVS}
+        attribute_levels: dict[str, SecurityLvl] = {}
+        for single_level, _, _, attributes in self._levels:
+            for attribute in attributes:
+                for type_name in (members or {}).get(attribute, ()):
+                    attribute_levels[type_name] = (
+                        attribute_levels.get(type_name, SecurityLvl.NONE) | single_level
+                    )
+
+        for type_name in type_names:
+            level, excluded = self._name_levels(type_name)
+            level = (level | attribute_levels.get(type_name, SecurityLvl.NONE)) & ~excluded
+            for single_level in SECURITY_LVS:
+                if single_level in level:
+                    labels[single_level].add(type_name)
+        return {level: frozenset(level_labels) for level, level_labels in labels.items()}
+
+
+@functools.cache
+def default_rules() -> SecurityRules:
+    return SecurityRules.from_file(DEFAULT_RULES_FILE)
@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from .cache import PolicyCache
+from .labelling import SecurityRules
+from .policy import Policy
+
+_logger = logging.getLogger('SELinuxTool')
+
+_LOGGER_NAMES = ('SELinuxTool', 'SELinuxTool:r', 'SELinuxTool:f', 'SELinuxTool:b')
+_PROGRESS_LOGGER = 'SELinuxTool:r'
+
+
+class _PolicyTag(logging.Filter):
+    # Records of a worker are tagged with the policy it is currently loading
+    def __init__(self) -> None:
+        super().__init__()
+        self.policy = ''
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.policy = self.policy
+        return True
+
+
+_tag = _PolicyTag()
+
+
+def _init_worker(queue: multiprocessing.Queue, levels: dict[str, int]) -> None:
+    # Workers forward all their records to the main process instead of writing them
+    handler = logging.handlers.QueueHandler(queue)
+    handler.addFilter(_tag)
+    for name in _LOGGER_NAMES:
+        logger = logging.getLogger(name)
+        logger.handlers = [handler]
+        logger.propagate = False
+        logger.setLevel(levels[name])
+
+
+def _load_policy(
+    path: Path,
+    load: bool,
+    save: bool,
+    count: int,
+    cache: PolicyCache | None,
+    permmapfile: str | Path | None,
+    rules: SecurityRules | None,
+) -> Policy:
+    _tag.policy = f'#{count + 1} {path.name}'
+    policy = Policy(path, permmapfile, rules)
+    policy.load_policy(load, save, count, cache)
+    return policy
+
+
+class _Dispatcher(logging.Handler):
+    # Re-emits the records of the workers through the loggers of the main process, merging the
+    # latest progress line of every policy into a single carriage-returned line
+    def __init__(self) -> None:
+        super().__init__()
+        self._progress: dict[str, str] = {}
+
+    def emit(self, record: logging.LogRecord) -> None:
+        policy = getattr(record, 'policy', '')
+        if record.name == _PROGRESS_LOGGER:
+            self._progress[policy] = record.getMessage()
+            record.msg = ' | '.join(f'[{tag}] {msg}' for tag, msg in self._progress.items())
+        else:
+            self._progress.pop(policy, None)
+            record.msg = f'[{policy}] {record.getMessage()}'
+        record.args = None
+        logging.getLogger(record.name).handle(record)
+
+
+def load_policies(
+    paths: list[Path],
+    load: bool,
+    save: bool,
+    cache: PolicyCache | None = None,
+    permmapfile: str | Path | None = None,
+    jobs: int | None = None,
+    rules: SecurityRules | None = None,
+) -> list[Policy]:
+    # Policies are loaded concurrently, one process each (up to jobs), and sent back in their
+    # compact form; the result is in the order of paths
+    jobs = min(len(paths), jobs or os.cpu_count() or 1)
+    init_time = time.time()
+    if jobs <= 1:
+        policies = [Policy(path, permmapfile, rules) for path in paths]
+        for count, policy in enumerate(policies):
+            policy.load_policy(load, save, count, cache)
+        return policies
+
+    queue: multiprocessing.Queue = multiprocessing.Queue()
+    levels = {name: logging.getLogger(name).level for name in _LOGGER_NAMES}
+    listener = logging.handlers.QueueListener(queue, _Dispatcher())
+    listener.start()
+    try:
+        with ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(queue, levels)) as pool:
+            futures = [
+                pool.submit(_load_policy, path, load, save, count, cache, permmapfile, rules)
+                for count, path in enumerate(paths)
+            ]
+            policies = [future.result() for future in futures]
+    finally:
+        listener.stop()
+
+    load_time = time.time() - init_time
+    serial_time = sum(policy.load_time for policy in policies)
+    _logger.info(
+        f'Loaded {len(policies)} policies with {jobs} processes in {load_time:.4f} '
+        f'({serial_time:.4f} if loaded one after the other).'
+    )
+    return policies
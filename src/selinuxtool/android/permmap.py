@@ -2,7 +2,7 @@ import logging
 from dataclasses import dataclass
 from pathlib import Path
 
-from setools.exception import UnmappedClass, UnmappedPermission
+from setools import SELinuxPolicy
 from setools.permmap import Mapping, PermissionMap
 from setools.policyrep import AVRule
 
@@ -23,11 +23,81 @@ class RuleInfoFlow:
 
 
 class AndroidPermissionMap(PermissionMap):
+    # Mappings are compiled into a (class, perm) -> (direction, weight) table, None if disabled
+    # and missing if unmapped, and rule results are memoised by class and permissions (policies
+    # repeat the same permission sets thousands of times); both are dropped by the mutators
     def __init__(self, permmapfile: str | Path | None = None) -> None:
+        self._table: dict[tuple[str, str], tuple[str, int] | None] | None = None
+        self._infoflows: dict[tuple[str, tuple[str, ...]], RuleInfoFlow] = {}
         super().__init__(permmapfile)
 
+    def _invalidate(self) -> None:
+        self._table = None
+        self._infoflows = {}
+
+    def load(self, permmapfile: str | Path | None) -> None:
+        super().load(permmapfile)
+        self._invalidate()
+
+    def map_policy(self, policy: SELinuxPolicy) -> None:
+        super().map_policy(policy)
+        self._invalidate()
+
+    def exclude_class(self, class_: str) -> None:
+        super().exclude_class(class_)
+        self._invalidate()
+
+    def exclude_permission(self, class_: str, permission: str) -> None:
+        super().exclude_permission(class_, permission)
+        self._invalidate()
+
+    def include_class(self, class_: str) -> None:
+        super().include_class(class_)
+        self._invalidate()
+
+    def include_permission(self, class_: str, permission: str) -> None:
+        super().include_permission(class_, permission)
+        self._invalidate()
+
+    def set_direction(self, class_: str, permission: str, direction: str) -> None:
+        super().set_direction(class_, permission, direction)
+        self._invalidate()
+
+    def set_weight(self, class_: str, permission: str, weight: int) -> None:
+        super().set_weight(class_, permission, weight)
+        self._invalidate()
+
+    def _compile(self) -> dict[tuple[str, str], tuple[str, int] | None]:
+        table: dict[tuple[str, str], tuple[str, int] | None] = {}
+        for class_name, perms in self._permmap.items():
+            for perm in perms:
+                mapping = Mapping(self._permmap, class_name, perm)
+                table[class_name, perm] = (
+                    (mapping.direction, mapping.weight) if mapping.enabled else None
+                )
+        return table
+
     def rule_infoflow(self, rule: AVRule) -> RuleInfoFlow:
         rule_class = str(rule.tclass)
+        rule_perms = tuple(rule.perms)
+        infoflow = self._infoflows.get((rule_class, rule_perms))
+        if infoflow is None:
+            infoflow = self._rule_infoflow(rule_class, rule_perms)
+            self._infoflows[rule_class, rule_perms] = infoflow
+
+        # Callers get their own lists
+        return RuleInfoFlow(
+            infoflow.read,
+            infoflow.write,
+            list(infoflow.read_perms),
+            list(infoflow.write_perms),
+            list(infoflow.unknown_perms),
+        )
+
+    def _rule_infoflow(self, rule_class: str, rule_perms: tuple[str, ...]) -> RuleInfoFlow:
+        if self._table is None:
+            self._table = self._compile()
+        table = self._table
         max_read_weight = 0
         max_write_weight = 0
         read_perms = []
@@ -39,32 +109,28 @@ class AndroidPermissionMap(PermissionMap):
         #                                   format(rule.ruletype))
 
         # Iterate over the permissions and determine the direction and weight for each
-        for perm in rule.perms:
-            try:
-                mapping = Mapping(self._permmap, rule_class, perm)
-            except UnmappedClass:
-                unknown_perms.append(perm)
-                # _logger.warning('Unmapped permission class: ' + rule_class)
-                continue
-            except UnmappedPermission:
+        for perm in rule_perms:
+            if (rule_class, perm) not in table:
+                # Unmapped class or permission
                 unknown_perms.append(perm)
-                # _logger.warning('Unmapped permission: ' + rule_class + ':' + perm)
                 continue
 
-            if not mapping.enabled:
+            mapping = table[rule_class, perm]
+            if mapping is None:
                 continue
 
-            if mapping.direction == 'r':
+            direction, weight = mapping
+            if direction == 'r':
                 read_perms.append(perm)
-                max_read_weight = max(max_read_weight, mapping.weight)
-            elif mapping.direction == 'w':
+                max_read_weight = max(max_read_weight, weight)
+            elif direction == 'w':
                 write_perms.append(perm)
-                max_write_weight = max(max_write_weight, mapping.weight)
-            elif mapping.direction == 'b':
+                max_write_weight = max(max_write_weight, weight)
+            elif direction == 'b':
                 read_perms.append(perm)
-                max_read_weight = max(max_read_weight, mapping.weight)
+                max_read_weight = max(max_read_weight, weight)
                 write_perms.append(perm)
-                max_write_weight = max(max_write_weight, mapping.weight)
+                max_write_weight = max(max_write_weight, weight)
 
         return RuleInfoFlow(
             max_read_weight, max_write_weight, read_perms, write_perms, unknown_perms
@@ -5,17 +5,23 @@ import difflib
 import logging
 import re
 import time
-from enum import Flag, auto
+from collections.abc import Iterable
 from pathlib import Path
 
 import networkx as nx
 import setools
 from libmata import alphabets as mata_alph
 from libmata.nfa import nfa as mata_nfa
+from setools.exception import InvalidType
 
 from selinuxtool.android.label import EdgeType
+from selinuxtool.util.common import file_digest
 
+from .cache import PolicyCache
+from .compress import SubjectCompression
 from .file_contexts import FileContext
+from .graphdb import dump_graphs, load_graphs, parse_graphs, save_graphs
+from .labelling import SECURITY_LVS, SecurityLvl, SecurityRules, default_rules
 from .permmap import AndroidPermissionMap
 
 _logger = logging.getLogger('SELinuxTool')
@@ -25,11 +31,16 @@ _ascii = {chr(i): i for i in range(32, 127)}
 _ascii_alphabet = mata_alph.OnTheFlyAlphabet.from_symbol_map(_ascii)
 
 
-class SecurityLvl(Flag):
-    NONE = 0
-    UNTRUSTED = auto()
-    TRUSTED = auto()
-    CRITICAL = auto()
+def _reaching(graph: nx.DiGraph, targets: Iterable[str]) -> set[str]:
+    # Nodes with a (possibly empty) path to any of the targets, as nx.has_path would tell
+    reaching = {target for target in targets if target in graph}
+    nodes_to_process = list(reaching)
+    while nodes_to_process:
+        for source in graph.predecessors(nodes_to_process.pop()):
+            if source not in reaching:
+                reaching.add(source)
+                nodes_to_process.append(source)
+    return reaching
 
 
 class Policy:
@@ -37,15 +48,27 @@ class Policy:
         'Name', 'Version', 'FC', 'Nodes', 'Edges', 'sN', 'sE', 'Load time (s)'
     )
 
-    def __init__(self, path: Path, permmapfile: str | Path | None = None) -> None:
+    def __init__(
+        self,
+        path: Path,
+        permmapfile: str | Path | None = None,
+        rules: SecurityRules | None = None,
+    ) -> None:
         self._path = path
+        self._permmapfile = permmapfile
         self._permmap = AndroidPermissionMap(permmapfile)
-        self._sepolicy: setools.SELinuxPolicy
+        self._rules = rules if rules is not None else default_rules()
+        self._sepolicy: setools.SELinuxPolicy | None = None
         self._file_contexts: dict[str, FileContext]
         self._missing_ctx: set[str] = set()
         self._properties: dict[str, str] = {}
         self._graph = nx.DiGraph()
         self._simple_graph = self._graph
+        self._compression: SubjectCompression | None = None
+        # Every level is empty until the policy is labelled
+        self._security_index: dict[SecurityLvl, frozenset[str]] = {
+            level: frozenset() for level in SECURITY_LVS
+        }
 
     def __str__(self) -> str:
         try:
@@ -70,8 +93,15 @@ class Policy:
     def path(self) -> Path:
         return self._path
 
+    @property
+    def load_time(self) -> float:
+        return self._load_time
+
     @property
     def sepolicy(self) -> setools.SELinuxPolicy:
+        # Parsed on first use, policies loaded from cache may never need it
+        if self._sepolicy is None:
+            self._sepolicy = setools.SELinuxPolicy(str(self._path / 'precompiled_sepolicy'))
         return self._sepolicy
 
     @property
@@ -125,46 +155,47 @@ class Policy:
         return datetime.datetime.strptime(date_str, '%Y-%m-%d').date()
 
     @property
-    def untrusted_labels(self) -> list[str]:
-        untrusted = [
-            n
-            for n, d in self._graph.nodes(data=True)
-            if SecurityLvl.UNTRUSTED in d['security_level']
-        ]
-        return untrusted
+    def untrusted_labels(self) -> frozenset[str]:
+        return self._security_index[SecurityLvl.UNTRUSTED]
 
     @property
-    def trusted_labels(self) -> list[str]:
-        trusted = [
-            n for n, d in self._graph.nodes(data=True) if SecurityLvl.TRUSTED in d['security_level']
-        ]
-        return trusted
+    def trusted_labels(self) -> frozenset[str]:
+        return self._security_index[SecurityLvl.TRUSTED]
 
     @property
-    def critical_labels(self) -> list[str]:
-        critical = [
-            n
-            for n, d in self._graph.nodes(data=True)
-            if SecurityLvl.CRITICAL in d['security_level']
-        ]
-        return critical
+    def critical_labels(self) -> frozenset[str]:
+        return self._security_index[SecurityLvl.CRITICAL]
 
-    def load_policy(self, load: bool, save: bool, count: int) -> None:
+    def security_labels(self, level: SecurityLvl) -> frozenset[str]:
+        return self._security_index[level]
+
+    def load_policy(
+        self, load: bool, save: bool, count: int, cache: PolicyCache | None = None
+    ) -> None:
         init_time = time.time()
         if not self._path.exists() or self._path == Path(''):
             _logger.fatal(f'The specified policy ({self._path}) was not found.')
             exit()
 
         _logger.info(f'Loading policy #{count + 1} ({self._path.name}).')
-        self._load_properties()
-        self._sepolicy = setools.SELinuxPolicy(str(self._path / 'precompiled_sepolicy'))
-        self._load_context(load, save)
-        self._load_graph(False, False)  # Seems to be more effective
+        self.load_properties()
+
+        key = PolicyCache.key([self._path / 'build.prop', *self._input_paths()]) if cache else ''
+        cached = cache.lookup(key) if cache is not None else None
+        if cached is None or not self._load_cached(*cached):
+            self._load_context(load, save)
+            self._load_graph(load, save)
+            if cache is not None:
+                cache.store(key, self._save_cached)
         self._update_security_labels()
         self._load_time = time.time() - init_time
         _logger.info(f'Loaded policy #{count + 1} in {self._load_time}.')
 
-    def _load_properties(self) -> None:
+    def load_properties(self) -> None:
+        # Enough to order policies, without loading them
+        if self._properties:
+            return
+
         with open(self._path / 'build.prop') as prop_file:
             for line_no, line in enumerate(prop_file):
                 # Ignore comments and blank lines
@@ -184,55 +215,24 @@ class Policy:
 
     def _load_context(self, load: bool, save: bool) -> None:
         db_exists = (self._path / 'db' / 'file_contexts.db').exists()
-        if load and db_exists:
-            self._file_contexts = FileContext.load(self._path)
+        contexts = FileContext.load(self._path) if load and db_exists else None
+        if contexts is not None:
+            self._file_contexts = contexts
         else:
             self._file_contexts = FileContext.from_files(
                 [self._path / 'plat_file_contexts', self._path / 'vendor_file_contexts']
             )
 
-        if save or (load and not db_exists):
+        if save or (load and contexts is None):
             FileContext.save(self._file_contexts, self._path)
 
     def _load_graph(self, load: bool, save: bool) -> None:
-        def attr_to_str(attr: EdgeType | str | bool) -> str:
-            if isinstance(attr, EdgeType):
-                return attr.name or ''
-            return str(attr)
-
-        pattern = re.compile(r"""(?x)
-                             (?P<type>(READ|WRITE|UNKN|ADDL)) |
-                             (?P<set>{.*}) |
-                             (?P<tuple>\(.*\)) |
-                             (?P<string>.*)
-                             """)
-
-        def str_to_attr(flat_str: str) -> EdgeType | str | set[str] | tuple[str]:
-            if flat_str == '_networkx_list_start':
-                return flat_str
-
-            mo = pattern.fullmatch(flat_str)
-            if not mo:
-                raise ValueError
-            match mo.lastgroup:
-                case 'type':
-                    return EdgeType[flat_str]
-                case 'set':
-                    return set(re.findall(r"'(.*?)'", flat_str))
-                case 'tuple':
-                    return tuple(re.findall(r"'(.*?)'", flat_str))
-                case 'str':
-                    return flat_str
-                case _:
-                    raise ValueError
-
         init_time = time.time()
-        graph_exists = (self._path / 'db' / 'graph.gml').exists()
-        if load and graph_exists:
-            self._graph = nx.read_gml(self.path / 'db' / 'graph.gml', destringizer=str_to_attr)
-            self._simple_graph = nx.read_gml(
-                self.path / 'db' / 'simple.gml', destringizer=str_to_attr
-            )
+        db_path = self._path / 'db' / 'graph.bin'
+        checksum = self._input_digest()
+        graphs = load_graphs(db_path, checksum) if load else None
+        if graphs is not None:
+            self._graph, self._simple_graph = graphs
         else:
             self._build_graph()
             self._build_simple_graph()
@@ -242,122 +242,197 @@ class Policy:
             f'Loaded graph in {load_time:.4f} {self.graph_debug_str}\t{self.simple_graph_debug_str}'
         )
 
-        if save or (load and not graph_exists):
-            nx.write_gml(self._graph, self._path / 'db' / 'graph.gml', attr_to_str)
-            nx.write_gml(self._simple_graph, self._path / 'db' / 'simple.gml', attr_to_str)
+        if save or (load and graphs is None):
+            db_path.parent.mkdir(exist_ok=True)
+            save_graphs(db_path, checksum, self._graph, self._simple_graph)
+
+    def _input_paths(self) -> list[Path]:
+        # The graphs only depend on the sepolicy, the file contexts and the permission map, the
+        # one actually loaded (setools records it), so that the default one is covered as well
+        return [
+            self._path / 'precompiled_sepolicy',
+            self._path / 'plat_file_contexts',
+            self._path / 'vendor_file_contexts',
+            Path(self._permmap.permmapfile),
+        ]
+
+    def _input_digest(self) -> bytes:
+        return file_digest(self._input_paths())
+
+    def _load_cached(self, entry: Path, meta: dict) -> bool:
+        graphs = load_graphs(entry / 'graph.bin', bytes.fromhex(meta['graph_checksum']))
+        if graphs is None or not (entry / 'db' / 'file_contexts.db').exists():
+            return False
+        contexts = FileContext.load(entry)
+        if contexts is None:
+            return False
+
+        self._file_contexts = contexts
+        self._graph, self._simple_graph = graphs
+        self._missing_ctx = set(meta['missing_contexts'])
+        _logger.info(f'Loaded policy from cache ({entry.name[:16]}).')
+        return True
+
+    def _set_security_levels(self) -> None:
+        for node in self._graph:
+            level = SecurityLvl.NONE
+            for single_level in SECURITY_LVS:
+                if node in self._security_index[single_level]:
+                    level |= single_level
+            self._graph.nodes[node]['security_level'] = level
+
+    # Compact form for process pools: graphs in the db format, NFAs as transition tables, and
+    # neither the sepolicy (parsed again on demand) nor the permission map (built again)
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state['_graph'] = dump_graphs(b'\0' * 32, self._graph, self._simple_graph)
+        del state['_simple_graph']
+        del state['_permmap']
+        state['_sepolicy'] = None
+        state['_compression'] = None
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._permmap = AndroidPermissionMap(self._permmapfile)
+        graphs = parse_graphs(state['_graph'], b'\0' * 32, self.name)
+        if graphs is None:
+            raise ValueError(f'Could not restore policy {self.name}.')
+        self._graph, self._simple_graph = graphs
+        self._set_security_levels()
+
+    def _save_cached(self, entry: Path) -> dict:
+        checksum = self._input_digest()
+        FileContext.save(self._file_contexts, entry)
+        save_graphs(entry / 'graph.bin', checksum, self._graph, self._simple_graph)
+        return {
+            'name': self.name,
+            'graph_checksum': checksum.hex(),
+            'missing_contexts': sorted(self._missing_ctx),
+        }
 
     def _build_graph(self) -> None:
-        def add_edge(source: str, target: str, type: EdgeType, perms: list[str]) -> None:
-            if self._graph.has_edge(source, target):
-                # TODO: maybe should move set to class
-                self._graph.edges[source, target]['perms'] |= set(perms)
-                self._graph.edges[source, target]['type'] |= type
-            else:
-                self._graph.add_edge(source, target, type=type, perms=set(perms))
-
-        def add_subj_node(label: str, transition: tuple[str, str]) -> None:
-            if self._graph.has_node(label):
-                if self._graph.nodes[label]['is_subject']:
-                    self._graph.nodes[label]['transitions'].append(transition)
-                else:
-                    self._graph.nodes[label]['is_subject'] = True
-                    self._graph.nodes[label]['transitions'] = [transition]
+        # A single pass over the rules: allow rules are accumulated per (source, target) in flat
+        # dicts, type transitions are kept aside, and the graph is filled in bulk afterwards
+        init_time = time.time()
+        edge_types: dict[tuple[str, str], int] = {}
+        edge_perms: dict[tuple[str, str], set[str]] = {}
+        transitions: list[tuple[str, str, str]] = []
+        read, write, unknown = EdgeType.READ.value, EdgeType.WRITE.value, EdgeType.UNKN.value
+
+        def add_edge(edge: tuple[str, str], type: int, perms: list[str]) -> None:
+            if edge in edge_types:
+                edge_types[edge] |= type
+                edge_perms[edge].update(perms)
             else:
-                self._graph.add_node(label, is_subject=True, transitions=[transition])
-
-        for terule in self._sepolicy.terules():
+                edge_types[edge] = type
+                edge_perms[edge] = set(perms)
+
+        allow = setools.policyrep.TERuletype.allow
+        type_transition = setools.policyrep.TERuletype.type_transition
+        rule_count = 0
+        for terule in self.sepolicy.terules():
+            rule_count += 1
             if isinstance(terule, setools.policyrep.AVRule):
                 # TODO: should also handle not allows?
-                if terule.ruletype == setools.policyrep.TERuletype.allow:
+                if terule.ruletype == allow:
                     u_label = str(terule.source)
                     v_label = str(terule.target)
 
                     rule_if = self._permmap.rule_infoflow(terule)
 
                     if rule_if.read_perms:
-                        add_edge(v_label, u_label, EdgeType.READ, rule_if.read_perms)
+                        add_edge((v_label, u_label), read, rule_if.read_perms)
 
                     if rule_if.write_perms:
-                        add_edge(u_label, v_label, EdgeType.WRITE, rule_if.write_perms)
+                        add_edge((u_label, v_label), write, rule_if.write_perms)
 
                     if rule_if.unknown_perms:
-                        add_edge(v_label, u_label, EdgeType.UNKN, rule_if.unknown_perms)
-                        add_edge(u_label, v_label, EdgeType.UNKN, rule_if.unknown_perms)
+                        add_edge((v_label, u_label), unknown, rule_if.unknown_perms)
+                        add_edge((u_label, v_label), unknown, rule_if.unknown_perms)
+            elif (
+                isinstance(terule, setools.policyrep.TERule) and terule.ruletype == type_transition
+            ):
+                # target is the object used for the transition
+                transitions.append((str(terule.source), str(terule.default), str(terule.target)))
+        rules_time = time.time() - init_time
+        _logger.info(
+            f'Read {rule_count} TE rules in {rules_time:.4f} '
+            f'({rule_count / max(rules_time, 1e-9):.0f} rules/s).'
+        )
+
+        # Edges (and so nodes) are inserted in the order they were first seen
+        edge_type_flags = {value: EdgeType(value) for value in set(edge_types.values())}
+        self._graph.add_edges_from(
+            (source, target, {'type': edge_type_flags[type], 'perms': edge_perms[source, target]})
+            for (source, target), type in edge_types.items()
+        )
         nx.set_node_attributes(self._graph, False, 'is_object')
         nx.set_node_attributes(self._graph, False, 'is_subject')
         _logger.debug(f'Processed allow rules. {self.graph_debug_str}')
 
         # Handling file contexts
-        for ctx, _ in self._file_contexts.items():
-            self._graph.add_node(ctx, is_object=True)
+        self._graph.add_nodes_from(self._file_contexts, is_object=True)
         _logger.debug(f'Processed file contexts. {self.graph_debug_str}')
 
         # Handling subject type transitions
-        for terule in list(self._sepolicy.terules()):
-            if (
-                isinstance(terule, setools.policyrep.TERule)
-                and terule.ruletype == setools.policyrep.TERuletype.type_transition
-            ):
-                # TODO: check
-                if not self._graph.nodes[terule.target]['is_object']:
-                    self._missing_ctx.add(str(terule.target))
-
-                u_label = str(terule.source)
-                v_label = str(terule.default)  # target is the object used for the transition
-                fc_label = str(terule.target)
-
-                # TODO: check if we need the file qualifier (terule.filename)
-                add_subj_node(v_label, (u_label, fc_label))
+        nodes = self._graph.nodes
+        for u_label, v_label, fc_label in transitions:
+            # TODO: check
+            if not nodes[fc_label]['is_object']:
+                self._missing_ctx.add(fc_label)
+
+            # TODO: check if we need the file qualifier (terule.filename)
+            if v_label not in nodes:
+                self._graph.add_node(v_label, is_subject=True, transitions=[])
+            elif not nodes[v_label].get('is_subject'):
+                nodes[v_label]['is_subject'] = True
+                nodes[v_label]['transitions'] = []
+            nodes[v_label]['transitions'].append((u_label, fc_label))
         _logger.debug(f'Processed type transitions. {self.graph_debug_str}')
         _logger.warning(f'Missing {len(self._missing_ctx)} contexts in type transitions.')
+        _logger.info(f'Built policy graph in {time.time() - init_time:.4f}.')
 
     def _build_simple_graph(self) -> None:
-        graph: nx.DiGraph = self._graph.copy()
-        nodes = [(n, graph.nodes[n]) for (n, deg) in sorted(graph.degree, key=lambda x: x[1])]
-        for progress, (node, node_data) in enumerate(nodes):
-            _rlogger.debug(f'Simplifying graph: {progress + 1} / {len(nodes)}')
-            if node_data['is_object']:
-                continue
-
-            for in_node, _, in_edge in graph.in_edges(node, data=True):
-                if not in_node == node:
-                    for _, out_node, out_edge in graph.out_edges(node, data=True):
-                        if not out_node == node:
-                            if not graph.has_edge(in_node, out_node):
-                                omitted_nodes = [node]
-                                # TODO: aggiungere permessi in else
-                                if in_edge['type'] == EdgeType.ADDL:
-                                    omitted_nodes += in_edge['omitted']
-                                if out_edge['type'] == EdgeType.ADDL:
-                                    omitted_nodes += out_edge['omitted']
-
-                                graph.add_edge(
-                                    in_node, out_node, type=EdgeType.ADDL, omitted=omitted_nodes
-                                )
-            graph.remove_node(node)
-        self._simple_graph = graph
-        _logger.debug('')
+        self._compression = SubjectCompression(self._graph)
+        self._simple_graph = self._compression.simple_graph()
         _logger.info(f'Simplified graph to only object nodes. {self.simple_graph_debug_str}')
 
-    def _update_security_labels(self) -> None:
-        UNTRUSTED_KW = ['isolate', 'untrust', 'danger', 'user', 'usr', 'debug', 'network']
-        TRUSTED_KW = ['trust', 'secur']
-        CRITICAL_KW = ['system', 'pol', 'critic', 'manager']
+    def relabel(self, rules: SecurityRules) -> None:
+        # Security levels from other rules, without reloading the policy
+        self._rules = rules
+        self._update_security_labels()
 
-        self._security_lvs: dict[SecurityLvl, list[str]] = {}
-        for node in self._graph:
-            level = SecurityLvl.NONE
-            if any(kw in node for kw in UNTRUSTED_KW):
-                level |= SecurityLvl.UNTRUSTED
-            if any(kw in node for kw in TRUSTED_KW) and 'untrust' not in node:
-                level |= SecurityLvl.TRUSTED
-            if any(kw in node for kw in CRITICAL_KW):
-                level |= SecurityLvl.CRITICAL
-
-            if level not in self._security_lvs:
-                self._security_lvs[level] = []
-            self._security_lvs[level].append(node)
-            self._graph.nodes[node]['security_level'] = level
+    def _update_security_labels(self) -> None:
+        init_time = time.time()
+        members = {
+            attribute: self._attribute_members(attribute) for attribute in self._rules.attributes
+        }
+        # Built once, so that atomic propositions do not rescan the graph
+        self._security_index = self._rules.classify(self._graph, members)
+        self._set_security_levels()
+        _logger.debug(f'Labelled {len(self._graph)} types in {time.time() - init_time}.')
+
+    def _attribute_members(self, attribute: str) -> frozenset[str]:
+        # Needs the sepolicy, which policies loaded from cache only parse for such rules
+        try:
+            type_attribute = self.sepolicy.lookup_typeattr(attribute)
+        except InvalidType:
+            _logger.warning(f'Unknown type attribute {attribute} in the labelling rules.')
+            return frozenset()
+        return frozenset(str(type_name) for type_name in type_attribute.expand())
+
+    def witness_path(self, source: str, target: str) -> list[str] | None:
+        # Labels of a policy path behind the simple graph edge source -> target
+        if not self._simple_graph.has_edge(source, target):
+            return None
+        if self._simple_graph.edges[source, target]['type'] != EdgeType.ADDL:
+            return [source, target]
+
+        if self._compression is None:  # Simple graph loaded from db
+            self._compression = SubjectCompression(self._graph)
+        subjects = self._compression.witness(source, target)
+        return None if subjects is None else [source, *subjects, target]
 
     # File contexts diffs
     def fc_diff(self, other: Policy) -> tuple[list[str], int, int]:
@@ -397,15 +472,13 @@ class Policy:
         initial_self = set()
         initial_other = set()
 
+        # Sources reaching a critical label, one backward search per graph instead of per pair
+        reaching_self = _reaching(self._graph, other.critical_labels)
+        reaching_other = _reaching(other._graph, other.critical_labels)
         for source in other.untrusted_labels:
-            if source in self._graph:
-                if any(
-                    target in self._graph and nx.has_path(self._graph, source, target)
-                    for target in other.critical_labels
-                ):
-                    initial_self.add(source)
-
-            if any(nx.has_path(other._graph, source, target) for target in other.critical_labels):
+            if source in reaching_self:
+                initial_self.add(source)
+            if source in reaching_other:
                 initial_other.add(source)
 
         init_fc_self_blu = mata_nfa.Nfa()  # empty lang
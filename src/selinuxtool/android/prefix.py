@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+from collections.abc import Iterable, Iterator
+from typing import Generic, TypeVar
+
+T = TypeVar('T')
+
+_META = frozenset('.[]()*+?{}|^$\\')
+_OPTIONAL = frozenset('*?{')
+
+
+def _has_top_level_alternation(regex: str) -> bool:
+    depth = 0
+    in_class = False
+    escaped = False
+    for char in regex:
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif in_class:
+            in_class = char != ']'
+        elif char == '[':
+            in_class = True
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            return True
+    return False
+
+
+def literal_prefix(regex: str) -> str:
+    # Every word of the regex language starts with the returned string, stopping early is safe
+    if _has_top_level_alternation(regex):
+        return ''
+
+    prefix: list[str] = []
+    pos = 0
+    while pos < len(regex):
+        char = regex[pos]
+        if char == '\\':
+            # Only escaped punctuation is a literal (e.g. `\.`), classes like `\d` are not
+            if pos + 1 >= len(regex) or regex[pos + 1].isalnum():
+                break
+            literal, step = regex[pos + 1], 2
+        elif char in _META:
+            break
+        else:
+            literal, step = char, 1
+
+        # A quantifier allowing zero repetitions makes the literal optional
+        if pos + step < len(regex) and regex[pos + step] in _OPTIONAL:
+            break
+
+        prefix.append(literal)
+        pos += step
+    return ''.join(prefix)
+
+
+def prefixes_overlap(left: str, right: str) -> bool:
+    return left.startswith(right) or right.startswith(left)
+
+
+class _TrieNode(Generic[T]):
+    __slots__ = ('children', 'items')
+
+    def __init__(self) -> None:
+        self.children: dict[str, _TrieNode[T]] = {}
+        self.items: list[T] = []
+
+
+class PrefixTrie(Generic[T]):
+    def __init__(self, entries: Iterable[tuple[str, T]] = ()) -> None:
+        self._root: _TrieNode[T] = _TrieNode()
+        self._size = 0
+        for prefix, item in entries:
+            self.insert(prefix, item)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def insert(self, prefix: str, item: T) -> None:
+        node = self._root
+        for char in prefix:
+            node = node.children.setdefault(char, _TrieNode())
+        node.items.append(item)
+        self._size += 1
+
+    def overlapping(self, prefix: str) -> Iterator[T]:
+        # Items whose prefix is an ancestor of, equal to, or an extension of the given one
+        node = self._root
+        for char in prefix:
+            yield from node.items
+            child = node.children.get(char)
+            if child is None:
+                return
+            node = child
+
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            yield from node.items
+            stack.extend(node.children.values())
@@ -1,4 +1,8 @@
-from dataclasses import dataclass
+from __future__ import annotations
+
+import weakref
+from dataclasses import dataclass, fields
+from typing import ClassVar, Self
 
 from lark import Transformer, ast_utils, v_args
 
@@ -6,42 +10,60 @@ from selinuxtool.android.policy import SecurityLvl
 
 
 class _IFDIF_AST(ast_utils.Ast):
-    pass
+    # Hash-consing: structurally equal nodes are built as the same object, so (being eq=False
+    # dataclasses) they hash by identity and can key the solver cache directly
+    _interned: ClassVar[weakref.WeakValueDictionary[tuple, _IFDIF_AST]] = (
+        weakref.WeakValueDictionary()
+    )
+
+    def __new__(cls, *args: object, **kwargs: object) -> Self:
+        names = [field.name for field in fields(cls)]  # type: ignore[arg-type]
+        key = (cls, *args, *(kwargs[name] for name in names[len(args) :]))
+        node = _IFDIF_AST._interned.get(key)
+        if node is None:
+            node = super().__new__(cls)
+            _IFDIF_AST._interned[key] = node
+        return node  # type: ignore[return-value]
+
+    def __reduce__(self) -> tuple[type, tuple]:
+        # Pickle and deepcopy would call __new__ without fields, nodes are rebuilt through the
+        # interning constructor instead (a copy is the interned node itself)
+        return type(self), tuple(getattr(self, field.name) for field in fields(self))  # type: ignore[arg-type]
 
 
 class _POLICY(_IFDIF_AST):
     pass
 
 
-@dataclass
+@dataclass(eq=False)
 class TruePolicy(_POLICY):
     pass
 
 
-@dataclass
+@dataclass(eq=False)
 class UpArrow(_POLICY):
     index: int
     label: SecurityLvl | str
 
 
-@dataclass
+@dataclass(eq=False)
 class And(_POLICY):
     left: _POLICY
     right: _POLICY
 
 
-@dataclass
+@dataclass(eq=False)
 class Not(_POLICY):
     inner: _POLICY
 
 
-@dataclass
+@dataclass(eq=False)
 class Diamond(_POLICY):
     index: int
     policy: _POLICY
 
 
-@dataclass
+@dataclass(eq=False)
 class BDiamond(_POLICY):
     index: int
     policy: _POLICY
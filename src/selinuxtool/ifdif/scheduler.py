@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import logging
+import multiprocessing
+import time
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+
+from selinuxtool.android.graph import InfoFlowGraph
+from selinuxtool.ifdif.ast import _POLICY, And, BDiamond, Diamond, Not, UpArrow
+from selinuxtool.ifdif.solver import Solver
+
+_logger = logging.getLogger('SELinuxTool')
+
+# Queries per task are a fraction of the share of each worker, contiguous so that neighbouring
+# (usually related) queries hit the same solver cache
+_TASKS_PER_WORKER = 4
+
+
+@dataclass
+class QueryResult:
+    model: int
+    # (node, side, product path) of every (b)diamond behind the explained counterexamples
+    witnesses: list[tuple[tuple[str, str], int, list[tuple[str, str]]]] = field(
+        default_factory=list
+    )
+    time: float = 0.0
+    cache_hits: int = 0
+    cache_misses: int = 0
+    skipped_nodes: int = 0
+
+
+# (graph, asts, differential, max_witnesses), set in the parent before the pool is forked so
+# that the workers inherit the built graph (and its closures) instead of receiving a copy, and
+# cleared as a whole once the batch is done
+_shared: tuple[InfoFlowGraph, list[_POLICY], bool, int] | None = None
+_worker_solver: Solver | None = None
+
+
+def _evaluate(
+    solver: Solver, graph: InfoFlowGraph, ast: _POLICY, max_witnesses: int
+) -> QueryResult:
+    init_time = time.time()
+    hits, misses, skipped = solver.cache_hits, solver.cache_misses, solver.skipped_nodes
+    model = solver.model(ast)
+    query_time = time.time() - init_time
+
+    # Every witness path is a search of the product graph, so they are only found on request,
+    # for the first max_witnesses counterexamples, and outside the query time
+    witnesses = []
+    if max_witnesses > 0 and model:
+        for node in sorted(graph.nodes_of(model))[:max_witnesses]:
+            witnesses += [
+                (node, diamond.index - 1, path) for diamond, path in solver.witnesses(ast, node)
+            ]
+    return QueryResult(
+        model,
+        witnesses,
+        query_time,
+        solver.cache_hits - hits,
+        solver.cache_misses - misses,
+        solver.skipped_nodes - skipped,
+    )
+
+
+def _evaluate_shared(position: int) -> QueryResult:
+    # Each worker keeps one solver, and so one subformula cache, for all its queries
+    global _worker_solver
+    if _shared is None:
+        raise RuntimeError('Queries evaluated outside of a batch.')
+    graph, asts, differential, max_witnesses = _shared
+    if _worker_solver is None:
+        _worker_solver = Solver(graph, differential)
+    return _evaluate(_worker_solver, graph, asts[position], max_witnesses)
+
+
+def _subformulas(policy: _POLICY) -> Iterator[_POLICY]:
+    yield policy
+    match policy:
+        case Diamond() | BDiamond():
+            yield from _subformulas(policy.policy)
+        case And():
+            yield from _subformulas(policy.left)
+            yield from _subformulas(policy.right)
+        case Not():
+            yield from _subformulas(policy.inner)
+
+
+def _prepare(graph: InfoFlowGraph, asts: list[_POLICY], differential: bool) -> None:
+    # Lazily built label masks and closures are built once in the parent rather than once per
+    # worker; malformed subformulas are left for the solver to reject
+    for policy in {policy for ast in asts for policy in _subformulas(ast)}:
+        match policy:
+            case UpArrow(index=1 | 2):
+                graph.label_mask(policy.index, policy.label)
+            case Diamond(index=1 | 2) | BDiamond(index=1 | 2) if graph.uses_closure:
+                direction = 'left' if policy.index == 1 else 'right'
+                graph.closure(direction, 'in' if isinstance(policy, Diamond) else 'out')
+    if differential:
+        graph.delta_region_mask()
+
+
+def evaluate_queries(
+    graph: InfoFlowGraph,
+    asts: list[_POLICY],
+    jobs: int = 1,
+    differential: bool = False,
+    max_witnesses: int = 0,
+) -> Iterator[QueryResult]:
+    # Results are yielded in the order of asts; the graph is only read once built, so the
+    # workers are forked from this process and share it copy-on-write
+    jobs = min(len(asts), jobs)
+    if jobs <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        solver = Solver(graph, differential)
+        for ast in asts:
+            yield _evaluate(solver, graph, ast, max_witnesses)
+        return
+
+    global _shared
+    _prepare(graph, asts, differential)
+    _shared = (graph, asts, differential, max_witnesses)
+    chunksize = max(1, len(asts) // (jobs * _TASKS_PER_WORKER))
+    init_time = time.time()
+    try:
+        with ProcessPoolExecutor(jobs, mp_context=multiprocessing.get_context('fork')) as pool:
+            yield from pool.map(_evaluate_shared, range(len(asts)), chunksize=chunksize)
+    finally:
+        _shared = None
+    _logger.debug(
+        f'Evaluated {len(asts)} queries with {jobs} processes in {time.time() - init_time:.4f}.'
+    )
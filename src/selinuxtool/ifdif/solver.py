@@ -1,57 +1,147 @@
+import sys
+from collections.abc import Iterator
+
 from selinuxtool.android.graph import InfoFlowGraph
-from selinuxtool.android.policy import SecurityLvl
+from selinuxtool.android.policy import SECURITY_LVS
 from selinuxtool.ifdif.ast import _POLICY, And, BDiamond, Diamond, Not, TruePolicy, UpArrow
 
+# Differential evaluation falls back to the whole graph above this share of affected nodes
+_DIFFERENTIAL_MAX_REGION = 0.5
+
+
+def swap_diamonds(policy: _POLICY) -> _POLICY:
+    # The same formula with the policy of every (b)diamond swapped, labels are left untouched
+    match policy:
+        case Diamond():
+            return Diamond(3 - policy.index, swap_diamonds(policy.policy))
+        case BDiamond():
+            return BDiamond(3 - policy.index, swap_diamonds(policy.policy))
+        case And():
+            return And(swap_diamonds(policy.left), swap_diamonds(policy.right))
+        case Not():
+            return Not(swap_diamonds(policy.inner))
+        case _:
+            return policy
+
 
 class Solver:
-    def __init__(self, info_flow_graph: InfoFlowGraph) -> None:
+    def __init__(self, info_flow_graph: InfoFlowGraph, differential: bool = False) -> None:
         self._graph = info_flow_graph
+        # AST nodes are hash-consed, so each distinct subformula is computed once per solver
+        self._cache: dict[_POLICY, int] = {}
+        self._cache_hits = 0
+        self._cache_misses = 0
+        # Subformulas evaluated on the delta region only (see model)
+        self._differential = differential
+        self._region_cache: dict[_POLICY, int] = {}
+        self._skipped_nodes = 0
+
+    @property
+    def cache_hits(self) -> int:
+        return self._cache_hits
+
+    @property
+    def cache_misses(self) -> int:
+        return self._cache_misses
+
+    @property
+    def skipped_nodes(self) -> int:
+        return self._skipped_nodes
+
+    @property
+    def nbytes(self) -> int:
+        # Models of the cached subformulas, counted once when cached for both universes
+        models = {id(model): model for model in self._cache.values()}
+        models.update((id(model), model) for model in self._region_cache.values())
+        return sum(sys.getsizeof(model) for model in models.values())
+
+    # Models are bitmasks over the product node ids, see InfoFlowGraph.nodes_of
+    def model(self, policy: _POLICY) -> int:
+        if self._differential and policy not in self._cache:
+            match policy:
+                case And(left=phi, right=Not(inner=swapped)) if swapped is swap_diamonds(phi):
+                    return self._differential_model(policy)
+        return self._cached(policy, self._graph.all_mask, self._cache)
+
+    def _differential_model(self, policy: _POLICY) -> int:
+        # phi and not swap(phi) only holds where left and right edges differ, nodes outside the
+        # delta region (closed under all edges) are never visited
+        num_nodes = len(self._graph.nodes)
+        region = self._graph.delta_region_mask()
+        region_size = region.bit_count()
+        if region_size > _DIFFERENTIAL_MAX_REGION * num_nodes:
+            return self._cached(policy, self._graph.all_mask, self._cache)
+
+        self._skipped_nodes += num_nodes - region_size
+        model = self._cached(policy, region, self._region_cache)
+        self._cache[policy] = model
+        return model
+
+    def _cached(self, policy: _POLICY, universe: int, cache: dict[_POLICY, int]) -> int:
+        if policy in cache:
+            self._cache_hits += 1
+            return cache[policy]
+
+        self._cache_misses += 1
+        model = self._model(policy, universe, cache)
+        cache[policy] = model
+        return model
+
+    def _witness_model(self, policy: _POLICY, node_id: int) -> int:
+        # Region models are exact on the region, which witness paths from its nodes never leave
+        if policy not in self._cache and policy in self._region_cache:
+            if self._graph.delta_region_mask() >> node_id & 1:
+                return self._region_cache[policy]
+        return self.model(policy)
+
+    def witnesses(
+        self, policy: _POLICY, node: tuple[str, str]
+    ) -> Iterator[tuple[Diamond | BDiamond, list[tuple[str, str]]]]:
+        # Product paths behind every (b)diamond subformula that node satisfies, negated
+        # subformulas are not descended into as their diamonds do not explain the node
+        match policy:
+            case Diamond() | BDiamond():
+                node_id = self._graph.node_id(node)
+                if self._witness_model(policy, node_id) >> node_id & 1:
+                    direction = 'left' if policy.index == 1 else 'right'
+                    type = 'in' if isinstance(policy, Diamond) else 'out'
+                    path = self._graph.witness_path(
+                        node, self._witness_model(policy.policy, node_id), direction, type
+                    )
+                    if path is not None:
+                        yield policy, path
+                yield from self.witnesses(policy.policy, node)
 
-    def model(self, policy: _POLICY) -> set[tuple[str, str]]:
+            case And():
+                yield from self.witnesses(policy.left, node)
+                yield from self.witnesses(policy.right, node)
+
+    def _model(self, policy: _POLICY, universe: int, cache: dict[_POLICY, int]) -> int:
+        # Models are restricted to universe, a set of nodes closed under all edges
         match policy:
             case TruePolicy():
-                return self._graph.labels
+                return universe
 
             case UpArrow():
                 if policy.index not in {1, 2}:
                     raise IndexError(policy.index)
 
-                match policy.label:
-                    case SecurityLvl.UNTRUSTED:
-                        if policy.index == 1:
-                            labels = self._graph._left.untrusted_labels
-                        elif policy.index == 2:
-                            labels = self._graph._right.untrusted_labels
-
-                    case SecurityLvl.TRUSTED:
-                        if policy.index == 1:
-                            labels = self._graph._left.trusted_labels
-                        elif policy.index == 2:
-                            labels = self._graph._right.trusted_labels
-
-                    case SecurityLvl.CRITICAL:
-                        if policy.index == 1:
-                            labels = self._graph._left.critical_labels
-                        elif policy.index == 2:
-                            labels = self._graph._right.critical_labels
-
-                    case _:
-                        if not isinstance(policy.label, str):
-                            raise TypeError('Cannot parse label.')
-                        labels = [policy.label]
+                if policy.label not in SECURITY_LVS and not isinstance(policy.label, str):
+                    raise TypeError('Cannot parse label.')
 
-                return {t for t in self._graph.labels if t[policy.index - 1] in labels}
+                return self._graph.label_mask(policy.index, policy.label) & universe
 
             case And():
-                return self.model(policy.left) & self.model(policy.right)
+                left = self._cached(policy.left, universe, cache)
+                return left & self._cached(policy.right, universe, cache)
 
             case Not():
-                return self._graph.labels - self.model(policy.inner)
+                return universe & ~self._cached(policy.inner, universe, cache)
 
             case Diamond():
-                candidates = self.model(policy.policy)
+                candidates = self._cached(policy.policy, universe, cache)
                 if not candidates:
-                    return set()
+                    return 0
 
                 if policy.index == 1:
                     direction = 'left'
@@ -60,12 +150,12 @@ class Solver:
                 else:
                     raise IndexError(policy.index)
 
-                return self._graph.eventually_reach(candidates, direction)
+                return self._graph.eventually_reachable_mask(candidates, direction, type='in')
 
             case BDiamond():
-                candidates = self.model(policy.policy)
+                candidates = self._cached(policy.policy, universe, cache)
                 if not candidates:
-                    return set()
+                    return 0
 
                 if policy.index == 1:
                     direction = 'left'
@@ -74,7 +164,7 @@ class Solver:
                 else:
                     raise IndexError(policy.index)
 
-                return self._graph.eventually_reached_by(candidates, direction)
+                return self._graph.eventually_reachable_mask(candidates, direction, type='out')
 
             case _:
                 raise TypeError('Unrecognised logical component.')
@@ -1,13 +1,20 @@
 import argparse
+import gc
 import logging
+import resource
 import sys
 import time
 from pathlib import Path
 
-from selinuxtool.android.graph import InfoFlowGraph
+from selinuxtool.android.cache import DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE, PolicyCache
+from selinuxtool.android.file_contexts import FileContext
+from selinuxtool.android.graph import REACHABILITY_MODES, InfoFlowGraph
+from selinuxtool.android.labelling import DEFAULT_RULES_FILE, SecurityRules
+from selinuxtool.android.loader import load_policies
 from selinuxtool.android.policy import Policy
 from selinuxtool.ifdif.parser import Parser
-from selinuxtool.ifdif.solver import Solver
+from selinuxtool.ifdif.scheduler import evaluate_queries
+from selinuxtool.server import DEFAULT_GRAPH_MEMORY, QueryServer, send_requests
 
 parser = argparse.ArgumentParser(description='Evaluates SEAndroid policies.')
 subparsers = parser.add_subparsers(help='set the execution mode', required=True)
@@ -20,12 +27,64 @@ parser_ver.add_argument(
     help='a specific vendor if the -e option is used or the path of a collection of policies',
 )
 parser_ver.add_argument('device', nargs='?', help='a specific device')
+parser_ver.add_argument(
+    '--stream',
+    action='store_true',
+    help='compare adjacent policies as they are loaded, keeping only two in memory',
+)
 
 # Policy mode
 parser_pol = subparsers.add_parser('policy', help='compare the two provided policies over a set of queries')
 parser_pol.add_argument('queries', type=str, help='a file of queries to be performed')
 parser_pol.add_argument('first', help='the first policy to compare')
 parser_pol.add_argument('second', help='the second policy to compare')
+parser_pol.add_argument(
+    '--differential',
+    action='store_true',
+    help='evaluate `phi and not swap(phi)` queries only where the two policies differ',
+)
+parser_pol.add_argument(
+    '--query-jobs',
+    type=int,
+    default=1,
+    help='the number of processes evaluating queries, sharing the built InfoFlowGraph',
+)
+parser_pol.add_argument(
+    '--witnesses',
+    type=int,
+    default=0,
+    metavar='N',
+    help='explain the first N counterexamples of every query with witness paths',
+)
+
+# Server mode
+parser_srv = subparsers.add_parser('serve', help='keep policies loaded and answer queries')
+parser_srv.add_argument(
+    'policies', nargs='*', help='policies loaded at startup, as NAME=PATH or PATH (named PATH)'
+)
+parser_srv.add_argument(
+    '--socket', type=str, help='listen on this Unix socket instead of stdin/stdout'
+)
+parser_srv.add_argument(
+    '--memory',
+    type=int,
+    default=DEFAULT_GRAPH_MEMORY // 2**20,
+    help='the size in MiB above which least recently used product graphs are evicted',
+)
+
+# Query client
+parser_qry = subparsers.add_parser('query', help='send queries to a running server')
+parser_qry.add_argument('socket', type=str, help='the Unix socket of the server')
+parser_qry.add_argument('left', nargs='?', help='the name of the first policy to compare')
+parser_qry.add_argument('right', nargs='?', help='the name of the second policy to compare')
+parser_qry.add_argument('queries', nargs='*', help='the queries to be performed')
+parser_qry.add_argument(
+    '--load', action='append', default=[], metavar='NAME=PATH', help='load a policy first'
+)
+parser_qry.add_argument(
+    '--unload', action='append', default=[], metavar='NAME', help='unload a policy first'
+)
+parser_qry.add_argument('--shutdown', action='store_true', help='stop the server afterwards')
 
 # Generic setup
 parser.add_argument('-v', '--verbose', action='store_true', help='prints debug info')
@@ -33,6 +92,49 @@ parser.add_argument(
     '-e', '--extracted', action='store_true', help='assume policies are from extracted folder'
 )
 parser.add_argument('-m', '--permmap', type=str, help='the path of the permission map to use')
+parser.add_argument(
+    '-j',
+    '--jobs',
+    type=int,
+    default=1,
+    help='the number of processes used to build the InfoFlowGraph',
+)
+parser.add_argument(
+    '--load-jobs',
+    type=int,
+    help='the number of processes loading policies concurrently (default: one per policy/CPU)',
+)
+parser.add_argument(
+    '-r',
+    '--reachability',
+    choices=REACHABILITY_MODES,
+    default='auto',
+    help='answer ito/ifrom by graph search, precomputed closures, or by graph size (default)',
+)
+
+parser.add_argument(
+    '--labels',
+    type=str,
+    default=str(DEFAULT_RULES_FILE),
+    help='the security labelling rules (JSON) applied to all policies (default: %(default)s)',
+)
+
+# Policy cache
+parser.add_argument(
+    '--no-cache', action='store_true', help='neither read nor write the persistent policy cache'
+)
+parser.add_argument(
+    '--cache-dir',
+    type=str,
+    default=str(DEFAULT_CACHE_DIR),
+    help='the directory of the policy cache (default: %(default)s)',
+)
+parser.add_argument(
+    '--cache-size',
+    type=int,
+    default=DEFAULT_CACHE_SIZE // 2**20,
+    help='the size in MiB above which least recently used policies are evicted from the cache',
+)
 
 # Save/Load functionality
 save_load = parser.add_mutually_exclusive_group()
@@ -60,7 +162,14 @@ _permmapfile: Path | None = None
 
 def main() -> None:
     # Set default mode to policy
-    if len(sys.argv) > 1 and sys.argv[1] not in {'vertical', 'policy', '-h', '--help'}:
+    if len(sys.argv) > 1 and sys.argv[1] not in {
+        'vertical',
+        'policy',
+        'serve',
+        'query',
+        '-h',
+        '--help',
+    }:
         sys.argv.insert(1, 'policy')
     args = parser.parse_args()
 
@@ -72,6 +181,16 @@ def main() -> None:
     args.func(args)
 
 
+def policy_cache(args: argparse.Namespace) -> PolicyCache | None:
+    if args.no_cache:
+        return None
+    return PolicyCache(Path(args.cache_dir), args.cache_size * 2**20)
+
+
+def security_rules(args: argparse.Namespace) -> SecurityRules:
+    return SecurityRules.from_file(args.labels)
+
+
 def vertical_mode(args: argparse.Namespace) -> None:
     _logger.info('Starting vertical comparison of the specified policies.')
     if not args.extracted:
@@ -89,13 +208,20 @@ def vertical_mode(args: argparse.Namespace) -> None:
     policy_paths.sort()
 
     _logger.info(f'Found {len(policy_paths)} policies.')
-    policies: list[Policy] = []
-    for count, path in enumerate(policy_paths):
-        # if count > 1:
-        #     continue
-        policy = Policy(path, _permmapfile)
-        policy.load_policy(args.load, args.save, count)
-        policies.append(policy)
+    if args.stream:
+        stream_vertical(args, policy_paths)
+        report_peak_memory()
+        return
+
+    policies = load_policies(
+        policy_paths,
+        args.load,
+        args.save,
+        policy_cache(args),
+        _permmapfile,
+        args.load_jobs,
+        security_rules(args),
+    )
 
     _logger.info('Ordering policies for vertical comparison:')
     policies.sort()
@@ -110,84 +236,237 @@ def vertical_mode(args: argparse.Namespace) -> None:
 
     _blogger.info('Stage 1 - file context changes:')
     for i in range(len(policies) - 1):
-        delta, dels, adds = policies[i].fc_diff(policies[i + 1])
-        if delta:
-            _blogger.info(f'{SML_IND}#{i + 1} --> #{i + 2} (-{dels}, +{adds})')
-            for line in delta:
-                _flogger.info(MED_IND + line)
+        fc_changes(i, policies[i], policies[i + 1])
 
     _blogger.info('Stage 2 - type changes:')
     for i in range(len(policies) - 1):
-        nodes_self, nodes_other, edges_self, edges_other = policies[i].type_diff(policies[i + 1])
-        if nodes_self or edges_self or nodes_other or edges_other:
-            _blogger.info(
-                f'{SML_IND}#{i + 1} --> #{i + 2}'
-                f' Nodes (-{len(nodes_self)}, +{len(nodes_other)})'
-                f' Edges (-{len(edges_self)}, +{len(edges_other)})'
-            )
-            if nodes_self or nodes_other:
-                _flogger.info(f'{MED_IND}Node changes:')
-                for node in nodes_self:
-                    _flogger.info(f'{BIG_IND}- {node}')
-                for node in nodes_other:
-                    _flogger.info(f'{BIG_IND}+ {node}')
-            if edges_self or edges_other:
-                _flogger.info(f'{MED_IND}Edge changes:')
-                for edge in edges_self:
-                    _flogger.info(f'{BIG_IND}- {edge}')
-                for edge in edges_other:
-                    _flogger.info(f'{BIG_IND}+ {edge}')
+        type_changes(i, policies[i], policies[i + 1])
 
     _blogger.info('Stage X - security changes:')
     for i in range(len(policies) - 1):
-        diffs, nfa = policies[i].security_lvs_diff(policies[i + 1])
-        if len(diffs) != 0:
-            _blogger.info(f'{SML_IND}#{i + 1} --> #{i + 2} Diffs: {diffs}')
-        if len(nfa.final_states) != 0:
-            _blogger.info(f'{SML_IND}#{i + 1} --> #{i + 2} FC: {nfa}')
+        security_changes(i, policies[i], policies[i + 1])
 
     _blogger.info('Stage Y - fc security changes:')
+    graph: InfoFlowGraph | None = None
     for i in range(len(policies) - 1):
-        graph = InfoFlowGraph(policies[i], policies[i + 1])
-        graph.build_graph()
-        nfa = graph.security_lvs_diff()
-        if len(nfa.final_states) != 0:
-            _blogger.info(f'{SML_IND}#{i + 1} --> #{i + 2} FC: {nfa}')
-        del graph
+        graph = product_graph(args, graph, policies[i], policies[i + 1])
+        fc_security_changes(i, graph)
+    del graph
+    report_peak_memory()
+
+
+def stream_vertical(args: argparse.Namespace, policy_paths: list[Path]) -> None:
+    # Policies are ordered from their build.prop, then compared pair by pair with only the two
+    # policies of the current pair loaded
+    _logger.info('Ordering policies for streamed vertical comparison:')
+    policies = [Policy(path, _permmapfile) for path in policy_paths]
+    for policy in policies:
+        policy.load_properties()
+    policies.sort()
+    for count, policy in enumerate(policies):
+        _logger.info(f'  #{count + 1}: {policy.name} {policy.version}')
+
+    _flogger.info(f'Vertical comparison of the following {len(policy_paths)} policies.')
+    _blogger.info(f'{BIG_IND}{Policy.STR_HEADERS}')
+    ordered_paths = [policy.path for policy in policies]
+    del policies
+
+    cache = policy_cache(args)
+    rules = security_rules(args)
+    previous: Policy | None = None
+    graph: InfoFlowGraph | None = None
+    for count, path in enumerate(ordered_paths):
+        policy = Policy(path, _permmapfile, rules)
+        policy.load_policy(args.load, args.save, count, cache)
+        FileContext.trim_interned()
+        _blogger.info(f'{SML_IND}#{count + 1}: {policy}')
+
+        if previous is not None:
+            _blogger.info(f'{SML_IND}#{count} --> #{count + 1}:')
+            fc_changes(count - 1, previous, policy)
+            type_changes(count - 1, previous, policy)
+            security_changes(count - 1, previous, policy)
+            graph = product_graph(args, graph, previous, policy)
+            fc_security_changes(count - 1, graph)
+            graph.release()
+
+        # Only the newest policy is kept for the next pair
+        previous = policy
+        gc.collect()
+
+
+def report_peak_memory() -> None:
+    # ru_maxrss is in KiB on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    _logger.info(f'Peak memory {peak / 2**10:.2f} MiB.')
+
+
+def fc_changes(i: int, policy: Policy, other: Policy) -> None:
+    delta, dels, adds = policy.fc_diff(other)
+    if delta:
+        _blogger.info(f'{SML_IND}#{i + 1} --> #{i + 2} (-{dels}, +{adds})')
+        for line in delta:
+            _flogger.info(MED_IND + line)
+
+
+def type_changes(i: int, policy: Policy, other: Policy) -> None:
+    nodes_self, nodes_other, edges_self, edges_other = policy.type_diff(other)
+    if nodes_self or edges_self or nodes_other or edges_other:
+        _blogger.info(
+            f'{SML_IND}#{i + 1} --> #{i + 2}'
+            f' Nodes (-{len(nodes_self)}, +{len(nodes_other)})'
+            f' Edges (-{len(edges_self)}, +{len(edges_other)})'
+        )
+        if nodes_self or nodes_other:
+            _flogger.info(f'{MED_IND}Node changes:')
+            for node in nodes_self:
+                _flogger.info(f'{BIG_IND}- {node}')
+            for node in nodes_other:
+                _flogger.info(f'{BIG_IND}+ {node}')
+        if edges_self or edges_other:
+            _flogger.info(f'{MED_IND}Edge changes:')
+            for edge in edges_self:
+                _flogger.info(f'{BIG_IND}- {edge}')
+            for edge in edges_other:
+                _flogger.info(f'{BIG_IND}+ {edge}')
+
+
+def security_changes(i: int, policy: Policy, other: Policy) -> None:
+    diffs, nfa = policy.security_lvs_diff(other)
+    if len(diffs) != 0:
+        _blogger.info(f'{SML_IND}#{i + 1} --> #{i + 2} Diffs: {diffs}')
+    if len(nfa.final_states) != 0:
+        _blogger.info(f'{SML_IND}#{i + 1} --> #{i + 2} FC: {nfa}')
+
+
+def product_graph(
+    args: argparse.Namespace, previous: InfoFlowGraph | None, policy: Policy, other: Policy
+) -> InfoFlowGraph:
+    # Consecutive pairs share a policy, whose side of the previous product is reused
+    if previous is not None:
+        return previous.successor(other, args.jobs)
+    graph = InfoFlowGraph(policy, other, args.reachability)
+    graph.build_graph(args.jobs)
+    return graph
+
+
+def fc_security_changes(i: int, graph: InfoFlowGraph) -> None:
+    nfa = graph.security_lvs_diff()
+    if len(nfa.final_states) != 0:
+        _blogger.info(f'{SML_IND}#{i + 1} --> #{i + 2} FC: {nfa}')
+
+
+def explain_path(policy: Policy, side: int, path: list[tuple[str, str]]) -> list[str]:
+    # Labels of a product path on one side, with the subjects behind ADDL edges
+    labels = [path[0][side]]
+    for source, target in zip(path, path[1:]):
+        hop = policy.witness_path(source[side], target[side])
+        labels.extend(hop[1:] if hop else [target[side]])
+    return labels
 
 
 def policy_mode(args: argparse.Namespace) -> None:
     _logger.info('Starting comparison of the specified policies.')
 
-    policy_left = Policy(Path(args.first), _permmapfile)
-    policy_right = Policy(Path(args.second), _permmapfile)
-    policy_left.load_policy(args.load, args.save, 0)
-    policy_right.load_policy(args.load, args.save, 1)
-
-    graph = InfoFlowGraph(policy_left, policy_right)
-    graph.build_graph()
+    policy_left, policy_right = load_policies(
+        [Path(args.first), Path(args.second)],
+        args.load,
+        args.save,
+        policy_cache(args),
+        _permmapfile,
+        args.load_jobs,
+        security_rules(args),
+    )
+
+    graph = InfoFlowGraph(policy_left, policy_right, args.reachability)
+    graph.build_graph(args.jobs)
     
     with open(args.queries) as query_file:
         queries = [ line.rstrip() for line in query_file ]
     init_time = time.time()
     parser = Parser()
-    solver = Solver(graph)
-    for query in queries:
-        ast = parser.solve(query)
-        model = solver.model(ast)
+    asts = [parser.solve(query) for query in queries]
+    cache_hits = cache_misses = skipped_nodes = 0
+    query_time = 0.0
+    results = evaluate_queries(graph, asts, args.query_jobs, args.differential, args.witnesses)
+    for query, result in zip(queries, results):
         _logger.info(f'Query perfomed `{query}`')
-        if len(model) == 0:
+        if not result.model:
             _logger.info(f'{BIG_IND} TRUE')
         else:
-            _logger.info(f'{BIG_IND} FALSE, the following labels are counterexamples {model}')
-  
-            
-    query_time = time.time() - init_time
-    _logger.info(f'Perfomed {len(queries)} queries in {query_time}.')
+            counterexamples = graph.nodes_of(result.model)
+            _logger.info(
+                f'{BIG_IND} FALSE, the following labels are counterexamples {counterexamples}'
+            )
+            for node, side, path in result.witnesses:
+                labels = explain_path([policy_left, policy_right][side], side, path)
+                _flogger.info(f'{BIG_IND}{node} #{side + 1}: {" -> ".join(labels)}')
+        query_time += result.time
+        cache_hits += result.cache_hits
+        cache_misses += result.cache_misses
+        skipped_nodes += result.skipped_nodes
+
+    _logger.info(
+        f'Perfomed {len(queries)} queries in {time.time() - init_time} '
+        f'({query_time} solving, cache {cache_hits} hits, {cache_misses} misses).'
+    )
+    if args.differential:
+        _logger.info(f'Differential evaluation skipped {skipped_nodes} nodes.')
+
+
+def named_policy(arg: str) -> tuple[str, Path]:
+    name, _, path = arg.rpartition('=')
+    return name or Path(path).name, Path(path)
+
+
+def serve_mode(args: argparse.Namespace) -> None:
+    server = QueryServer(
+        args.load,
+        args.save,
+        policy_cache(args),
+        _permmapfile,
+        security_rules(args),
+        args.reachability,
+        args.jobs,
+        args.memory * 2**20,
+    )
+    server.load_policies(named_policy(arg) for arg in args.policies)
+    if args.socket:
+        server.serve_socket(Path(args.socket))
+    else:
+        server.serve_stream(sys.stdin, sys.stdout)
+
+
+def query_mode(args: argparse.Namespace) -> None:
+    requests: list[dict] = [{'op': 'unload', 'name': name} for name in args.unload]
+    for arg in args.load:
+        name, path = named_policy(arg)
+        requests.append({'op': 'load', 'name': name, 'path': str(path.resolve())})
+    if args.left and args.right:
+        requests.append(
+            {'op': 'query', 'left': args.left, 'right': args.right, 'queries': args.queries}
+        )
+    if args.shutdown:
+        requests.append({'op': 'shutdown'})
+
+    for response in send_requests(Path(args.socket), requests):
+        if not response['ok']:
+            _logger.error(response['error'])
+        for result in response.get('results', ()):
+            _logger.info(f'Query perfomed `{result["query"]}` in {result["time"]:.4f}')
+            if result['holds']:
+                _logger.info(f'{BIG_IND} TRUE')
+            else:
+                counterexamples = [tuple(node) for node in result['counterexamples']]
+                _logger.info(
+                    f'{BIG_IND} FALSE, the following labels are counterexamples {counterexamples}'
+                )
 
 
 parser_ver.set_defaults(func=vertical_mode)
 parser_pol.set_defaults(func=policy_mode)
+parser_srv.set_defaults(func=serve_mode)
+parser_qry.set_defaults(func=query_mode)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,249 @@
+from __future__ import annotations
+
+import gc
+import json
+import logging
+import socket
+import socketserver
+import time
+from collections import OrderedDict
+from collections.abc import Iterable
+from pathlib import Path
+from typing import IO
+
+from lark.exceptions import LarkError
+
+from selinuxtool.android.cache import PolicyCache
+from selinuxtool.android.file_contexts import FileContext
+from selinuxtool.android.graph import InfoFlowGraph
+from selinuxtool.android.labelling import SecurityRules
+from selinuxtool.android.policy import Policy
+from selinuxtool.ifdif.parser import Parser
+from selinuxtool.ifdif.solver import Solver
+
+_logger = logging.getLogger('SELinuxTool')
+
+DEFAULT_GRAPH_MEMORY = 4 * 2**30
+
+# Requests and responses are JSON objects, one per line:
+#   {"op": "load", "name": "a", "path": "..."}  -> {"ok": true, "time": ...}
+#   {"op": "unload", "name": "a"}               -> {"ok": true}
+#   {"op": "list"}                              -> {"ok": true, "policies": ..., "graphs": ...}
+#   {"op": "query", "left": "a", "right": "b", "queries": ["..."]}
+#       -> {"ok": true, "graph_time": ..., "results": [{"query", "holds", "counterexamples",
+#           "time"}, ...]}
+#   {"op": "shutdown"}                          -> {"ok": true}
+# Failed requests get {"ok": false, "error": "..."}
+
+
+# Fields every request of an operation must have
+_REQUIRED_FIELDS = {
+    'load': ('name', 'path'),
+    'unload': ('name',),
+    'list': (),
+    'query': ('left', 'right', 'queries'),
+    'shutdown': (),
+}
+
+
+class RequestError(Exception):
+    pass
+
+
+class QueryServer:
+    # Named policies stay loaded until unloaded, product graphs (with their solvers, so that
+    # subformulas are cached across requests) are built on demand and evicted least recently
+    # used first once they exceed max_bytes. The budget covers what grows with the queries: the
+    # adjacencies, closures and node masks of the graphs and the models cached by the solvers;
+    # the loaded policies themselves are only released by unloading them
+    def __init__(
+        self,
+        load: bool = False,
+        save: bool = False,
+        cache: PolicyCache | None = None,
+        permmapfile: str | Path | None = None,
+        rules: SecurityRules | None = None,
+        reachability: str = 'auto',
+        jobs: int = 1,
+        max_bytes: int = DEFAULT_GRAPH_MEMORY,
+    ) -> None:
+        self._load = load
+        self._save = save
+        self._cache = cache
+        self._permmapfile = permmapfile
+        self._rules = rules
+        self._reachability = reachability
+        self._jobs = jobs
+        self._max_bytes = max_bytes
+        self._parser = Parser()
+        self._policies: dict[str, Policy] = {}
+        self._graphs: OrderedDict[tuple[str, str], tuple[InfoFlowGraph, Solver]] = OrderedDict()
+        self._running = True
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    def handle(self, request: dict) -> dict:
+        # Failed requests leave the loaded policies and graphs as they were
+        if not isinstance(request, dict):
+            return {'ok': False, 'error': 'Requests must be JSON objects.'}
+        op = request.get('op')
+        if op not in _REQUIRED_FIELDS:
+            return {'ok': False, 'error': f'Unknown operation {op}.'}
+        missing = [name for name in _REQUIRED_FIELDS[op] if name not in request]
+        if missing:
+            return {'ok': False, 'error': f'Missing fields {", ".join(missing)} for {op}.'}
+
+        try:
+            match op:
+                case 'load':
+                    return self._load_policy(request['name'], Path(request['path']))
+                case 'unload':
+                    return self._unload_policy(request['name'])
+                case 'list':
+                    return {
+                        'ok': True,
+                        'policies': {
+                            name: str(policy.path) for name, policy in self._policies.items()
+                        },
+                        'graphs': [list(key) for key in self._graphs],
+                    }
+                case 'query':
+                    return self._query(request['left'], request['right'], request['queries'])
+                case 'shutdown':
+                    self._running = False
+                    return {'ok': True}
+            raise RequestError(f'Unknown operation {op}.')
+        except (RequestError, LarkError) as e:
+            return {'ok': False, 'error': str(e)}
+        except Exception as e:
+            _logger.exception(f'Failed {op} request.')
+            return {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+
+    def load_policies(self, policies: Iterable[tuple[str, Path]]) -> None:
+        for name, path in policies:
+            self._load_policy(name, path)
+
+    def _load_policy(self, name: str, path: Path) -> dict:
+        if not (path / 'build.prop').exists():
+            raise RequestError(f'No policy at {path}.')
+
+        # A policy being reloaded is only replaced once the new one is loaded
+        init_time = time.time()
+        policy = Policy(path, self._permmapfile, self._rules)
+        try:
+            policy.load_policy(self._load, self._save, len(self._policies), self._cache)
+        except SystemExit:
+            raise RequestError(f'Could not load the policy at {path}.') from None
+        if name in self._policies:
+            self._unload_policy(name)
+        self._policies[name] = policy
+        return {'ok': True, 'time': time.time() - init_time}
+
+    def _unload_policy(self, name: str) -> dict:
+        self._policies.pop(name, None)
+        for key in [key for key in self._graphs if name in key]:
+            del self._graphs[key]
+        # The file-context NFAs only it used can now be dropped from the interning tables
+        gc.collect()
+        FileContext.trim_interned()
+        return {'ok': True}
+
+    def _product(self, left: str, right: str) -> tuple[InfoFlowGraph, Solver, float]:
+        key = (left, right)
+        if key in self._graphs:
+            self._graphs.move_to_end(key)
+            return *self._graphs[key], 0.0
+        for name in key:
+            if name not in self._policies:
+                raise RequestError(f'Policy {name} is not loaded.')
+
+        init_time = time.time()
+        graph = InfoFlowGraph(self._policies[left], self._policies[right], self._reachability)
+        graph.build_graph(self._jobs)
+        self._graphs[key] = (graph, Solver(graph))
+        self._evict()
+        return *self._graphs[key], time.time() - init_time
+
+    def _evict(self) -> None:
+        # The most recent graph is kept even if it alone exceeds the budget
+        sizes = {
+            key: graph.nbytes + graph.cache_nbytes + solver.nbytes
+            for key, (graph, solver) in self._graphs.items()
+        }
+        total_bytes = sum(sizes.values())
+        while total_bytes > self._max_bytes and len(self._graphs) > 1:
+            key, _ = self._graphs.popitem(last=False)
+            total_bytes -= sizes[key]
+            _logger.info(f'Evicted product graph {key} ({sizes[key] / 2**20:.2f} MiB).')
+
+    def _query(self, left: str, right: str, queries: list[str]) -> dict:
+        if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+            raise RequestError('Queries must be a list of strings.')
+        graph, solver, graph_time = self._product(left, right)
+        results = []
+        for query in queries:
+            init_time = time.time()
+            model = solver.model(self._parser.solve(query))
+            results.append(
+                {
+                    'query': query,
+                    'holds': not model,
+                    'counterexamples': sorted(graph.nodes_of(model)),
+                    'time': time.time() - init_time,
+                }
+            )
+        # Solver caches grow with the queries, so the budget is checked after them
+        self._evict()
+        return {'ok': True, 'graph_time': graph_time, 'results': results}
+
+    def serve_stream(self, requests: IO[str], responses: IO[str]) -> None:
+        for line in requests:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                response = {'ok': False, 'error': f'Invalid request ({e}).'}
+            else:
+                response = self.handle(request)
+            responses.write(json.dumps(response) + '\n')
+            responses.flush()
+            if not self._running:
+                break
+
+    def serve_socket(self, socket_path: Path) -> None:
+        # Connections are served one at a time, the graphs and solvers are not thread-safe
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self) -> None:
+                with (
+                    self.connection.makefile('r', encoding='utf-8') as requests,
+                    self.connection.makefile('w', encoding='utf-8') as responses,
+                ):
+                    server.serve_stream(requests, responses)
+
+        if socket_path.exists():
+            socket_path.unlink()
+        with socketserver.UnixStreamServer(str(socket_path), Handler) as unix_server:
+            _logger.info(f'Serving queries on {socket_path}.')
+            try:
+                while self._running:
+                    unix_server.handle_request()
+            finally:
+                socket_path.unlink()
+
+
+def send_requests(socket_path: Path, requests: list[dict]) -> list[dict]:
+    # Client side: one connection for the whole batch, responses in request order
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(str(socket_path))
+        with client.makefile('rw', encoding='utf-8') as stream:
+            responses = []
+            for request in requests:
+                stream.write(json.dumps(request) + '\n')
+                stream.flush()
+                responses.append(json.loads(stream.readline()))
+    return responses
@@ -1,6 +1,14 @@
+import hashlib
+from array import array
+from collections.abc import Iterable
+from pathlib import Path
+
 from libmata.nfa import strings as mata_str
 from libmata.nfa.nfa import Nfa as Nfa
 
+# Picklable NFA: number of states, initial states, final states and flat transitions
+NfaTable = tuple[int, list[int], list[int], array]
+
 
 class bcolors:
     HEADER = '\033[95m'
@@ -21,3 +29,39 @@ def nfa_to_word(nfa: Nfa) -> str:
         chars = [chr(c) for c in word]
         words.append(''.join(chars))
     return words
+
+
+def nfa_to_table(nfa: Nfa) -> NfaTable:
+    transitions = array('i')
+    for trans in nfa.iterate():
+        transitions.extend((trans.source, trans.symbol, trans.target))
+    return (
+        nfa.num_of_states(),
+        list(nfa.initial_states),
+        list(nfa.final_states),
+        transitions,
+    )
+
+
+def nfa_from_table(table: NfaTable) -> Nfa:
+    num_states, initial_states, final_states, transitions = table
+    nfa = Nfa(num_states)
+    for pos in range(0, len(transitions), 3):
+        nfa.add_transition(transitions[pos], transitions[pos + 1], transitions[pos + 2])
+    nfa.make_initial_states(initial_states)
+    nfa.make_final_states(final_states)
+    return nfa
+
+
+def file_digest(paths: Iterable[Path]) -> bytes:
+    # SHA-256 over the names, sizes and contents of the given files (size -1 if missing)
+    digest = hashlib.sha256()
+    for path in paths:
+        size = path.stat().st_size if path.exists() else -1
+        digest.update(path.name.encode() + b'\0' + size.to_bytes(8, 'little', signed=True))
+        if size <= 0:
+            continue
+        with open(path, 'rb') as file:
+            while chunk := file.read(1 << 20):
+                digest.update(chunk)
+    return digest.digest()
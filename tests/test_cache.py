@@ -0,0 +1,87 @@
+import json
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from selinuxtool.android.cache import META_FILE, PolicyCache
+from selinuxtool.android.policy import Policy
+
+
+class TestPolicyCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self._dir = tempfile.TemporaryDirectory()
+        self.root = Path(self._dir.name)
+        self.cache = PolicyCache(self.root / 'cache', max_bytes=3500)
+
+    def tearDown(self) -> None:
+        self._dir.cleanup()
+
+    def write_entry(self, size: int) -> dict:
+        def write(entry: Path) -> dict:
+            (entry / 'graph.bin').write_bytes(bytes(size))
+            return {'name': 'policy'}
+
+        return write
+
+    def test_key(self) -> None:
+        input_path = self.root / 'build.prop'
+        input_path.write_text('ro.build.version.release=14\n')
+        key = PolicyCache.key([input_path, self.root / 'missing'])
+
+        self.assertEqual(key, PolicyCache.key([input_path, self.root / 'missing']))
+        input_path.write_text('ro.build.version.release=15\n')
+        self.assertNotEqual(key, PolicyCache.key([input_path, self.root / 'missing']))
+
+    def test_permission_map_input(self) -> None:
+        # The default permission map is an input as much as an explicit one
+        policy = Policy(self.root / 'policy')
+        self.assertIn(Path(policy.perm_map.permmapfile), policy._input_paths())
+
+        permmap_path = self.root / 'perm_map'
+        permmap_path.write_text(Path(policy.perm_map.permmapfile).read_text())
+        key = PolicyCache.key(Policy(self.root / 'policy', permmap_path)._input_paths())
+        with open(permmap_path, 'a') as permmap_file:
+            permmap_file.write('\nclass extra 1\n  read r 10\n')
+        self.assertNotEqual(
+            key, PolicyCache.key(Policy(self.root / 'policy', permmap_path)._input_paths())
+        )
+
+    def test_store_lookup(self) -> None:
+        self.assertIsNone(self.cache.lookup('a'))
+        self.cache.store('a', self.write_entry(100))
+
+        entry, meta = self.cache.lookup('a')
+        self.assertEqual(meta['name'], 'policy')
+        self.assertEqual((entry / 'graph.bin').stat().st_size, 100)
+        self.assertEqual([path.name for path in self.cache.root.iterdir()], ['a'])
+
+        # Entries of other versions are ignored
+        meta['version'] = -1
+        with open(entry / META_FILE, 'w') as meta_file:
+            json.dump(meta, meta_file)
+        self.assertIsNone(self.cache.lookup('a'))
+
+    def test_concurrent_eviction(self) -> None:
+        # The entry disappears between reading its metadata and marking it as recently used
+        self.cache.store('a', self.write_entry(100))
+        utime = os.utime
+
+        def evict(path: Path) -> None:
+            self.cache._max_bytes = 0
+            self.cache.evict()
+            utime(path)
+
+        with mock.patch('selinuxtool.android.cache.os.utime', side_effect=evict):
+            self.assertIsNone(self.cache.lookup('a'))
+        self.assertEqual(list(self.cache.root.iterdir()), [])
+
+    def test_eviction(self) -> None:
+        for age, key in enumerate(['a', 'b', 'c']):
+            self.cache.store(key, self.write_entry(1000))
+            os.utime(self.cache.root / key / META_FILE, (age, age))
+        self.cache.lookup('a')  # Now the most recently used
+
+        self.cache.store('d', self.write_entry(1000))
+        self.assertEqual(sorted(path.name for path in self.cache.root.iterdir()), ['a', 'c', 'd'])
@@ -0,0 +1,290 @@
+import gc
+import pickle
+import struct
+import tempfile
+import unittest
+from pathlib import Path
+
+from libmata import parser as mata_parser
+from libmata.nfa import nfa as mata_nfa
+
+from selinuxtool.android import file_contexts
+from selinuxtool.android.file_contexts import (
+    _FC_DB_ENTRY,
+    _FC_DB_HEADER,
+    FileContext,
+    _ascii_alphabet,
+)
+from selinuxtool.android.prefix import PrefixTrie, literal_prefix
+
+SAMPLE_CONTEXTS = r"""
+# Root and catch-all entries
+/.*                                         u:object_r:default_file:s0
+/                                           u:object_r:rootfs:s0
+/system(/.*)?                               u:object_r:system_file:s0
+/system/bin/sh                          --  u:object_r:shell_exec:s0
+/system/bin/toybox                      --  u:object_r:toolbox_exec:s0
+/system/bin/toolbox                     --  u:object_r:toolbox_exec:s0
+/system/etc/selinux(/.*)?                   u:object_r:sepolicy_file:s0
+/system/etc/hosts\.conf                     u:object_r:system_conf_file:s0
+/(vendor|system/vendor)(/.*)?               u:object_r:vendor_file:s0
+/(vendor|system/vendor)/bin/hw/android\.hardware\.wifi@1\.0-service  u:object_r:hal_wifi_exec:s0
+/vendor/lib(64)?/hw/gralloc\.so             u:object_r:same_process_hal_file:s0
+/data(/.*)?                                 u:object_r:system_data_file:s0
+/data/vendor(/.*)?                          u:object_r:vendor_data_file:s0
+/data/vendor/wifi(/.*)?                     u:object_r:wifi_vendor_data_file:s0
+/data/vendor/wifi/wpa(/.*)?                 u:object_r:wpa_data_file:s0
+/data/misc/wifi(/.*)?                       u:object_r:wifi_data_file:s0
+/data/misc/wifi/sockets(/.*)?               u:object_r:wpa_socket:s0
+/dev(/.*)?                                  u:object_r:device:s0
+/dev/block(/.*)?                            u:object_r:block_device:s0
+/dev/block/by-name/[a-z_]+                  u:object_r:block_device:s0
+/dev/block/by-name/userdata                 u:object_r:userdata_block_device:s0
+/dev/socket/rild[0-9]?                      u:object_r:rild_socket:s0
+/dev/socket(/.*)?                           u:object_r:socket_device:s0
+/dev/tty[0-9]*                              u:object_r:tty_device:s0
+/sys/devices/platform/.*\.i2c/i2c-[0-9]+/.*  u:object_r:sysfs_i2c:s0
+/data/vendor/wifi/wpa/sockets(/.*)?         u:object_r:wpa_socket:s0
+"""
+
+
+def naive_from_files(ctx_paths: list[Path]) -> dict[str, mata_nfa.Nfa]:
+    # Reference implementation: each entry is shadowed by the union of all later ones
+    entries: list[tuple[str, str]] = []
+    for ctx_path in ctx_paths:
+        with open(ctx_path) as file:
+            for line in file:
+                components = line.split()
+                if not components or components[0].startswith('#'):
+                    continue
+                entries.append((components[0], components[-1].split(':')[2]))
+    entries.reverse()
+
+    nfas: dict[str, mata_nfa.Nfa] = {}
+    old_nfa = mata_parser.from_regex('')
+    for regex, ctx_type in entries:
+        nfa = mata_parser.from_regex(regex)
+        shadowed = mata_nfa.intersection(nfa, mata_nfa.complement(old_nfa, _ascii_alphabet))
+        old_nfa = mata_nfa.union(old_nfa, nfa)
+        nfas[ctx_type] = mata_nfa.union(nfas[ctx_type], shadowed) if ctx_type in nfas else shadowed
+    return nfas
+
+
+class TestLiteralPrefix(unittest.TestCase):
+    def test_plain(self) -> None:
+        self.assertEqual(literal_prefix('/system/bin/sh'), '/system/bin/sh')
+        self.assertEqual(literal_prefix('/system(/.*)?'), '/system')
+        self.assertEqual(literal_prefix('/.*'), '/')
+
+    def test_escapes(self) -> None:
+        self.assertEqual(literal_prefix(r'/system/etc/hosts\.conf'), '/system/etc/hosts.conf')
+        self.assertEqual(literal_prefix(r'/dev/\d+'), '/dev/')
+
+    def test_optional(self) -> None:
+        self.assertEqual(literal_prefix('/dev/tty[0-9]*'), '/dev/tty')
+        self.assertEqual(literal_prefix('/dev/ttyS?'), '/dev/tty')
+        self.assertEqual(literal_prefix('/vendor/lib(64)?/hw'), '/vendor/lib')
+
+    def test_alternation(self) -> None:
+        self.assertEqual(literal_prefix('/(vendor|system/vendor)/bin'), '/')
+        self.assertEqual(literal_prefix('/vendor/bin|/system/bin'), '')
+        self.assertEqual(literal_prefix('/[|]a|b'), '')
+        self.assertEqual(literal_prefix('/a[|(]b'), '/a')
+
+
+class TestPrefixTrie(unittest.TestCase):
+    def test_overlapping(self) -> None:
+        trie = PrefixTrie([('/', 0), ('/data', 1), ('/data/vendor', 2), ('/dev', 3), ('', 4)])
+
+        self.assertEqual(sorted(trie.overlapping('/data/vendor/wifi')), [0, 1, 2, 4])
+        self.assertEqual(sorted(trie.overlapping('/data')), [0, 1, 2, 4])
+        self.assertEqual(sorted(trie.overlapping('/sys')), [0, 4])
+        self.assertEqual(sorted(trie.overlapping('')), [0, 1, 2, 3, 4])
+        self.assertEqual(len(trie), 5)
+
+
+class TestFileContextPrecedence(unittest.TestCase):
+    def setUp(self) -> None:
+        self._dir = tempfile.TemporaryDirectory()
+        self.ctx_path = Path(self._dir.name) / 'plat_file_contexts'
+        with open(self.ctx_path, 'w') as file:
+            file.write(SAMPLE_CONTEXTS)
+
+    def tearDown(self) -> None:
+        self._dir.cleanup()
+
+    def test_language_equivalence(self) -> None:
+        contexts = FileContext.from_files([self.ctx_path])
+        expected = naive_from_files([self.ctx_path])
+
+        self.assertEqual(set(contexts), set(expected))
+        for ctx_type, nfa in expected.items():
+            with self.subTest(ctx_type=ctx_type):
+                self.assertTrue(mata_nfa.equivalence_check(contexts[ctx_type].nfa, nfa))
+
+    def test_shadowing(self) -> None:
+        contexts = FileContext.from_files([self.ctx_path])
+
+        def accepts(ctx_type: str, path: str) -> bool:
+            return contexts[ctx_type].nfa.is_in_lang([ord(c) for c in path])
+
+        self.assertTrue(accepts('wpa_socket', '/data/vendor/wifi/wpa/sockets/wlan0'))
+        self.assertFalse(accepts('wpa_data_file', '/data/vendor/wifi/wpa/sockets/wlan0'))
+        self.assertTrue(accepts('userdata_block_device', '/dev/block/by-name/userdata'))
+        self.assertFalse(accepts('block_device', '/dev/block/by-name/userdata'))
+        self.assertTrue(accepts('socket_device', '/dev/socket/rild1'))
+        self.assertFalse(accepts('rild_socket', '/dev/socket/rild1'))
+        self.assertTrue(accepts('vendor_file', '/system/vendor/lib'))
+        self.assertFalse(accepts('system_file', '/system/vendor/lib'))
+
+    def test_interning(self) -> None:
+        contexts = FileContext.from_files([self.ctx_path])
+        for ctx_type, ctx in FileContext.from_files([self.ctx_path]).items():
+            self.assertIs(ctx.nfa, contexts[ctx_type].nfa)
+
+        # Only the entries overlapping the changed one are rebuilt
+        with open(self.ctx_path, 'w') as file:
+            file.write(SAMPLE_CONTEXTS.replace('/dev/tty[0-9]*', '/dev/ttyS[0-9]*'))
+        changed = FileContext.from_files([self.ctx_path])
+        self.assertIs(changed['wpa_socket'].nfa, contexts['wpa_socket'].nfa)
+        self.assertIs(changed['userdata_block_device'].nfa, contexts['userdata_block_device'].nfa)
+        self.assertIsNot(changed['tty_device'].nfa, contexts['tty_device'].nfa)
+        self.assertIsNot(changed['device'].nfa, contexts['device'].nfa)
+
+    def test_trim_interned(self) -> None:
+        contexts = FileContext.from_files([self.ctx_path])
+        tty_nfa, wpa_nfa = contexts['tty_device'].nfa, contexts['wpa_socket'].nfa
+        with open(self.ctx_path, 'w') as file:
+            file.write(SAMPLE_CONTEXTS.replace('/dev/tty[0-9]*', '/dev/ttyS[0-9]*'))
+        changed = FileContext.from_files([self.ctx_path])
+
+        # The NFAs of contexts still alive stay interned
+        FileContext.trim_interned()
+        with open(self.ctx_path, 'w') as file:
+            file.write(SAMPLE_CONTEXTS)
+        self.assertIs(FileContext.from_files([self.ctx_path])['tty_device'].nfa, tty_nfa)
+
+        # Once released, only the NFAs of the last load stay interned
+        del contexts
+        gc.collect()
+        with open(self.ctx_path, 'w') as file:
+            file.write(SAMPLE_CONTEXTS.replace('/dev/tty[0-9]*', '/dev/ttyS[0-9]*'))
+        again = FileContext.from_files([self.ctx_path])
+        FileContext.trim_interned()
+        self.assertIs(again['tty_device'].nfa, changed['tty_device'].nfa)
+        del changed, again
+        gc.collect()
+        with open(self.ctx_path, 'w') as file:
+            file.write(SAMPLE_CONTEXTS)
+        original = FileContext.from_files([self.ctx_path])
+        self.assertIsNot(original['tty_device'].nfa, tty_nfa)
+        self.assertIs(original['wpa_socket'].nfa, wpa_nfa)
+
+    def test_trim_unpickled(self) -> None:
+        contexts = pickle.loads(pickle.dumps(FileContext.from_files([self.ctx_path])))
+        FileContext.trim_interned()
+        self.assertIs(pickle.loads(pickle.dumps(contexts))['device'].nfa, contexts['device'].nfa)
+
+        nfa_ids = {id(ctx.nfa) for ctx in contexts.values()}
+        del contexts
+        gc.collect()
+        FileContext.trim_interned()
+        self.assertFalse(nfa_ids & {id(nfa) for nfa in file_contexts._table_nfas.values()})
+
+    def test_db_interned(self) -> None:
+        # Policies restored from their dbs (e.g. from the cache) share their identical NFAs
+        first_path = Path(self._dir.name) / 'first'
+        second_path = Path(self._dir.name) / 'second'
+        first_path.mkdir()
+        second_path.mkdir()
+        FileContext.save(FileContext.from_files([self.ctx_path]), first_path)
+        with open(self.ctx_path, 'w') as file:
+            file.write(SAMPLE_CONTEXTS.replace('/dev/tty[0-9]*', '/dev/ttyS[0-9]*'))
+        FileContext.save(FileContext.from_files([self.ctx_path]), second_path)
+
+        first = FileContext.load(first_path)
+        second = FileContext.load(second_path)
+        self.assertIs(second['wpa_socket'].nfa, first['wpa_socket'].nfa)
+        self.assertIs(second['userdata_block_device'].nfa, first['userdata_block_device'].nfa)
+        self.assertIsNot(second['tty_device'].nfa, first['tty_device'].nfa)
+
+        # And keep them interned while they are alive
+        FileContext.trim_interned()
+        self.assertIs(FileContext.load(first_path)['tty_device'].nfa, first['tty_device'].nfa)
+
+    def test_pickle(self) -> None:
+        contexts = FileContext.from_files([self.ctx_path])
+        first = pickle.loads(pickle.dumps(contexts))
+        second = pickle.loads(pickle.dumps(contexts))
+
+        self.assertEqual(set(first), set(contexts))
+        for ctx_type, ctx in contexts.items():
+            with self.subTest(ctx_type=ctx_type):
+                self.assertEqual(str(first[ctx_type].label), str(ctx.label))
+                self.assertTrue(mata_nfa.equivalence_check(first[ctx_type].nfa, ctx.nfa))
+                self.assertIs(second[ctx_type].nfa, first[ctx_type].nfa)
+
+    def test_db_round_trip(self) -> None:
+        contexts = FileContext.from_files([self.ctx_path])
+        FileContext.save(contexts, self._dir.name)
+        loaded = FileContext.load(Path(self._dir.name))
+
+        self.assertIsNotNone(loaded)
+        self.assertEqual(set(loaded), set(contexts))
+        for ctx_type, ctx in contexts.items():
+            with self.subTest(ctx_type=ctx_type):
+                self.assertEqual(str(loaded[ctx_type].label), str(ctx.label))
+                self.assertEqual(loaded[ctx_type].prefixes, ctx.prefixes)
+                self.assertTrue(mata_nfa.equivalence_check(loaded[ctx_type].nfa, ctx.nfa))
+
+    def test_db_old_format(self) -> None:
+        db_path = Path(self._dir.name) / 'db'
+        db_path.mkdir()
+        (db_path / 'file_contexts.db').write_text('--BEGIN--\n["/.*"]\t\tu:object_r:a:s0\n')
+
+        self.assertIsNone(FileContext.load(Path(self._dir.name)))
+
+    def test_db_corrupt(self) -> None:
+        contexts = FileContext.from_files([self.ctx_path])
+        FileContext.save(contexts, self._dir.name)
+        db_path = Path(self._dir.name) / 'db' / 'file_contexts.db'
+        data = db_path.read_bytes()
+
+        # Cuts within the header, metadata and transition table (by whole and partial items) of
+        # every entry; cuts at entry boundaries leave a well-formed db with fewer contexts
+        cuts = []
+        pos = _FC_DB_HEADER.size
+        while pos < len(data):
+            metadata_size, _, num_transitions = _FC_DB_ENTRY.unpack_from(data, pos)
+            transitions_pos = pos + _FC_DB_ENTRY.size + metadata_size
+            cuts += [
+                pos + 1,
+                pos + _FC_DB_ENTRY.size + metadata_size // 2,
+                transitions_pos + 4 * num_transitions - 2,
+            ]
+            if num_transitions > 1:  # Fully shadowed entries have no transitions
+                cuts.append(transitions_pos + 4 * (num_transitions // 2))
+            pos = transitions_pos + 4 * num_transitions
+
+        for size in cuts:
+            db_path.write_bytes(data[:size])
+            with self.subTest(size=size):
+                self.assertIsNone(FileContext.load(Path(self._dir.name)))
+
+        # Bad metadata (encoding, JSON, missing fields) and transition tables
+        entry = _FC_DB_HEADER.size
+        metadata_size, num_states, num_transitions = _FC_DB_ENTRY.unpack_from(data, entry)
+        metadata = data[entry + _FC_DB_ENTRY.size :][:metadata_size]
+        transitions = data[entry + _FC_DB_ENTRY.size + metadata_size :][: 4 * num_transitions]
+        rest = data[entry + _FC_DB_ENTRY.size + metadata_size + 4 * num_transitions :]
+        for name, metadata, transitions in [
+            ('encoding', b'\xff' + metadata[1:], transitions),
+            ('json', metadata[:-1] + b',', transitions),
+            ('fields', metadata.replace(b'"final"', b'"_inal"'), transitions),
+            ('transitions', metadata, transitions[:-4]),
+            ('states', metadata, struct.pack('<i', -1) + transitions[4:]),
+        ]:
+            header = _FC_DB_ENTRY.pack(len(metadata), num_states, len(transitions) // 4)
+            db_path.write_bytes(data[:entry] + header + metadata + transitions + rest)
+            with self.subTest(name=name):
+                self.assertIsNone(FileContext.load(Path(self._dir.name)))
@@ -1,11 +1,82 @@
+import random
+import tempfile
 import unittest
+from pathlib import Path
+from types import SimpleNamespace
 
 import networkx as nx
+from libmata.nfa import nfa as mata_nfa
 
+from selinuxtool.android.csr import CSRAdjacency, TransitiveClosure
+from selinuxtool.android.file_contexts import FileContext
 from selinuxtool.android.graph import InfoFlowGraph
 
+LEFT_CONTEXTS = """
+/.*                         u:object_r:default_file:s0
+/system(/.*)?               u:object_r:system_file:s0
+/system/bin/sh              u:object_r:shell_exec:s0
+/data(/.*)?                 u:object_r:system_data_file:s0
+/data/vendor(/.*)?          u:object_r:vendor_data_file:s0
+/dev/block(/.*)?            u:object_r:block_device:s0
+/dev/socket/rild[0-9]?      u:object_r:rild_socket:s0
+"""
+
+RIGHT_CONTEXTS = """
+/.*                         u:object_r:default_file:s0
+/system(/.*)?               u:object_r:system_file:s0
+/(system|vendor)/bin/sh     u:object_r:shell_exec:s0
+/data(/.*)?                 u:object_r:system_data_file:s0
+/data/vendor/wifi(/.*)?     u:object_r:wifi_data_file:s0
+/dev/block/by-name/[a-z]+   u:object_r:block_device:s0
+/dev/socket(/.*)?           u:object_r:socket_device:s0
+"""
+
+
+def stub_policy(contexts: str, edges: list[tuple[str, str]]) -> SimpleNamespace:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ctx_path = Path(tmp_dir) / 'plat_file_contexts'
+        with open(ctx_path, 'w') as file:
+            file.write(contexts)
+        file_contexts = FileContext.from_files([ctx_path])
+
+    simple_graph = nx.DiGraph()
+    simple_graph.add_nodes_from(file_contexts)
+    simple_graph.add_edges_from(edges)
+    return SimpleNamespace(file_contexts=file_contexts, simple_graph=simple_graph)
+
+
+class TestCSRAdjacency(unittest.TestCase):
+    def test_adjacency(self) -> None:
+        edges = [(0, 1), (2, 0), (0, 2), (2, 2), (3, 1)]
+        adjacency = CSRAdjacency.from_pairs(4, edges)
+
+        self.assertEqual(len(adjacency), 4)
+        self.assertEqual(adjacency.num_edges, 5)
+        self.assertEqual(list(adjacency.neighbours(0)), [1, 2])
+        self.assertEqual(list(adjacency.neighbours(1)), [])
+        self.assertEqual(sorted(adjacency.edges()), sorted(edges))
+        self.assertEqual(sorted(adjacency.reverse().edges()), sorted((v, u) for u, v in edges))
+
+    def test_components(self) -> None:
+        # 0 <-> 1 -> 2 -> 3 -> 2, 4 -> 4, 5 isolated
+        edges = [(0, 1), (1, 0), (1, 2), (2, 3), (3, 2), (4, 4)]
+        component, count = CSRAdjacency.from_pairs(6, edges).components()
+
+        self.assertEqual(count, 4)
+        self.assertEqual(component[0], component[1])
+        self.assertEqual(component[2], component[3])
+        self.assertLess(component[2], component[0])  # Sinks come first
+
+        closure = TransitiveClosure(CSRAdjacency.from_pairs(6, edges))
+        self.assertEqual(closure.reachable([0]), 0b1111)
+        self.assertEqual(closure.reachable([3]), 0b1100)
+        self.assertEqual(closure.reachable([4]), 0b10000)
+        self.assertEqual(closure.reachable([5]), 0)
+
 
 class TestGraph(unittest.TestCase):
+    reachability = 'search'
+
     def setUp(self) -> None:
         stub_graph = nx.MultiDiGraph()
         left_edges = [  # D -> ^C -> B <- A <-> ^E
@@ -20,8 +91,8 @@ class TestGraph(unittest.TestCase):
         right_edges = [(y, x) for (x, y) in left_edges]  # D <- ^C <- B -> A <-> ^E
         stub_graph.add_edges_from(left_edges, direction='left')
         stub_graph.add_edges_from(right_edges, direction='right')
-        self.graph = InfoFlowGraph(None, None)
-        self.graph._graph = stub_graph
+        self.graph = InfoFlowGraph(None, None, self.reachability)
+        self.graph.load_networkx(stub_graph)
 
     def test_eventually_reach(self) -> None:
         self.assertEqual(self.graph.eventually_reach(['A'], 'left'), {'A', 'E'})
@@ -48,3 +119,155 @@ class TestGraph(unittest.TestCase):
         self.assertEqual(self.graph.eventually_reached_by(['C'], 'left'), {'B', 'C'})
         self.assertEqual(self.graph.eventually_reached_by(['D'], 'left'), {'B', 'C'})
         self.assertEqual(self.graph.eventually_reached_by(['E'], 'left'), {'A', 'B', 'E'})
+
+
+class TestGraphClosure(TestGraph):
+    reachability = 'closure'
+
+    def test_closure_against_search(self) -> None:
+        random.seed(0)
+        stub_graph = nx.MultiDiGraph()
+        stub_graph.add_nodes_from(range(60))
+        for _ in range(150):
+            edge = random.randrange(60), random.randrange(60)
+            stub_graph.add_edge(*edge, direction=random.choice(['left', 'right']))
+        search_graph = InfoFlowGraph(None, None, 'search')
+        search_graph.load_networkx(stub_graph)
+        self.graph.load_networkx(stub_graph)
+
+        for _ in range(20):
+            mask = random.getrandbits(60)
+            for direction in ['left', 'right']:
+                for type in ['in', 'out']:
+                    self.assertEqual(
+                        self.graph.eventually_reachable_mask(mask, direction, type),
+                        search_graph.eventually_reachable_mask(mask, direction, type),
+                    )
+
+
+class TestGraphConstruction(unittest.TestCase):
+    def setUp(self) -> None:
+        self.left = stub_policy(
+            LEFT_CONTEXTS,
+            [
+                ('default_file', 'system_file'),
+                ('shell_exec', 'system_data_file'),
+                ('vendor_data_file', 'vendor_data_file'),
+                ('rild_socket', 'block_device'),
+            ],
+        )
+        self.right = stub_policy(
+            RIGHT_CONTEXTS,
+            [
+                ('system_file', 'default_file'),
+                ('socket_device', 'wifi_data_file'),
+                ('shell_exec', 'shell_exec'),
+                ('block_device', 'system_data_file'),
+            ],
+        )
+        self.graph = InfoFlowGraph(self.left, self.right)
+        self.graph.build_graph()
+
+    def test_nodes(self) -> None:
+        expected = [
+            (left_label, right_label)
+            for left_label, left_fc in self.left.file_contexts.items()
+            for right_label, right_fc in self.right.file_contexts.items()
+            if not mata_nfa.intersection(left_fc.nfa, right_fc.nfa).is_lang_empty()
+        ]
+
+        self.assertEqual(sorted(self.graph.labels), sorted(expected))
+        self.assertIn(('rild_socket', 'socket_device'), self.graph.labels)
+        self.assertIn(('vendor_data_file', 'wifi_data_file'), self.graph.labels)
+        self.assertNotIn(('system_file', 'system_data_file'), self.graph.labels)
+
+    def test_parallel_nodes(self) -> None:
+        parallel_graph = InfoFlowGraph(self.left, self.right)
+        parallel_graph.build_graph(jobs=3)
+
+        self.assertEqual(list(parallel_graph.graph.nodes), list(self.graph.graph.nodes))
+
+    def test_shared_nfas(self) -> None:
+        right = stub_policy(LEFT_CONTEXTS.replace('rild[0-9]?', 'rild[0-9]*'), [])
+        left_contexts = self.left.file_contexts
+        shared = {
+            label
+            for label in left_contexts
+            if left_contexts[label].nfa is right.file_contexts[label].nfa
+        }
+        self.assertIn('system_file', shared)
+        self.assertIn('block_device', shared)
+        self.assertNotIn('rild_socket', shared)
+        self.assertNotIn('default_file', shared)
+
+        expected = [
+            (left_label, right_label)
+            for left_label, left_fc in left_contexts.items()
+            for right_label, right_fc in right.file_contexts.items()
+            if not mata_nfa.intersection(left_fc.nfa, right_fc.nfa).is_lang_empty()
+        ]
+        for jobs in [1, 2]:
+            graph = InfoFlowGraph(self.left, right)
+            graph.build_graph(jobs)
+            self.assertEqual(sorted(graph.labels), sorted(expected))
+
+    def test_successor(self) -> None:
+        following = stub_policy(
+            LEFT_CONTEXTS.replace('rild[0-9]?', 'rild[0-9]*'),
+            [('system_file', 'rild_socket'), ('block_device', 'default_file')],
+        )
+        expected = InfoFlowGraph(self.right, following)
+        expected.build_graph()
+
+        self.graph.release()
+        for jobs in [1, 2]:
+            with self.subTest(jobs=jobs):
+                graph = self.graph.successor(following, jobs)
+                self.assertEqual(graph.nodes, expected.nodes)
+                self.assertEqual(
+                    sorted(graph.graph.edges(keys=True, data='direction')),
+                    sorted(expected.graph.edges(keys=True, data='direction')),
+                )
+                # Intersections with NFAs the following policy shares with the left one are known
+                right_ids = {id(ctx.nfa) for ctx in self.right.file_contexts.values()}
+                following_ids = {id(ctx.nfa) for ctx in following.file_contexts.values()}
+                known = {
+                    key: is_empty
+                    for key, is_empty in self.graph._emptiness.items()
+                    if (key[0] in right_ids and key[1] in following_ids)
+                    or (key[1] in right_ids and key[0] in following_ids)
+                }
+                self.assertEqual({key: graph._emptiness[key] for key in known}, known)
+                self.assertEqual(len(known), 17)
+
+    def test_edges(self) -> None:
+        expected = nx.MultiDiGraph()
+        expected.add_nodes_from(self.graph.graph.nodes)
+        for left_1, right_1 in self.graph.graph.nodes:
+            for left_2, right_2 in self.graph.graph.nodes:
+                if self.left.simple_graph.has_edge(left_1, left_2):
+                    expected.add_edge((left_1, right_1), (left_2, right_2), direction='left')
+                if self.right.simple_graph.has_edge(right_1, right_2):
+                    expected.add_edge((left_1, right_1), (left_2, right_2), direction='right')
+
+        # Every edge of a simple graph is lifted to each product pair with its labels on that side
+        directions = [direction for _, _, direction in expected.edges(data='direction')]
+        self.assertEqual(directions.count('left'), 10)
+        self.assertEqual(directions.count('right'), 10)
+        self.assertTrue(
+            expected.has_edge(('default_file', 'default_file'), ('system_file', 'system_file'))
+        )
+        self.assertEqual(
+            sorted(self.graph.graph.edges(keys=True, data='direction')),
+            sorted(expected.edges(keys=True, data='direction')),
+        )
+
+    def test_csr_round_trip(self) -> None:
+        graph = InfoFlowGraph(self.left, self.right)
+        graph.load_networkx(self.graph.graph)
+
+        self.assertEqual(graph.nodes, self.graph.nodes)
+        self.assertEqual(
+            sorted(graph.graph.edges(keys=True, data='direction')),
+            sorted(self.graph.graph.edges(keys=True, data='direction')),
+        )
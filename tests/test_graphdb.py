@@ -0,0 +1,80 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import networkx as nx
+
+from selinuxtool.android.compress import SubjectCompression
+from selinuxtool.android.graphdb import dump_graphs, load_graphs, parse_graphs, save_graphs
+from selinuxtool.android.label import EdgeType
+
+
+def stub_policy_graph() -> nx.DiGraph:
+    graph = nx.DiGraph()
+    graph.add_node('system_file', is_object=True, is_subject=False)
+    graph.add_node('app_data_file', is_object=True, is_subject=False)
+    graph.add_node('shell', is_object=False, is_subject=True, transitions=[('adbd', 'shell_exec')])
+    graph.add_node('adbd', is_object=False, is_subject=False)
+    graph.add_node('shell_exec', is_object=True, is_subject=False)
+    graph.add_edge('system_file', 'shell', type=EdgeType.READ, perms={'read', 'open'})
+    graph.add_edge('shell', 'app_data_file', type=EdgeType.WRITE | EdgeType.UNKN, perms={'write'})
+    graph.add_edge('shell_exec', 'adbd', type=EdgeType.READ, perms={'execute'})
+    graph.add_edge('adbd', 'shell', type=EdgeType.WRITE, perms={'transition'})
+    graph.add_edge('app_data_file', 'system_file', type=EdgeType.WRITE, perms=set())
+    return graph
+
+
+class TestGraphDb(unittest.TestCase):
+    def setUp(self) -> None:
+        self._dir = tempfile.TemporaryDirectory()
+        self.db_path = Path(self._dir.name) / 'graph.bin'
+        self.graph = stub_policy_graph()
+        self.simple_graph = SubjectCompression(self.graph).simple_graph()
+
+    def tearDown(self) -> None:
+        self._dir.cleanup()
+
+    def assertGraphEqual(self, graph: nx.DiGraph, expected: nx.DiGraph) -> None:
+        self.assertEqual(list(graph.nodes(data=True)), list(expected.nodes(data=True)))
+        self.assertEqual(sorted(graph.edges(data=True)), sorted(expected.edges(data=True)))
+
+    def test_round_trip(self) -> None:
+        save_graphs(self.db_path, b'\1' * 32, self.graph, self.simple_graph)
+        graphs = load_graphs(self.db_path, b'\1' * 32)
+
+        self.assertIsNotNone(graphs)
+        graph, simple_graph = graphs
+        self.assertGraphEqual(graph, self.graph)
+        self.assertGraphEqual(simple_graph, self.simple_graph)
+        self.assertEqual(simple_graph.edges['shell_exec', 'app_data_file']['type'], EdgeType.ADDL)
+
+    def test_rejected(self) -> None:
+        self.assertIsNone(load_graphs(self.db_path, b'\1' * 32))
+
+        save_graphs(self.db_path, b'\1' * 32, self.graph, self.simple_graph)
+        self.assertIsNone(load_graphs(self.db_path, b'\2' * 32))
+
+        with open(self.db_path, 'r+b') as db:
+            db.seek(8)
+            db.write(b'\xff')
+        self.assertIsNone(load_graphs(self.db_path, b'\1' * 32))
+
+    def test_corrupt(self) -> None:
+        db = dump_graphs(b'\1' * 32, self.graph, self.simple_graph)
+        # Every truncation is rejected, whichever section it cuts
+        for length in range(len(db)):
+            with self.subTest(length=length):
+                self.assertIsNone(parse_graphs(db[:length], b'\1' * 32, 'test'))
+
+        # Labels that are not UTF-8, and node ids past the labels
+        labels = db.index(b'system_file')
+        self.assertIsNone(
+            parse_graphs(db.replace(b'system_file', b'\xffystem_file'), b'\1' * 32, 'test')
+        )
+        corrupt = bytearray(db)
+        corrupt[-8:] = b'\x7f' * 8
+        self.assertIsNone(parse_graphs(bytes(corrupt), b'\1' * 32, 'test'))
+
+        with open(self.db_path, 'wb') as file:
+            file.write(db[: labels + 4])
+        self.assertIsNone(load_graphs(self.db_path, b'\1' * 32))
@@ -0,0 +1,78 @@
+import random
+import string
+import unittest
+
+from selinuxtool.android.labelling import SECURITY_LVS, SecurityLvl, SecurityRules, default_rules
+
+
+def keyword_level(node: str) -> SecurityLvl:
+    # The hardcoded keyword scan the default rules replace
+    level = SecurityLvl.NONE
+    if any(
+        kw in node for kw in ['isolate', 'untrust', 'danger', 'user', 'usr', 'debug', 'network']
+    ):
+        level |= SecurityLvl.UNTRUSTED
+    if any(kw in node for kw in ['trust', 'secur']) and 'untrust' not in node:
+        level |= SecurityLvl.TRUSTED
+    if any(kw in node for kw in ['system', 'pol', 'critic', 'manager']):
+        level |= SecurityLvl.CRITICAL
+    return level
+
+
+class TestSecurityRules(unittest.TestCase):
+    def test_default_rules(self) -> None:
+        rng = random.Random(0)
+        words = ['system', 'untrusted', 'trusted', 'app', 'secure', 'user', 'policy', 'data', '_']
+        labels = {
+            ''.join(rng.choice(words + list(string.ascii_lowercase)) for _ in range(4))
+            for _ in range(500)
+        }
+        labels |= {'untrusted_app', 'system_server', 'trusted_secure_file', 'vendor_file'}
+
+        index = default_rules().classify(labels)
+        for label in labels:
+            with self.subTest(label=label):
+                level = SecurityLvl.NONE
+                for single_level in SECURITY_LVS:
+                    if label in index[single_level]:
+                        level |= single_level
+                self.assertEqual(level, keyword_level(label))
+
+    def test_rules(self) -> None:
+        rules = SecurityRules(
+            {
+                'UNTRUSTED': {
+                    'regexes': ['^untrusted_app(_[0-9]+)?$'],
+                    'attributes': ['appdomain'],
+                },
+                'CRITICAL': {
+                    'keywords': ['system'],
+                    'types': ['init', 'vold'],
+                    'exclude': {'types': ['system_app'], 'regexes': ['_tmpfs$']},
+                },
+            }
+        )
+        labels = [
+            'untrusted_app_25',
+            'untrusted_app_zygote',
+            'platform_app',
+            'init',
+            'vold',
+            'system_server',
+            'system_app',
+            'system_tmpfs',
+        ]
+        index = rules.classify(labels, {'appdomain': frozenset({'platform_app', 'system_app'})})
+
+        self.assertEqual(rules.attributes, {'appdomain'})
+        self.assertEqual(
+            index[SecurityLvl.UNTRUSTED], {'untrusted_app_25', 'platform_app', 'system_app'}
+        )
+        self.assertEqual(index[SecurityLvl.CRITICAL], {'init', 'vold', 'system_server'})
+        self.assertEqual(index[SecurityLvl.TRUSTED], set())
+
+    def test_unknown_level(self) -> None:
+        with self.assertRaises(ValueError):
+            SecurityRules({'CRITICAL': {}, 'SECRET': {'keywords': ['key']}})
+        with self.assertRaises(ValueError):
+            SecurityRules({'NONE': {}})
@@ -0,0 +1,82 @@
+import logging
+import pickle
+import unittest
+from pathlib import Path
+
+from test_graphdb import stub_policy_graph
+
+from selinuxtool.android.compress import SubjectCompression
+from selinuxtool.android.label import EdgeType
+from selinuxtool.android.loader import _Dispatcher
+from selinuxtool.android.policy import Policy, SecurityLvl
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self) -> None:
+        super().__init__()
+        self.messages: list[str] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.messages.append(record.getMessage())
+
+
+class TestPolicyTransfer(unittest.TestCase):
+    def test_pickle(self) -> None:
+        policy = Policy(Path('stub'))
+        policy._graph = stub_policy_graph()
+        policy._compression = SubjectCompression(policy._graph)
+        policy._simple_graph = policy._compression.simple_graph()
+        policy._security_index = {
+            SecurityLvl.UNTRUSTED: frozenset({'app_data_file'}),
+            SecurityLvl.TRUSTED: frozenset(),
+            SecurityLvl.CRITICAL: frozenset({'system_file', 'shell_exec'}),
+        }
+        policy._set_security_levels()
+
+        loaded = pickle.loads(pickle.dumps(policy))
+        self.assertEqual(list(loaded._graph.nodes(data=True)), list(policy._graph.nodes(data=True)))
+        self.assertEqual(
+            sorted(loaded.simple_graph.edges(data=True)),
+            sorted(policy.simple_graph.edges(data=True)),
+        )
+        self.assertEqual(loaded.critical_labels, policy.critical_labels)
+        self.assertEqual(
+            loaded.witness_path('shell_exec', 'app_data_file'),
+            ['shell_exec', 'adbd', 'shell', 'app_data_file'],
+        )
+        self.assertEqual(
+            loaded.simple_graph.edges['shell_exec', 'app_data_file']['type'], EdgeType.ADDL
+        )
+
+
+class TestDispatcher(unittest.TestCase):
+    def setUp(self) -> None:
+        self.handler = RecordingHandler()
+        self.logger = logging.getLogger('SELinuxTool:r')
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self) -> None:
+        self.logger.removeHandler(self.handler)
+
+    def record(self, name: str, policy: str, msg: str) -> logging.LogRecord:
+        record = logging.LogRecord(name, logging.INFO, __file__, 0, msg, None, None)
+        record.policy = policy
+        return record
+
+    def test_progress(self) -> None:
+        dispatcher = _Dispatcher()
+        dispatcher.emit(self.record('SELinuxTool:r', '#1 a', 'Reading 1 / 2.'))
+        dispatcher.emit(self.record('SELinuxTool:r', '#2 b', 'Reading 1 / 3.'))
+        dispatcher.emit(self.record('SELinuxTool:r', '#1 a', 'Reading 2 / 2.'))
+        dispatcher.emit(self.record('SELinuxTool', '#1 a', 'Done.'))
+        dispatcher.emit(self.record('SELinuxTool:r', '#2 b', 'Reading 2 / 3.'))
+
+        self.assertEqual(
+            self.handler.messages,
+            [
+                '[#1 a] Reading 1 / 2.',
+                '[#1 a] Reading 1 / 2. | [#2 b] Reading 1 / 3.',
+                '[#1 a] Reading 2 / 2. | [#2 b] Reading 1 / 3.',
+                '[#2 b] Reading 2 / 3.',
+            ],
+        )
@@ -1,3 +1,5 @@
+import copy
+import pickle
 import unittest
 
 from selinuxtool.ifdif.ast import _POLICY, And, BDiamond, Diamond, Not, TruePolicy, UpArrow
@@ -66,3 +68,23 @@ class TestPolicyParser(unittest.TestCase):
         self.assertIsInstance(ast.index, int)
         self.assertIsInstance(ast.policy, _POLICY)
         self.assertEqual(ast.index, 2)
+
+    def test_hash_consing(self) -> None:
+        ast: And = self._parser.solve('ito_2(label_2(CRITICAL)) and not ito_1(label_2(CRITICAL))')
+        other: Diamond = self._parser.solve('ito_2 (label_2 (CRITICAL))')
+
+        self.assertIs(ast.left, other)
+        self.assertIs(ast.left.policy, ast.right.inner.policy)
+        self.assertIsNot(ast.left, ast.right.inner)
+        self.assertIs(UpArrow(1, 'testLabel'), UpArrow(index=1, label='testLabel'))
+
+    def test_pickle_and_copy(self) -> None:
+        ast = self._parser.solve('ifrom_1(label_2(CRITICAL)) and not ito_2(label_1(testLabel))')
+
+        # Copies are rebuilt through the interning constructor, so they are the same nodes
+        self.assertIs(pickle.loads(pickle.dumps(ast)), ast)
+        self.assertIs(copy.deepcopy(ast), ast)
+        self.assertIs(copy.copy(ast), ast)
+        self.assertIs(
+            pickle.loads(pickle.dumps(Diamond(1, UpArrow(1, 'x')))), Diamond(1, UpArrow(1, 'x'))
+        )
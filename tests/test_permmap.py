@@ -0,0 +1,58 @@
+import random
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+
+from setools.exception import UnmappedClass, UnmappedPermission
+from setools.permmap import Mapping
+
+from selinuxtool.android.permmap import AndroidPermissionMap, RuleInfoFlow
+
+PERMMAP_FILE = Path('src/selinuxtool/perm_map')
+
+
+def mapping_infoflow(permmap: AndroidPermissionMap, rule: SimpleNamespace) -> RuleInfoFlow:
+    # Reference implementation: a setools Mapping per permission
+    infoflow = RuleInfoFlow(0, 0, [], [], [])
+    for perm in rule.perms:
+        try:
+            mapping = Mapping(permmap._permmap, rule.tclass, perm)
+        except (UnmappedClass, UnmappedPermission):
+            infoflow.unknown_perms.append(perm)
+            continue
+
+        if not mapping.enabled:
+            continue
+        if mapping.direction in ('r', 'b'):
+            infoflow.read_perms.append(perm)
+            infoflow.read = max(infoflow.read, mapping.weight)
+        if mapping.direction in ('w', 'b'):
+            infoflow.write_perms.append(perm)
+            infoflow.write = max(infoflow.write, mapping.weight)
+    return infoflow
+
+
+class TestAndroidPermissionMap(unittest.TestCase):
+    def setUp(self) -> None:
+        self.permmap = AndroidPermissionMap(PERMMAP_FILE)
+        rng = random.Random(0)
+        self.rules = []
+        for _ in range(500):
+            tclass = rng.choice(['file', 'dir', 'sock_file', 'binder', 'no_such_class'])
+            perms = rng.sample(['read', 'write', 'open', 'getattr', 'ioctl', 'call', 'unknown'], 4)
+            self.rules.append(SimpleNamespace(tclass=tclass, perms=perms))
+
+    def test_against_mappings(self) -> None:
+        for rule in self.rules * 2:
+            self.assertEqual(self.permmap.rule_infoflow(rule), mapping_infoflow(self.permmap, rule))
+
+    def test_invalidation(self) -> None:
+        rule = SimpleNamespace(tclass='file', perms=['read', 'write', 'getattr'])
+        self.assertIn('read', self.permmap.rule_infoflow(rule).read_perms)
+
+        self.permmap.set_direction('file', 'read', 'w')
+        self.assertEqual(self.permmap.rule_infoflow(rule), mapping_infoflow(self.permmap, rule))
+        self.assertIn('read', self.permmap.rule_infoflow(rule).write_perms)
+
+        self.permmap.exclude_permission('file', 'read')
+        self.assertNotIn('read', self.permmap.rule_infoflow(rule).perms)
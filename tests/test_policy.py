@@ -1,12 +1,167 @@
 import logging
+import random
 import subprocess
 import unittest
 from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
 
-from selinuxtool.android.policy import Policy
+import networkx as nx
+import setools
+
+from selinuxtool.android.label import EdgeType
+from selinuxtool.android.labelling import SECURITY_LVS
+from selinuxtool.android.permmap import AndroidPermissionMap
+from selinuxtool.android.policy import Policy, _reaching
 from selinuxtool.util.common import nfa_to_word
 
 
+class TestReaching(unittest.TestCase):
+    def test_against_has_path(self) -> None:
+        random.seed(0)
+        graph = nx.gnm_random_graph(40, 60, seed=0, directed=True)
+        for _ in range(10):
+            targets = random.sample(range(45), 3)  # Some targets may be missing
+            expected = {
+                source
+                for source in graph
+                for target in targets
+                if target in graph and nx.has_path(graph, source, target)
+            }
+            self.assertEqual(_reaching(graph, targets), expected)
+
+
+def allow(source: str, target: str, tclass: str, perms: list[str]) -> mock.Mock:
+    return mock.Mock(
+        spec=setools.policyrep.AVRule,
+        ruletype=setools.policyrep.TERuletype.allow,
+        source=source,
+        target=target,
+        tclass=tclass,
+        perms=perms,
+    )
+
+
+def type_transition(source: str, target: str, default: str) -> mock.Mock:
+    return mock.Mock(
+        spec=setools.policyrep.TERule,
+        ruletype=setools.policyrep.TERuletype.type_transition,
+        source=source,
+        target=target,
+        default=default,
+    )
+
+
+def multi_pass_graph(
+    rules: list[mock.Mock], permmap: AndroidPermissionMap, file_contexts: list[str]
+) -> tuple[nx.DiGraph, set[str]]:
+    # The graph construction replaced by the single pass, one walk of the rules per step
+    graph = nx.DiGraph()
+    missing_ctx = set()
+
+    def add_edge(source: str, target: str, type: EdgeType, perms: list[str]) -> None:
+        if graph.has_edge(source, target):
+            graph.edges[source, target]['perms'] |= set(perms)
+            graph.edges[source, target]['type'] |= type
+        else:
+            graph.add_edge(source, target, type=type, perms=set(perms))
+
+    def add_subj_node(label: str, transition: tuple[str, str]) -> None:
+        if graph.has_node(label):
+            if graph.nodes[label]['is_subject']:
+                graph.nodes[label]['transitions'].append(transition)
+            else:
+                graph.nodes[label]['is_subject'] = True
+                graph.nodes[label]['transitions'] = [transition]
+        else:
+            graph.add_node(label, is_subject=True, transitions=[transition])
+
+    for terule in rules:
+        if isinstance(terule, setools.policyrep.AVRule):
+            if terule.ruletype == setools.policyrep.TERuletype.allow:
+                u_label = str(terule.source)
+                v_label = str(terule.target)
+                rule_if = permmap.rule_infoflow(terule)
+                if rule_if.read_perms:
+                    add_edge(v_label, u_label, EdgeType.READ, rule_if.read_perms)
+                if rule_if.write_perms:
+                    add_edge(u_label, v_label, EdgeType.WRITE, rule_if.write_perms)
+                if rule_if.unknown_perms:
+                    add_edge(v_label, u_label, EdgeType.UNKN, rule_if.unknown_perms)
+                    add_edge(u_label, v_label, EdgeType.UNKN, rule_if.unknown_perms)
+    nx.set_node_attributes(graph, False, 'is_object')
+    nx.set_node_attributes(graph, False, 'is_subject')
+
+    for ctx in file_contexts:
+        graph.add_node(ctx, is_object=True)
+
+    for terule in list(rules):
+        if (
+            isinstance(terule, setools.policyrep.TERule)
+            and terule.ruletype == setools.policyrep.TERuletype.type_transition
+        ):
+            if not graph.nodes[terule.target]['is_object']:
+                missing_ctx.add(str(terule.target))
+            add_subj_node(str(terule.default), (str(terule.source), str(terule.target)))
+    return graph, missing_ctx
+
+
+class TestBuildGraph(unittest.TestCase):
+    def test_against_multi_pass(self) -> None:
+        rules = [
+            allow('shell', 'system_file', 'file', ['read', 'getattr', 'execute']),
+            allow('shell', 'app_data_file', 'file', ['write', 'append', 'open']),
+            allow('untrusted_app', 'app_data_file', 'file', ['read', 'write', 'mounton']),
+            allow('shell', 'system_file', 'file', ['setattr', 'frobnicate']),
+            allow('adbd', 'shell', 'process', ['transition', 'sigchld']),
+            allow('vold', 'block_device', 'blk_file', ['ioctl', 'lock']),
+            allow('vold', 'vold_socket', 'unmapped_class', ['connectto']),
+            type_transition('adbd', 'shell_exec', 'shell'),
+            type_transition('init', 'vold_exec', 'vold'),
+            type_transition('zygote', 'app_exec', 'untrusted_app'),
+            type_transition('init', 'adbd', 'adbd'),
+            type_transition('vold', 'shell_exec', 'shell'),
+            allow('untrusted_app', 'shell_exec', 'file', ['execute']),
+        ]
+        file_contexts = [
+            'system_file',
+            'app_data_file',
+            'shell_exec',
+            'vold_exec',
+            'app_exec',
+            'block_device',
+        ]
+        policy = Policy(Path('stub'))
+        policy._sepolicy = SimpleNamespace(terules=lambda: iter(rules))
+        policy._file_contexts = dict.fromkeys(file_contexts)
+        policy._build_graph()
+
+        expected, missing_ctx = multi_pass_graph(rules, policy.perm_map, file_contexts)
+        self.assertEqual(list(policy._graph.nodes(data=True)), list(expected.nodes(data=True)))
+        self.assertEqual(list(policy._graph.edges(data=True)), list(expected.edges(data=True)))
+        self.assertEqual(policy._missing_ctx, missing_ctx)
+        # Spot checks against the permission map
+        self.assertEqual(
+            policy._graph.edges['system_file', 'shell'],
+            {
+                'type': EdgeType.READ | EdgeType.UNKN,
+                'perms': {'read', 'getattr', 'execute', 'frobnicate'},
+            },
+        )
+        self.assertEqual(policy._missing_ctx, {'adbd'})
+
+
+class TestSecurityIndex(unittest.TestCase):
+    def test_unlabelled_policy(self) -> None:
+        policy = Policy(Path('stub'))
+
+        self.assertEqual(policy.untrusted_labels, frozenset())
+        self.assertEqual(policy.trusted_labels, frozenset())
+        self.assertEqual(policy.critical_labels, frozenset())
+        for level in SECURITY_LVS:
+            self.assertEqual(policy.security_labels(level), frozenset())
+
+
 class TestPolicySecurityDiffs(unittest.TestCase):
     def setUp(self) -> None:
         self.logger = logging.getLogger('SELinuxTool')
@@ -0,0 +1,114 @@
+import random
+import unittest
+
+from test_solver import simple_policy
+
+from selinuxtool.android.graph import InfoFlowGraph
+from selinuxtool.ifdif import scheduler
+from selinuxtool.ifdif.parser import Parser
+from selinuxtool.ifdif.scheduler import evaluate_queries
+from selinuxtool.ifdif.solver import Solver
+
+QUERIES = [
+    'label_2 (CRITICAL) and not label_1 (CRITICAL)',
+    'ito_2(label_2(CRITICAL)) and not ito_1(label_2(CRITICAL))',
+    'ifrom_1(label_1(UNTRUSTED)) and not ifrom_2(label_1(UNTRUSTED))',
+    '(label_1(UNTRUSTED) and ito_2(ifrom_1(label_2(CRITICAL)))) and not '
+    '(label_1(UNTRUSTED) and ito_1(ifrom_2(label_2(CRITICAL))))',
+    'true',
+    'not true',
+]
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self) -> None:
+        self.parser = Parser()
+        self.asts = [self.parser.solve(query) for query in QUERIES * 3]
+
+    def random_graph(self, seed: int, reachability: str = 'auto') -> InfoFlowGraph:
+        rng = random.Random(seed)
+        labels = ['criticalC', 'untrustedA', 'untrustedB', 'safeD']
+        edges = [(u, v) for u in labels for v in labels if rng.random() < 0.3]
+        changed = [edge for edge in edges if rng.random() < 0.9]
+        graph = InfoFlowGraph(
+            simple_policy('simplePolicy1', edges),
+            simple_policy('simplePolicy2', changed),
+            reachability,
+        )
+        graph.build_graph()
+        return graph
+
+    def test_parallel(self) -> None:
+        # Results come back in query order, whatever worker evaluated them
+        for seed, reachability, differential in [
+            (0, 'search', False),
+            (1, 'closure', False),
+            (2, 'search', True),
+            (3, 'closure', True),
+        ]:
+            with self.subTest(seed=seed, reachability=reachability, differential=differential):
+                graph = self.random_graph(seed, reachability)
+                solver = Solver(graph)
+                results = list(evaluate_queries(graph, self.asts, 3, differential, 2))
+                self.assertEqual(
+                    [result.model for result in results],
+                    [solver.model(ast) for ast in self.asts],
+                )
+                sequential = list(evaluate_queries(graph, self.asts, 1, differential, 2))
+                self.assertEqual(
+                    [result.witnesses for result in results],
+                    [result.witnesses for result in sequential],
+                )
+
+    def test_cache(self) -> None:
+        # The sequential evaluation shares a single solver cache across the batch
+        graph = self.random_graph(0)
+        results = list(evaluate_queries(graph, self.asts))
+        self.assertEqual(sum(result.cache_misses for result in results[len(QUERIES) :]), 0)
+
+    def test_witnesses(self) -> None:
+        graph = InfoFlowGraph(
+            simple_policy(
+                'simplePolicy1',
+                [('criticalC', 'untrustedA'), ('criticalC', 'untrustedB'), ('safeD', 'criticalC')],
+            ),
+            simple_policy(
+                'simplePolicy2',
+                [('criticalC', 'untrustedA'), ('safeD', 'criticalC'), ('untrustedB', 'safeD')],
+            ),
+        )
+        graph.build_graph()
+        ast = self.parser.solve('ito_2(label_2(CRITICAL)) and not ito_1(label_2(CRITICAL))')
+        [unexplained] = evaluate_queries(graph, [ast])
+        self.assertEqual(
+            graph.nodes_of(unexplained.model),
+            {('untrustedA', 'safeD'), ('untrustedB', 'untrustedB')},
+        )
+        self.assertEqual(unexplained.witnesses, [])
+
+        # Only the first counterexample is explained, by its ito_2
+        [explained] = evaluate_queries(graph, [ast], max_witnesses=1)
+        self.assertEqual(
+            explained.witnesses,
+            [
+                (
+                    ('untrustedA', 'safeD'),
+                    1,
+                    [('untrustedA', 'safeD'), ('criticalC', 'criticalC')],
+                )
+            ],
+        )
+
+    def test_errors(self) -> None:
+        graph = self.random_graph(0)
+        asts = [self.parser.solve('true'), self.parser.solve('label_3(CRITICAL)')]
+        with self.assertRaises(IndexError):
+            list(evaluate_queries(graph, asts, 2))
+        # The shared batch state is released, failed or not
+        self.assertIsNone(scheduler._shared)
+        list(evaluate_queries(graph, asts[:1] * 2, 2))
+        self.assertIsNone(scheduler._shared)
+
+
+if __name__ == '__main__':
+    unittest.main()
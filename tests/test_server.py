@@ -0,0 +1,149 @@
+import io
+import json
+import threading
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from test_solver import simple_policy
+
+from selinuxtool.server import QueryServer, send_requests
+
+
+def serve(server: QueryServer, requests: list[dict | str]) -> list[dict]:
+    lines = [request if isinstance(request, str) else json.dumps(request) for request in requests]
+    responses = io.StringIO()
+    server.serve_stream(io.StringIO('\n'.join(lines) + '\n'), responses)
+    return [json.loads(line) for line in responses.getvalue().splitlines()]
+
+
+class TestQueryServer(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = QueryServer()
+        # The hand-written policies stand in for loaded ones
+        self.server._policies['one'] = simple_policy(
+            'simplePolicy1',
+            [('criticalC', 'untrustedA'), ('criticalC', 'untrustedB'), ('safeD', 'criticalC')],
+        )
+        self.server._policies['two'] = simple_policy(
+            'simplePolicy2',
+            [('criticalC', 'untrustedA'), ('safeD', 'criticalC'), ('untrustedB', 'safeD')],
+        )
+        for name, policy in self.server._policies.items():
+            policy.path = Path('policies') / name
+
+    def test_query(self) -> None:
+        query = {
+            'op': 'query',
+            'left': 'one',
+            'right': 'two',
+            'queries': [
+                'label_2 (CRITICAL) and not label_1 (CRITICAL)',
+                'ito_2(label_2(CRITICAL)) and not ito_1(label_2(CRITICAL))',
+            ],
+        }
+        first, second = serve(self.server, [query, query])
+        self.assertTrue(first['ok'])
+        self.assertEqual([result['holds'] for result in first['results']], [True, False])
+        self.assertEqual(
+            first['results'][1]['counterexamples'],
+            [['untrustedA', 'safeD'], ['untrustedB', 'untrustedB']],
+        )
+        # The product graph is kept for the next request
+        self.assertEqual(second['graph_time'], 0.0)
+        self.assertEqual(
+            [result['counterexamples'] for result in second['results']],
+            [result['counterexamples'] for result in first['results']],
+        )
+
+    def test_errors(self) -> None:
+        def query(queries: object) -> dict:
+            return {'op': 'query', 'left': 'one', 'right': 'two', 'queries': queries}
+
+        responses = serve(
+            self.server,
+            [
+                'not json',
+                '["op", "list"]',
+                {'op': 'frobnicate'},
+                {'op': 'query', 'left': 'one'},
+                {'op': 'query', 'left': 'one', 'right': 'three', 'queries': []},
+                query(['label_1 (']),
+                query(['ito_3(true)']),
+                query(['label_3(CRITICAL)']),
+                query('true'),
+                {'op': 'load', 'name': 'three', 'path': '/nonexistent'},
+            ],
+        )
+        self.assertEqual([response['ok'] for response in responses], [False] * 10)
+        self.assertIn('JSON objects', responses[1]['error'])
+        self.assertEqual(responses[2]['error'], 'Unknown operation frobnicate.')
+        self.assertEqual(responses[3]['error'], 'Missing fields right, queries for query.')
+        self.assertEqual(responses[4]['error'], 'Policy three is not loaded.')
+        self.assertIn('IndexError', responses[6]['error'])
+        self.assertIn('IndexError', responses[7]['error'])
+        self.assertEqual(responses[8]['error'], 'Queries must be a list of strings.')
+
+        # The server carries on with everything still loaded
+        [response] = serve(self.server, [query(['true'])])
+        self.assertEqual(response['results'][0]['holds'], False)
+        self.assertTrue(self.server.running)
+
+    def test_failed_reload(self) -> None:
+        with TemporaryDirectory() as tmp:
+            (Path(tmp) / 'build.prop').write_text('ro.build.version.release=14\n')
+            serve(self.server, [{'op': 'query', 'left': 'one', 'right': 'two', 'queries': []}])
+            [response] = serve(self.server, [{'op': 'load', 'name': 'one', 'path': tmp}])
+
+        # The policy being replaced and its graphs are kept when the new one fails to load
+        self.assertFalse(response['ok'])
+        self.assertEqual(self.server._policies['one'].path, Path('policies') / 'one')
+        self.assertEqual(list(self.server._graphs), [('one', 'two')])
+
+    def test_unload_and_eviction(self) -> None:
+        self.server._max_bytes = 0
+        serve(
+            self.server,
+            [
+                {'op': 'query', 'left': 'one', 'right': 'two', 'queries': []},
+                {'op': 'query', 'left': 'two', 'right': 'one', 'queries': []},
+            ],
+        )
+        # Only the most recent graph fits (or rather, is always kept)
+        self.assertEqual(list(self.server._graphs), [('two', 'one')])
+
+        listing, _, after = serve(
+            self.server, [{'op': 'list'}, {'op': 'unload', 'name': 'one'}, {'op': 'list'}]
+        )
+        self.assertEqual(sorted(listing['policies']), ['one', 'two'])
+        self.assertEqual(listing['graphs'], [['two', 'one']])
+        self.assertEqual(list(after['policies']), ['two'])
+        self.assertEqual(after['graphs'], [])
+
+    def test_shutdown(self) -> None:
+        responses = serve(self.server, [{'op': 'shutdown'}, {'op': 'list'}])
+        self.assertEqual(responses, [{'ok': True}])
+        self.assertFalse(self.server.running)
+
+    def test_socket(self) -> None:
+        with TemporaryDirectory() as tmp:
+            socket_path = Path(tmp) / 'server.sock'
+            thread = threading.Thread(
+                target=self.server.serve_socket, args=(socket_path,), daemon=True
+            )
+            thread.start()
+            while not socket_path.exists():
+                thread.join(0.01)
+
+            (response,) = send_requests(socket_path, [{'op': 'list'}])
+            self.assertEqual(sorted(response['policies']), ['one', 'two'])
+            # Later connections see the state left by the earlier ones
+            send_requests(socket_path, [{'op': 'unload', 'name': 'one'}, {'op': 'shutdown'}])
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+            self.assertEqual(list(self.server._policies), ['two'])
+            self.assertFalse(socket_path.exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+import random
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+
+import networkx as nx
+
+from selinuxtool.android.file_contexts import FileContext
+from selinuxtool.android.graph import InfoFlowGraph
+from selinuxtool.android.policy import SecurityLvl
+from selinuxtool.ifdif.parser import Parser
+from selinuxtool.ifdif.solver import _DIFFERENTIAL_MAX_REGION, Solver, swap_diamonds
+
+
+def simple_policy(name: str, edges: list[tuple[str, str]]) -> SimpleNamespace:
+    # The kick-the-tire policies, with the simple graph written out by hand
+    file_contexts = FileContext.from_files([Path('policies') / name / 'plat_file_contexts'])
+    simple_graph = nx.DiGraph()
+    simple_graph.add_nodes_from(file_contexts)
+    simple_graph.add_edges_from(edges)
+    return SimpleNamespace(
+        file_contexts=file_contexts,
+        simple_graph=simple_graph,
+        security_labels={
+            SecurityLvl.UNTRUSTED: frozenset({'untrustedA', 'untrustedB'}),
+            SecurityLvl.TRUSTED: frozenset(),
+            SecurityLvl.CRITICAL: frozenset({'criticalC'}),
+        }.__getitem__,
+    )
+
+
+class TestSolver(unittest.TestCase):
+    def setUp(self) -> None:
+        left = simple_policy(
+            'simplePolicy1',
+            [('criticalC', 'untrustedA'), ('criticalC', 'untrustedB'), ('safeD', 'criticalC')],
+        )
+        right = simple_policy(
+            'simplePolicy2',
+            [('criticalC', 'untrustedA'), ('safeD', 'criticalC'), ('untrustedB', 'safeD')],
+        )
+        self.graph = InfoFlowGraph(left, right)
+        self.graph.build_graph()
+        self.parser = Parser()
+        self.solver = Solver(self.graph)
+
+    def solve(self, query: str) -> set[tuple[str, str]]:
+        return self.graph.nodes_of(self.solver.model(self.parser.solve(query)))
+
+    def test_kick_the_tire(self) -> None:
+        self.assertEqual(self.solve('label_2 (CRITICAL) and not label_1 (CRITICAL)'), set())
+        self.assertEqual(
+            self.solve('ito_2(label_2(CRITICAL)) and not ito_1(label_2(CRITICAL))'),
+            {('untrustedB', 'untrustedB'), ('untrustedA', 'safeD')},
+        )
+
+    def test_operators(self) -> None:
+        self.assertEqual(self.solve('true'), self.graph.labels)
+        self.assertEqual(self.solve('not true'), set())
+        self.assertEqual(
+            self.solve('label_1 (untrustedA)'),
+            {('untrustedA', 'untrustedA'), ('untrustedA', 'safeD')},
+        )
+        self.assertEqual(
+            self.solve('ifrom_2 label_2 (untrustedB)'),
+            {
+                ('criticalC', 'criticalC'),
+                ('safeD', 'safeD'),
+                ('untrustedA', 'safeD'),
+                ('untrustedA', 'untrustedA'),
+            },
+        )
+
+    def test_cache(self) -> None:
+        self.solve('ito_2(label_2(CRITICAL)) and not ito_1(label_2(CRITICAL))')
+        # label_2(CRITICAL) is shared by both diamonds
+        self.assertEqual(self.solver.cache_hits, 1)
+        misses = self.solver.cache_misses
+        self.solve('(label_2(UNTRUSTED) and ito_2(label_2(CRITICAL)))')
+
+        # Only the new label and the And are computed, ito_2(...) comes from the first query
+        self.assertEqual(self.solver.cache_misses, misses + 2)
+        self.assertEqual(self.solver.cache_hits, 2)
+
+    def test_differential(self) -> None:
+        queries = [
+            'ito_2(label_2(CRITICAL)) and not ito_1(label_2(CRITICAL))',
+            '(label_2(UNTRUSTED) and ito_2(label_2(CRITICAL))) and not '
+            '(label_2(UNTRUSTED) and ito_1(label_2(CRITICAL)))',
+            'ifrom_2(ito_1(label_1(untrustedA))) and not ifrom_1(ito_2(label_1(untrustedA)))',
+            'not ito_2(true) and not not ito_1(true)',
+        ]
+        solver = Solver(self.graph, differential=True)
+        for query in queries:
+            with self.subTest(query=query):
+                ast = self.parser.solve(query)
+                self.assertIs(ast.right.inner, swap_diamonds(ast.left))
+                self.assertEqual(solver.model(ast), self.solver.model(ast))
+
+    def test_differential_random(self) -> None:
+        ast = self.parser.solve(
+            '(label_1(UNTRUSTED) and ito_2(ifrom_1(label_2(CRITICAL)))) and not '
+            '(label_1(UNTRUSTED) and ito_1(ifrom_2(label_2(CRITICAL))))'
+        )
+        labels = ['criticalC', 'untrustedA', 'untrustedB', 'safeD']
+        for seed in range(20):
+            with self.subTest(seed=seed):
+                rng = random.Random(seed)
+                edges = [(u, v) for u in labels for v in labels if rng.random() < 0.3]
+                changed = [edge for edge in edges if rng.random() < 0.9]
+                graph = InfoFlowGraph(
+                    simple_policy('simplePolicy1', edges), simple_policy('simplePolicy2', changed)
+                )
+                graph.build_graph()
+                self.assertEqual(
+                    Solver(graph, differential=True).model(ast), Solver(graph).model(ast)
+                )
+
+    def test_differential_skipped(self) -> None:
+        # Where both policies have the same edges, the whole graph is skipped
+        edges = [('criticalC', 'untrustedA'), ('safeD', 'criticalC'), ('untrustedB', 'safeD')]
+        policy = simple_policy('simplePolicy2', edges)
+        graph = InfoFlowGraph(policy, policy)
+        graph.build_graph()
+        solver = Solver(graph, differential=True)
+
+        ast = self.parser.solve('ito_2(label_2(CRITICAL)) and not ito_1(label_2(CRITICAL))')
+        self.assertEqual(solver.model(ast), 0)
+        self.assertEqual(solver.skipped_nodes, len(graph.nodes))
+
+        # Large deltas fall back to the whole graph: both edges are new, leaving one node out
+        changed = [('criticalC', 'untrustedA'), ('criticalC', 'safeD')]
+        graph = InfoFlowGraph(
+            simple_policy('simplePolicy1', []), simple_policy('simplePolicy2', changed)
+        )
+        graph.build_graph()
+        region_size = graph.delta_region_mask().bit_count()
+        self.assertGreater(region_size, _DIFFERENTIAL_MAX_REGION * len(graph.nodes))
+        self.assertLess(region_size, len(graph.nodes))
+        solver = Solver(graph, differential=True)
+        self.assertEqual(solver.model(ast), Solver(graph).model(ast))
+        self.assertEqual(solver.skipped_nodes, 0)
+
+    def test_witnesses(self) -> None:
+        ast = self.parser.solve('ito_2(label_2(CRITICAL)) and not ito_1(label_2(CRITICAL))')
+        self.solver.model(ast)
+
+        witnesses = list(self.solver.witnesses(ast, ('untrustedB', 'untrustedB')))
+        self.assertEqual(len(witnesses), 1)
+        self.assertEqual(
+            witnesses[0][1],
+            [('untrustedB', 'untrustedB'), ('safeD', 'safeD'), ('criticalC', 'criticalC')],
+        )
+
+        ast = self.parser.solve('ifrom_2 label_2 (untrustedB)')
+        for node in self.graph.nodes_of(self.solver.model(ast)):
+            [(_, path)] = self.solver.witnesses(ast, node)
+            self.assertEqual(path[0], ('untrustedB', 'untrustedB'))
+            self.assertEqual(path[-1], node)
+
+    def test_witnesses_not_negated(self) -> None:
+        # The diamond under the negation does not explain why a node satisfies the query
+        ast = self.parser.solve(
+            'label_1(UNTRUSTED) and not (label_2(UNTRUSTED) and ito_2(label_2(CRITICAL)))'
+        )
+        node = ('untrustedA', 'safeD')
+        self.assertIn(node, self.graph.nodes_of(self.solver.model(ast)))
+        self.assertEqual(list(self.solver.witnesses(ast, node)), [])